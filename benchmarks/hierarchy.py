@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+    Role resolution on a synthetic hierarchy.
+
+    Builds a role tree of the given depth and fanout in in-memory SQLite,
+    assigns random roles to users and groups, then measures:
+
+    ``get_children``
+        ``RoleMixin.get_children`` on the root role
+    ``get_role_names``
+        ``UserMixin.get_role_names`` on each user
+    ``identity``
+        loading a Flask-Principal identity and checking one permission,
+        with a cold role cache
+    ``request``
+        a request to a ``Roles.require_any`` protected view, with a warm
+        role cache
+
+    For each it reports the mean time, SQL statements per operation and the
+    peak memory allocated while running it. Run from the repository root::
+
+        python -m benchmarks.hierarchy --depth 5 --fanout 4 --users 200
+
+    Pass ``--json`` to get one JSON object per operation, for tracking
+    results over time.
+"""
+import argparse
+import json
+import random
+import time
+import tracemalloc
+
+import flask_roles
+import sqlalchemy as sa
+from flask import Flask, Response
+from flask_login import LoginManager, login_user
+from flask_principal import Identity, Permission, RoleNeed, identity_loaded
+
+from benchmarks.models import (
+    Group,
+    GroupRole,
+    Role,
+    User,
+    UserGroup,
+    UserRole,
+    db,
+)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--fanout", type=int, default=5)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--groups", type=int, default=10)
+    parser.add_argument("--roles-per-user", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--graph", action="store_true", help="ROLES_GRAPH")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true")
+    return parser.parse_args(argv)
+
+
+def create_app(args):
+    app = Flask(__name__)
+    app.config["SECRET_KEY"] = "benchmark"
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["ROLES_GRAPH"] = args.graph
+    app.config["ROLES_IDENTITY_LOADED"] = True
+
+    db.init_app(app)
+    login_manager = LoginManager(app)
+    login_manager.user_loader(lambda id: db.session.query(User).get(int(id)))
+    roles = flask_roles.Roles(app, user_model=User)
+
+    @app.route("/protected")
+    @roles.require_any("role-0")
+    def protected():
+        return Response("ok")
+
+    return app, roles
+
+
+def populate(args):
+    """Insert the tree level by level, then users, groups and grants."""
+    rng = random.Random(args.seed)
+    role_rows = [{"id": 1, "name": "role-0", "parent_id": None}]
+    level = [1]
+    for _ in range(args.depth):
+        next_level = []
+        for parent_id in level:
+            for _ in range(args.fanout):
+                role_id = len(role_rows) + 1
+                role_rows.append(
+                    {
+                        "id": role_id,
+                        "name": "role-%d" % (role_id - 1),
+                        "parent_id": parent_id,
+                    }
+                )
+                next_level.append(role_id)
+        level = next_level
+    role_ids = [row["id"] for row in role_rows]
+
+    def grants(key, holder_ids):
+        return [
+            {key: holder_id, "role_id": role_id}
+            for holder_id in holder_ids
+            for role_id in rng.sample(
+                role_ids, min(args.roles_per_user, len(role_ids))
+            )
+        ]
+
+    user_ids = range(1, args.users + 1)
+    group_ids = range(1, args.groups + 1)
+    session = db.session
+    session.execute(Role.__table__.insert(), role_rows)
+    session.execute(
+        User.__table__.insert(),
+        [{"id": i, "username": "user-%d" % i} for i in user_ids],
+    )
+    if args.groups:
+        session.execute(
+            Group.__table__.insert(), [{"id": i} for i in group_ids]
+        )
+        session.execute(
+            GroupRole.__table__.insert(), grants("group_id", group_ids)
+        )
+        session.execute(
+            UserGroup.__table__.insert(),
+            [
+                {"user_id": i, "group_id": rng.choice(group_ids)}
+                for i in user_ids
+            ],
+        )
+    session.execute(UserRole.__table__.insert(), grants("user_id", user_ids))
+    session.commit()
+    return len(role_rows)
+
+
+def measure(name, operation, repeat, setup=None):
+    """Run ``operation`` ``repeat`` times and return the result row."""
+    statements = []
+
+    def count(*args):
+        statements.append(args[2])
+
+    sa.event.listen(db.engine, "before_cursor_execute", count)
+    elapsed = 0.0
+    tracemalloc.start()
+    try:
+        for i in range(repeat):
+            if setup is not None:
+                setup(i)
+            start = time.perf_counter()
+            operation(i)
+            elapsed += time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        sa.event.remove(db.engine, "before_cursor_execute", count)
+    return {
+        "operation": name,
+        "us_per_op": elapsed / repeat * 1e6,
+        "queries_per_op": len(statements) / repeat,
+        "peak_kib": peak / 1024.0,
+    }
+
+
+def run(args):
+    app, roles = create_app(args)
+    results = []
+    with app.app_context():
+        db.create_all()
+        role_count = populate(args)
+        users = db.session.query(User).order_by(User.id).all()
+        root = db.session.query(Role).get(1)
+        view = Permission(RoleNeed("role-0"))
+
+        def fresh(i):
+            # Cold ORM state and role cache for every operation
+            db.session.expire_all()
+            roles.cache.clear()
+
+        def get_children(i):
+            list(root.get_children())
+
+        def get_role_names(i):
+            list(users[i % len(users)].get_role_names())
+
+        def identity(i):
+            user = users[i % len(users)]
+            with app.test_request_context():
+                login_user(user)
+                identity = Identity(user.id)
+                identity_loaded.send(app, identity=identity)
+                view.allows(identity)
+
+        results.append(
+            measure("get_children", get_children, args.repeat, fresh)
+        )
+        results.append(
+            measure("get_role_names", get_role_names, args.repeat, fresh)
+        )
+        results.append(measure("identity", identity, args.repeat, fresh))
+
+    with app.test_client() as client:
+        with client.session_transaction() as session:
+            session["_user_id"] = "1"
+            session["_fresh"] = True
+        client.get("/protected")
+
+        def request(i):
+            client.get("/protected")
+
+        results.append(measure("request", request, args.repeat))
+
+    for row in results:
+        row.update(
+            roles=role_count,
+            depth=args.depth,
+            fanout=args.fanout,
+            users=args.users,
+            graph=args.graph,
+        )
+    return results
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = run(args)
+    if args.json:
+        for row in results:
+            print(json.dumps(row, sort_keys=True))
+        return
+    print(
+        "%d roles (depth %d, fanout %d), %d users, %d groups%s"
+        % (
+            results[0]["roles"],
+            args.depth,
+            args.fanout,
+            args.users,
+            args.groups,
+            ", ROLES_GRAPH" if args.graph else "",
+        )
+    )
+    print(
+        "%-16s %12s %10s %10s" % ("operation", "us/op", "queries", "peak KiB")
+    )
+    for row in results:
+        print(
+            "%-16s %12.1f %10.1f %10.1f"
+            % (
+                row["operation"],
+                row["us_per_op"],
+                row["queries_per_op"],
+                row["peak_kib"],
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+    Models shared by the benchmarks, mirroring those in the test suite.
+"""
+import flask_roles
+from flask_login import UserMixin
+from flask_sqlalchemy import SQLAlchemy
+
+db = SQLAlchemy()
+
+
+class Role(db.Model, flask_roles.RoleMixin):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(80), unique=True, nullable=False)
+    parent_id = db.Column(db.Integer, db.ForeignKey("role.id"))
+    children = db.relationship(
+        "Role",
+        backref=db.backref("parent", remote_side=[id]),
+    )
+
+
+class User(db.Model, UserMixin, flask_roles.UserMixin):
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(80), unique=True)
+    roles = db.relationship("Role", secondary="user_role")
+    groups = db.relationship("Group", secondary="user_group")
+
+
+class UserRole(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    role_id = db.Column(db.Integer, db.ForeignKey("role.id"), primary_key=True)
+
+
+class Group(db.Model, flask_roles.GroupMixin):
+    id = db.Column(db.Integer, primary_key=True)
+    roles = db.relationship("Role", secondary="group_role")
+
+
+class GroupRole(db.Model):
+    group_id = db.Column(
+        db.Integer, db.ForeignKey("group.id"), primary_key=True
+    )
+    role_id = db.Column(db.Integer, db.ForeignKey("role.id"), primary_key=True)
+
+
+class UserGroup(db.Model):
+    group_id = db.Column(
+        db.Integer, db.ForeignKey("group.id"), primary_key=True
+    )
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the per-request cost of protecting a view with a Flask-Principal
+``Permission(RoleNeed(...)).require(403)`` against
+``Roles.require_any``.
+
+Run from the repository root::
+
+    python -m benchmarks.require_roles [requests]
+
+Each path gets its own app, hit by the same logged in user whose roles
+come from a warm role cache, so the difference is the Identity,
+identity_loaded and Need set machinery that Flask-Principal adds to every
+request.
+"""
+
+import sys
+import timeit
+
+import flask_roles
+from flask import Flask, Response, current_app, request
+from flask_login import LoginManager, login_required, login_user
+from flask_principal import (
+    Identity,
+    Permission,
+    Principal,
+    RoleNeed,
+    identity_changed,
+)
+
+from benchmarks.models import Role, User, db
+
+
+def create_app(use_principal):
+    app = Flask(__name__)
+    app.config["SECRET_KEY"] = "benchmark"
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["ROLES_IDENTITY_LOADED"] = use_principal
+
+    db.init_app(app)
+    login_manager = LoginManager(app)
+    login_manager.user_loader(lambda id: db.session.query(User).get(int(id)))
+    roles = flask_roles.Roles(app, user_model=User)
+    if use_principal:
+        Principal(app)
+        require = Permission(RoleNeed("protected.view")).require(403)
+    else:
+        require = roles.require_any("protected.view")
+
+    @app.route("/login", methods=["post"])
+    def login():
+        user = User.query.filter_by(username=request.form["username"]).one()
+        login_user(user)
+        if use_principal:
+            identity_changed.send(
+                current_app._get_current_object(), identity=Identity(user.id)
+            )
+        return Response("ok")
+
+    @app.route("/protected")
+    @login_required
+    @require
+    def protected_view():
+        return Response("ok")
+
+    with app.app_context():
+        db.create_all()
+        admin = Role(name="admin")
+        protected = Role(name="protected", parent=admin)
+        Role(name="protected.view", parent=protected)
+        db.session.add(User(username="admin", roles=[admin]))
+        db.session.commit()
+    return app
+
+
+def measure(use_principal, requests):
+    app = create_app(use_principal)
+    with app.test_client() as client:
+        client.post("/login", data={"username": "admin"})
+        # Warm the role cache and check the route allows the user
+        assert client.get("/protected").status_code == 200
+        seconds = min(
+            timeit.repeat(
+                lambda: client.get("/protected"), number=requests, repeat=3
+            )
+        )
+    return seconds / requests * 1e6
+
+
+def main(requests=2000):
+    principal = measure(True, requests)
+    roles = measure(False, requests)
+    print("%-20s %8.1f us/request" % ("Permission.require", principal))
+    print("%-20s %8.1f us/request" % ("Roles.require_any", roles))
+    print("%-20s %8.1f us/request" % ("saved", principal - roles))
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -3,31 +3,15 @@ from example.extensions import roles, db, principal, login_manager
 from example import models
 import werkzeug
 from flask import Flask, Response, current_app, request
-from flask_login import current_user, login_required, login_user
+from flask_login import login_required, login_user
 from flask_principal import (
     Identity,
     Permission,
     RoleNeed,
     identity_changed,
-    identity_loaded,
 )
 
 
-@identity_loaded.connect
-def on_identity_loaded(sender, identity):
-    # Set the identity user object
-    identity.user = current_user
-
-    # Add any roles for the user
-    for role_name in current_user.get_role_names():
-        identity.provides.add(RoleNeed(role_name))
-
-    # Add any roles for the user via group member_ship
-    for group in current_user.groups:
-        for role_name in group.get_role_names():
-            identity.provides.add(RoleNeed(role_name))
-
-
 @login_manager.unauthorized_handler
 def unauthorized():
     return (
@@ -46,7 +30,7 @@ def init_extensions(app):
     principal.init_app(app)
     login_manager.init_app(app)
     db.init_app(app)
-    roles.init_app(app)
+    roles.init_app(app, user_model=models.User)
 
 
 def init_resources(app):
@@ -90,6 +74,8 @@ def create_app():
     app.config["SECRET_KEY"] = "deterministic"
     app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///:memory:"
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    # Let flask_roles fill identity.provides with the user's roles
+    app.config["ROLES_IDENTITY_LOADED"] = True
 
     @app.errorhandler(werkzeug.exceptions.Forbidden)
     def handle_bad_request(e):
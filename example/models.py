@@ -11,8 +11,6 @@ class Role(db.Model, flask_roles.RoleMixin):
     parent_id = db.Column(db.Integer, db.ForeignKey("role.id"))
     children = db.relationship(
         "Role",
-        lazy="joined",
-        join_depth=2,
         order_by=id,
         backref=db.backref("parent", remote_side=[id]),
     )
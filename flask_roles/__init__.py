@@ -5,11 +5,122 @@
 
     Adds Roles support to a flask project
 """
+import base64
+import functools
+import itertools
+import logging
+import time
+import uuid
+import zlib
+from functools import wraps
 
+import sqlalchemy as sa
+from flask import (
+    _request_ctx_stack,
+    abort,
+    current_app,
+    g,
+    has_request_context,
+    request,
+)
+from flask import session as cookie_session
+from sqlalchemy.orm import object_session
+from werkzeug.local import LocalProxy
 
-from .model import GroupMixin, RoleMixin, UserMixin
+from .aio import AsyncRoles
+from .batch import iter_role_names, scoped_role_names
+from .bits import RoleIndex
+from .cache import BaseCache, LRUCache, SharedCache
+from .closure import GroupClosure, RoleClosure
+from .endpoints import (
+    Requirement,
+    allows,
+    compile_endpoints,
+    denied,
+    mark,
+    requirements,
+)
+from .generation import RoleGeneration
+from .grants import ExpiringRoles, utcnow
+from .graph import RoleGraph
+from .invalidation import (
+    ALL,
+    HIERARCHY,
+    Scoped,
+    Watcher,
+    bump,
+    uncommitted,
+    watch,
+)
+from .model import (
+    GroupMixin,
+    RoleMixin,
+    UserMixin,
+    ancestor_ids,
+    descendant_ids,
+    walk_roles,
+)
+from .policy import Policy
+from .provides import LazyProvides
+from .schema import Schema, direct_role_ids, hierarchy_columns, role_holder_ids
+from .scope import ScopedRoles
+from .signals import (
+    role_cache_evicted,
+    role_cache_hit,
+    role_cache_miss,
+    roles_resolved,
+)
+from .stats import RoleStats
 
-__all__ = ["Roles", "RoleMixin", "UserMixin", "GroupMixin"]
+try:
+    from flask_login import current_user
+except ImportError:  # pragma: no cover
+    current_user = None
+
+try:
+    from flask_principal import RoleNeed, identity_loaded
+except ImportError:  # pragma: no cover
+    RoleNeed = identity_loaded = None
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    "Roles",
+    "RoleMixin",
+    "UserMixin",
+    "GroupMixin",
+    "RoleClosure",
+    "GroupClosure",
+    "RoleGeneration",
+    "BaseCache",
+    "LRUCache",
+    "SharedCache",
+    "RoleIndex",
+    "RoleGraph",
+    "RoleStats",
+    "AsyncRoles",
+    "Policy",
+    "ScopedRoles",
+    "ExpiringRoles",
+]
+
+
+def _forget_versions():
+    """Make the current request read the :class:`RoleGeneration` again."""
+    ctx = _request_ctx_stack.top
+    if ctx is not None:
+        ctx._roles_versions = None
+
+
+def _pack_names(names):
+    # Sorted dotted names share long prefixes, which deflate well
+    data = "\n".join(sorted(names)).encode("utf-8")
+    return base64.urlsafe_b64encode(zlib.compress(data, 9)).decode("ascii")
+
+
+def _unpack_names(packed):
+    data = zlib.decompress(base64.urlsafe_b64decode(packed.encode("ascii")))
+    return data.decode("utf-8").split("\n") if data else []
 
 
 class Roles(object):
@@ -27,20 +138,886 @@ class Roles(object):
             roles.init_app(app)
             return app
 
+    The effective role names of each user are cached by user id. Entries are
+    dropped whenever the user_role, user_group or group_role association
+    tables are written to, or the role hierarchy changes. The cache is
+    configured with:
+
+    ``ROLES_CACHE_SIZE``
+        Maximum number of users kept (default ``10000``)
+    ``ROLES_CACHE_TTL``
+        Seconds before an entry is re-resolved regardless (default ``300``)
+    ``ROLES_IDENTITY_LOADED``
+        Register :meth:`on_identity_loaded` with Flask-Principal (default
+        ``False``)
+    ``ROLES_GRAPH``
+        Resolve roles against an in-memory :class:`RoleGraph` snapshot of
+        the hierarchy instead of the database (default ``False``)
+    ``ROLES_GRAPH_FILE``
+        With ``ROLES_GRAPH`` and a :class:`RoleGeneration`, a path where
+        the snapshot is written whenever the hierarchy version changes and
+        memory mapped from by every worker (default ``None``)
+    ``ROLES_ENDPOINT_INDEX``
+        Check :meth:`require_any` and :meth:`require_all` requirements in
+        one ``before_request`` hook against :attr:`endpoints` (default
+        ``False``)
+    ``ROLES_SESSION_CLAIMS``
+        Keep the logged in user's effective role names, stamped with the
+        :class:`RoleGeneration`, in the signed Flask session so that
+        :meth:`current_role_mask` loads neither the user nor their roles.
+        Needs ``generation`` and ``session`` (default ``False``)
+    ``ROLES_SESSION_CLAIMS_SIZE``
+        Largest claim, in bytes of compressed role names, kept in the
+        session; users holding more roles are resolved per request instead,
+        as cookies are limited to about 4 KB (default ``2048``)
+    ``ROLES_STATS``
+        Count the time, roles, SQL statements and cache hits spent on role
+        resolution in :attr:`stats` and send the blinker signals of
+        :mod:`flask_roles.signals` (default ``False``)
+
+    Those settings configure the default in-process :class:`LRUCache`.
+    Workers can share role sets through a :class:`SharedCache` instead. With
+    a :class:`RoleGeneration`, cache keys carry the database generation
+    counter, which is read once per request, so that changes made by one
+    worker are seen by all of them.
+
     :param app: the Flask object
+    :param user_model: the mapped user class. If omitted, it is discovered
+        from the first user whose roles are resolved. Required with a
+        ``generation``, which must be bumped by writes made before that.
+    :param cache: a :class:`BaseCache` to use instead of the default
+    :param generation: a :class:`RoleGeneration` shared by all workers
+    :param session: a session (e.g. ``db.session``) to read the
+        :class:`RoleGeneration` with when no user object is at hand, or the
+        user is detached
+
+    Role names are interned by a :class:`RoleIndex`, and each user's roles
+    are kept as an int bitmask, so checks like :meth:`has_any_role` are a
+    single bitwise AND.
     """
 
-    def __init__(self, app=None):
+    def __init__(
+        self,
+        app=None,
+        user_model=None,
+        cache=None,
+        generation=None,
+        session=None,
+    ):
         """Initialize with app."""
+        self.user_model = None
+        self.schema = None
+        self.cache = cache
+        self.generation = generation
+        self.session = session
+        self.index = RoleIndex()
+        self.use_graph = False
+        self.graph = None
+        self.graph_file = None
+        self.endpoints = None
+        self.session_claims = False
+        self.claim_size = 2048
+        self.stats = None
+        self.aio = AsyncRoles(self)
+        self._scope_epochs = {}
+        self._scope_loader = None
+        self._watcher = None
         if app is not None:
             self.app = app
-            self.init_app(app)
+            self.init_app(app, user_model)
         else:
             self.app = None
+            if user_model is not None:
+                self._bind(user_model)
 
-    def init_app(self, app):
+    def init_app(self, app, user_model=None):
         """Initialize application in Flask-Roles. Adds (Role, app) to flask
         extensions.
 
         :param app: Flask object
+        :param user_model: the mapped user class
+        """
+        app.config.setdefault("ROLES_CACHE_SIZE", 10000)
+        app.config.setdefault("ROLES_CACHE_TTL", 300)
+        app.config.setdefault("ROLES_IDENTITY_LOADED", False)
+        app.config.setdefault("ROLES_GRAPH", False)
+        app.config.setdefault("ROLES_GRAPH_FILE", None)
+        app.config.setdefault("ROLES_ENDPOINT_INDEX", False)
+        app.config.setdefault("ROLES_SESSION_CLAIMS", False)
+        app.config.setdefault("ROLES_SESSION_CLAIMS_SIZE", 2048)
+        self.session_claims = app.config["ROLES_SESSION_CLAIMS"]
+        self.claim_size = app.config["ROLES_SESSION_CLAIMS_SIZE"]
+        if self.session_claims and (
+            self.generation is None or self.session is None
+        ):
+            # Nothing else would tell a claim that another worker, or
+            # another connection, changed the user's roles
+            raise ValueError(
+                "ROLES_SESSION_CLAIMS needs a RoleGeneration and a session"
+            )
+        if self.generation is not None and (
+            user_model is None and self.user_model is None
+        ):
+            # Writes are only watched, and the generation bumped, once the
+            # model is bound; other workers would miss those made before
+            raise ValueError("A RoleGeneration needs the user_model")
+        app.config.setdefault("ROLES_STATS", False)
+        self.use_graph = app.config["ROLES_GRAPH"]
+        self.graph_file = app.config["ROLES_GRAPH_FILE"]
+        if self.cache is None:
+            self.cache = LRUCache(
+                maxsize=app.config["ROLES_CACHE_SIZE"],
+                ttl=app.config["ROLES_CACHE_TTL"],
+            )
+        if app.config["ROLES_STATS"]:
+            self.stats = RoleStats()
+            cache = self.cache
+            if isinstance(cache, LRUCache) and cache.on_evict is None:
+                cache.on_evict = self._evicted
+        if user_model is not None:
+            self._bind(user_model)
+        if app.config["ROLES_IDENTITY_LOADED"]:
+            identity_loaded.connect(self.on_identity_loaded, sender=app)
+        if app.config["ROLES_ENDPOINT_INDEX"]:
+            app.before_request(self._authorize_endpoint)
+        app.extensions["roles"] = self
+
+    def on_identity_loaded(self, sender, identity):
+        """Flask-Principal ``identity_loaded`` handler, registered by
+        :meth:`init_app` when ``ROLES_IDENTITY_LOADED`` is set. Attaches
+        ``current_user`` to the identity and provides a ``RoleNeed`` for
+        each of the user's effective roles, including those granted through
+        groups, from the cache or one query.
+
+        The roles are only resolved when a permission check first reads
+        ``identity.provides`` (a :class:`~flask_roles.provides.LazyProvides`),
+        so public and login-only views never touch the role tables.
+        Anonymous users keep the plain, empty set.
+        """
+        user = current_user._get_current_object()
+        identity.user = user
+        if not hasattr(user, "get_role_names"):
+            return
+
+        def load():
+            return [RoleNeed(name) for name in self.get_role_names(user)]
+
+        identity.provides = LazyProvides(load, identity.provides)
+
+    def _bind(self, user_model):
+        if self.user_model is user_model:
+            return
+        self.user_model = user_model
+        self.schema = Schema(user_model)
+        self._watcher = Watcher(
+            self.schema, self._invalidate, self.generation
+        )
+        watch(self._watcher)
+
+    def _invalidate(self, user_ids):
+        _forget_versions()
+        if user_ids is HIERARCHY:
+            # Readers keep whichever snapshot they already hold
+            self.graph = None
+        if isinstance(user_ids, Scoped):
+            if ALL in user_ids:
+                self.invalidate_scopes()
+                return
+            for scope, scope_user_ids in user_ids.items():
+                self.invalidate_scope(
+                    scope, None if scope_user_ids is ALL else scope_user_ids
+                )
+            return
+        self._drop(None if user_ids in (ALL, HIERARCHY) else user_ids)
+
+    def _versions(self, session):
+        # (generation, hierarchy) read once per request. Not per app
+        # context, which CLI commands and task workers keep open for long.
+        if self.generation is None:
+            return (None, None)
+        if session is None:
+            raise ValueError("Pass a session to read the RoleGeneration with")
+        ctx = _request_ctx_stack.top
+        if ctx is None:
+            return self.generation.versions(session)
+        versions = getattr(ctx, "_roles_versions", None)
+        if versions is None:
+            versions = self.generation.versions(session)
+            if not self._uncommitted(session):
+                ctx._roles_versions = versions
+        return versions
+
+    def _uncommitted(self, session):
+        # Role sets, graphs and claims read in a transaction that bumped
+        # the generation are used but never kept: should it roll back, the
+        # next commit reuses the generation they would be keyed under
+        if self.generation is None or session is None:
+            return False
+        return uncommitted(session.connection())
+
+    def _cache_key(self, user, user_id):
+        if self.generation is None:
+            return user_id
+        return (self._versions(self._session_of(user))[0], user_id)
+
+    def _session_of(self, user):
+        # Detached users, e.g. kept from an earlier request, have none
+        session = object_session(user)
+        return self.session if session is None else session
+
+    def _scope_epoch(self, scope):
+        # Kept next to the entries in a shared cache, so that every worker
+        # moves on when one of them drops a whole scope. ALL stands for
+        # the epoch of every scope.
+        if self.cache.process_local:
+            return self._scope_epochs.get(scope, 0)
+        if scope is ALL:
+            return self.cache.get(("scope", "epoch"), 0)
+        return self.cache.get(("scope", scope, "epoch"), 0)
+
+    def _scope_key(self, scope, user_id):
+        return (
+            "scope",
+            self._scope_epoch(ALL),
+            scope,
+            self._scope_epoch(scope),
+            user_id,
+        )
+
+    def _next_scope_epoch(self, scope):
+        if self.cache.process_local:
+            self._scope_epochs[scope] = self._scope_epochs.get(scope, 0) + 1
+            return
+        # Unique rather than counted, so that an epoch which aged out of
+        # the cache can never bring old entries back
+        key = ("scope", "epoch") if scope is ALL else ("scope", scope, "epoch")
+        self.cache.set(key, uuid.uuid4().hex)
+
+    def get_graph(self, session):
+        """Return the current :class:`RoleGraph`, building and swapping in a
+        new snapshot if the hierarchy changed since the last one was built.
+        With a :class:`RoleGeneration` this also notices changes made by
+        other workers.
+
+        :param session: session used to load the role table if needed
+        """
+        if self._uncommitted(session):
+            # Neither swapped in nor written to ROLES_GRAPH_FILE
+            return RoleGraph.load(session, self.schema, self.index)
+        graph = self.graph
+        version = self._versions(session)[1]
+        if graph is None or graph.version != version:
+            graph = self._load_graph(session, version)
+            self.graph = graph
+        return graph
+
+    def _load_graph(self, session, version, role_ids=()):
+        # A snapshot of ``version`` which knows ``role_ids``
+        path = self.graph_file
+        if path is None or version is None:
+            return RoleGraph.load(session, self.schema, self.index, version)
+        try:
+            mapped = RoleGraph.open(path, self.index)
+        except (OSError, ValueError):
+            mapped = None
+        if (
+            mapped is not None
+            and mapped.version == version
+            and all(role_id in mapped for role_id in role_ids)
+        ):
+            return mapped
+        graph = RoleGraph.load(session, self.schema, self.index, version)
+        # Never replace a snapshot another worker built from newer data
+        if mapped is None or (mapped.version or 0) <= version:
+            try:
+                graph.dump(path)
+            except OSError:
+                # Sharing is an optimisation, this worker's copy still works
+                logger.warning(
+                    "Could not write the role graph to %s", path, exc_info=True
+                )
+        return graph
+
+    def invalidate(self, user_ids=None, session=None):
+        """Drop cached role sets from this worker's cache. With a
+        :class:`RoleGeneration`, bump it instead to reach every worker: the
+        bump is part of the transaction of ``session``, and takes effect
+        once that commits.
+
+        :param user_ids: iterable of user ids, or ``None`` to drop all
+        :param session: session to bump the generation with, defaults to
+            the extension's ``session``
+        """
+        if self.generation is None:
+            self._drop(user_ids)
+            return
+        session = session or self.session
+        if session is None:
+            raise ValueError("Pass a session to bump the generation with")
+        # Cache keys carry the generation, and a shared cache cannot
+        # be cleared, so every entry has to move on
+        bump(session.connection(), self.generation)
+        _forget_versions()
+
+    def _drop(self, user_ids):
+        if self.cache is None:
+            return
+        if user_ids is None:
+            self.cache.clear()
+            return
+        for user_id in user_ids:
+            self.cache.delete(user_id)
+
+    def invalidate_scope(self, scope, user_ids=None):
+        """Drop the role sets cached for ``scope``, by users or for the
+        whole scope at once. Entries of other scopes, and users' unscoped
+        roles, are kept.
+
+        Dropping a whole scope moves it on to fresh cache keys, so the old
+        entries are never read again and age out of the cache.
+
+        :param scope: the scope id
+        :param user_ids: iterable of user ids, or ``None`` to drop all
+        """
+        if self.cache is None:
+            return
+        if user_ids is None:
+            self._next_scope_epoch(scope)
+            return
+        for user_id in user_ids:
+            self.cache.delete(self._scope_key(scope, user_id))
+
+    def invalidate_scopes(self):
+        """Drop the role sets cached for every scope, moving them all on to
+        fresh cache keys at once. Users' unscoped roles are kept. Writes to
+        the :class:`ScopedRoles` table that do not name their scopes do
+        this.
+        """
+        if self.cache is not None:
+            self._next_scope_epoch(ALL)
+
+    def resolve_role_names(self, user):
+        """Compute the effective role names of ``user``, bypassing the cache.
+        Roles granted through groups and inherited from parent roles are
+        included.
+        """
+        role_model = self.schema.role_model
+        closure = getattr(role_model, "__role_closure__", None)
+        if closure is not None:
+            return frozenset(closure.get_role_names(user))
+
+        session = object_session(user)
+        identity = sa.inspect(user).identity
+        if session is None or identity is None:
+            names = set(user.get_role_names())
+            for group in getattr(user, "groups", ()):
+                names.update(group.get_role_names())
+            return frozenset(names)
+
+        direct_ids = direct_role_ids(type(user), identity)
+        if hierarchy_columns(role_model) is not None:
+            # Direct, group and inherited roles in one recursive query
+            rows = session.query(self.schema.role_name).filter(
+                self.schema.role_id.in_(descendant_ids(role_model, direct_ids))
+            )
+            return frozenset(row[0] for row in rows)
+
+        # Direct and group roles in one query instead of a lazy load of
+        # user.roles, user.groups and every group's roles
+        direct = session.query(role_model).filter(
+            getattr(role_model, self.schema.role_id.key).in_(direct_ids)
+        )
+        return frozenset(role.name for role in walk_roles(direct))
+
+    def resolve_role_mask(self, user):
+        """Compute the effective roles of ``user`` as a bitmask, bypassing
+        the cache. With ``ROLES_GRAPH`` only the ids of the directly held
+        roles are queried, the rest comes from the :class:`RoleGraph`.
+        """
+        session = object_session(user)
+        identity = sa.inspect(user).identity
+        if self.use_graph and session is not None and identity is not None:
+            role_ids = [
+                row[0]
+                for row in session.execute(
+                    direct_role_ids(type(user), identity)
+                )
+            ]
+            graph = self.get_graph(session)
+            if any(role_id not in graph for role_id in role_ids):
+                # Roles created without a parent leave the hierarchy
+                # version alone, so a snapshot may predate them
+                graph = self._load_graph(session, graph.version, role_ids)
+                self.graph = graph
+            return graph.effective_mask(role_ids)
+        return self.index.mask(self.resolve_role_names(user))
+
+    def iter_role_names(self, users, session=None, chunk_size=1000):
+        """Resolve the effective role names of many users with a fixed number
+        of queries per ``chunk_size`` users, yielding ``(user_id,
+        frozenset)`` pairs as each chunk completes, so memory stays flat::
+
+            for user_id, names in roles.iter_role_names(user_ids, db.session):
+                ...
+
+            by_id = dict(roles.iter_role_names(users))
+
+        The cache is neither consulted nor filled.
+
+        :param users: iterable of users or user ids
+        :param session: session to query with, defaults to the session of
+            the first user object
+        :param chunk_size: number of users resolved per query
+        """
+        users = iter(users)
+        first = next(users, None)
+        if first is None:
+            return iter(())
+        if hasattr(first, "get_role_names"):
+            if self.user_model is None:
+                self._bind(type(first))
+            if session is None:
+                session = object_session(first)
+        if self.schema is None or session is None:
+            raise ValueError(
+                "Pass a session and set user_model to resolve user ids"
+            )
+
+        def ids():
+            for user in itertools.chain([first], users):
+                if hasattr(user, "get_role_names"):
+                    yield sa.inspect(user).identity[0]
+                else:
+                    yield user
+
+        return iter_role_names(session, self.schema, ids(), chunk_size)
+
+    def holders(self, session, role_name, model=None):
+        """Query the users (or rows of ``model``, e.g. the group model) that
+        effectively hold ``role_name``: those assigned the role or one of
+        its ancestors, directly or through their groups. Everything is
+        resolved in the database, so the query can be paged, counted or
+        streamed with ``yield_per`` for roles held by very many users::
+
+            for user in roles.holders(db.session, "billing.read").yield_per(
+                1000
+            ):
+                ...
+
+        :param session: session to query with
+        :param role_name: the role to look up
+        :param model: mapped class using :class:`UserMixin` or
+            :class:`GroupMixin`, defaults to the user model
+        """
+        if self.schema is None:
+            raise ValueError("Set user_model to look up role holders")
+        schema = self.schema
+        model = model or schema.user_model
+        seed = sa.select([schema.role_id]).where(
+            schema.role_name == role_name
+        )
+        closure = getattr(schema.role_model, "__role_closure__", None)
+        if closure is not None:
+            role_ids = closure.ancestor_ids(seed)
+        else:
+            role_ids = ancestor_ids(schema.role_model, seed)
+        holder_id = sa.inspect(model).primary_key[0]
+        return (
+            session.query(model)
+            .filter(holder_id.in_(role_holder_ids(model, role_ids)))
+            .order_by(holder_id)
+        )
+
+    def get_role_mask(self, user, scope=None):
+        """Return the effective roles of ``user`` as a bitmask over
+        :attr:`index`, from the cache when possible. Anonymous users hold no
+        roles. With ``scope``, the roles assigned to ``user`` within it
+        through :class:`ScopedRoles` are included.
+        """
+        if isinstance(user, LocalProxy):
+            user = user._get_current_object()
+        if not hasattr(user, "get_role_names"):
+            return 0
+        mask = self._role_mask(user)
+        if scope is not None:
+            mask |= self.get_scoped_role_mask(user, scope)
+        return mask
+
+    def _role_mask(self, user):
+        if self.user_model is None:
+            self._bind(type(user))
+
+        identity = sa.inspect(user).identity
+        if (
+            self.cache is None
+            or identity is None
+            or not isinstance(user, self.user_model)
+        ):
+            return self._resolve(user, identity and identity[0])
+        if self._uncommitted(self._session_of(user)):
+            return self._resolve(user, identity[0])
+
+        key = self._cache_key(user, identity[0])
+        value = self.cache.get(key)
+        if self.stats is not None:
+            self._lookup(identity[0], value is not None)
+        if value is None:
+            # Read first: a grant lapsing meanwhile only shortens the entry
+            ttl = self._grant_ttl(user, identity[0])
+            mask = self._resolve(user, identity[0])
+            self._cache_set(key, mask, ttl)
+        elif self.cache.process_local:
+            mask = value
+        else:
+            mask = self.index.mask(value)
+        return mask
+
+    def _grant_ttl(self, user, user_id):
+        # Seconds until the earliest of the user's grants expires, if any
+        grants = self.schema.grants
+        session = object_session(user)
+        if grants is None or session is None:
+            return None
+        now = utcnow()
+        row = session.execute(grants.next_expiry([user_id], now)).first()
+        return None if row is None else (row[1] - now).total_seconds()
+
+    def _cache_set(self, key, mask, ttl=None):
+        # Bit positions are private to this process
+        value = mask if self.cache.process_local else self.index.names(mask)
+        if ttl is None:
+            self.cache.set(key, value)
+        else:
+            self.cache.set(key, value, ttl)
+
+    def get_scoped_role_mask(self, user, scope):
+        """Return the roles assigned to ``user`` within ``scope``, and their
+        descendants, as a bitmask, from the cache when possible. The cache
+        is keyed by user and scope, and :meth:`invalidate_scope` drops the
+        entries of one scope.
+        """
+        if isinstance(user, LocalProxy):
+            user = user._get_current_object()
+        if not hasattr(user, "get_role_names"):
+            return 0
+        if self.user_model is None:
+            self._bind(type(user))
+        if self.schema.scopes is None:
+            raise ValueError(
+                "%s has no ScopedRoles" % self.schema.user_model.__name__
+            )
+        identity = sa.inspect(user).identity
+        if identity is None:
+            # Scoped assignments need a persisted user
+            return 0
+        if self.cache is None or self._uncommitted(self._session_of(user)):
+            return self._resolve(user, identity[0], scope)
+
+        # Keyed without the generation, which scoped writes leave alone, so
+        # that one scope can be dropped without the others. The entry
+        # carries the hierarchy version its descendants were read at.
+        key = self._scope_key(scope, identity[0])
+        hierarchy = self._versions(self._session_of(user))[1]
+        value = self.cache.get(key)
+        if value is not None and value[0] != hierarchy:
+            value = None
+        if self.stats is not None:
+            self._lookup(identity[0], value is not None)
+        if value is None:
+            mask = self._resolve(user, identity[0], scope)
+            if self.cache.process_local:
+                self.cache.set(key, (hierarchy, mask))
+            else:
+                self.cache.set(key, (hierarchy, self.index.names(mask)))
+        elif self.cache.process_local:
+            mask = value[1]
+        else:
+            mask = self.index.mask(value[1])
+        return mask
+
+    def resolve_scoped_role_mask(self, user, scope):
+        """Compute the roles assigned to ``user`` within ``scope`` and their
+        descendants as a bitmask, bypassing the cache, with one query that
+        reads only that scope's assignments.
+        """
+        rows = self._session_of(user).execute(
+            scoped_role_names(
+                self.schema, [sa.inspect(user).identity[0]], scope
+            )
+        )
+        return self.index.mask(name for _, name in rows)
+
+    def _resolve(self, user, user_id, scope=None):
+        stats = self.stats
+        if scope is not None:
+            resolve = functools.partial(
+                self.resolve_scoped_role_mask, user, scope
+            )
+        else:
+            resolve = functools.partial(self.resolve_role_mask, user)
+        if stats is None:
+            return resolve()
+        with stats.timing() as timing:
+            mask = resolve()
+        roles = bin(mask).count("1")
+        stats.add(
+            resolutions=1,
+            resolve_seconds=timing["seconds"],
+            roles_traversed=roles,
+            statements=timing["statements"],
+        )
+        roles_resolved.send(
+            self,
+            user_id=user_id,
+            seconds=timing["seconds"],
+            roles=roles,
+            statements=timing["statements"],
+        )
+        return mask
+
+    def _lookup(self, user_id, hit):
+        if hit:
+            self.stats.add(cache_hits=1)
+            role_cache_hit.send(self, user_id=user_id)
+        else:
+            self.stats.add(cache_misses=1)
+            role_cache_miss.send(self, user_id=user_id)
+
+    def _evicted(self, key):
+        self.stats.add(cache_evictions=1)
+        role_cache_evicted.send(self, key=key)
+
+    def get_role_names(self, user, scope=None):
+        """Return the effective role names of ``user`` (within ``scope``) as
+        a frozenset.
+        """
+        return self.index.names(self.get_role_mask(user, scope))
+
+    def scope_loader(self, callback):
+        """Register the callback returning the scope of the current
+        request, e.g. the tenant id, or ``None`` outside any scope. Its
+        roles are added to ``current_user``'s in :meth:`current_role_mask`,
+        so :meth:`require_any`, :meth:`require_all`, :meth:`require` and the
+        endpoint index check the roles held within it::
+
+            @roles.scope_loader
+            def current_organisation():
+                return g.organisation.id
+        """
+        self._scope_loader = callback
+        return callback
+
+    def current_scope(self):
+        """Return the scope of the current request, see
+        :meth:`scope_loader`.
+        """
+        if self._scope_loader is None or not has_request_context():
+            return None
+        return self._scope_loader()
+
+    def current_role_mask(self):
+        """Return the effective roles of ``current_user``, within
+        :meth:`current_scope`, as a bitmask.
+
+        With ``ROLES_SESSION_CLAIMS`` the role names are kept, compressed,
+        in the signed session next to the id of the user they belong to and
+        a version stamp, and are only re-resolved once the stamp is out of
+        date, so neither the user nor the roles are loaded. Claims larger
+        than ``ROLES_SESSION_CLAIMS_SIZE`` are not kept. The stamp is the
+        :class:`RoleGeneration`, read with one small query per request
+        shared with the cache, so claims need a generation and a
+        ``session``. Scoped roles are not kept in the session. With
+        :class:`ExpiringRoles` the claim also lapses when the user's
+        earliest grant expires.
+        """
+        mask = self._current_role_mask()
+        scope = self.current_scope()
+        if scope is not None:
+            mask |= self.get_scoped_role_mask(current_user, scope)
+        return mask
+
+    def _current_role_mask(self):
+        if not (self.session_claims and has_request_context()):
+            return self.get_role_mask(current_user)
+        user_id = cookie_session.get("_user_id")
+        if user_id is None:
+            # Anonymous, or about to be logged in from a remember cookie
+            return self.get_role_mask(current_user)
+        if self._uncommitted(self.session):
+            # Not stamped with a generation that may yet be reused
+            return self.get_role_mask(current_user)
+
+        stamp = self._versions(self.session)[0]
+        claim = cookie_session.get("_roles")
+        if (
+            claim is not None
+            and claim[:2] == [user_id, stamp]
+            # Packed names; earlier claims held a list
+            and isinstance(claim[2], str)
+            # Expiry of the earliest grant, if there is one
+            and not (len(claim) > 3 and claim[3] <= time.time())
+        ):
+            return self.index.mask(_unpack_names(claim[2]))
+        mask = self.get_role_mask(current_user)
+        names = _pack_names(self.index.names(mask))
+        if len(names) > self.claim_size:
+            # Would push the cookie past what browsers keep
+            cookie_session.pop("_roles", None)
+            return mask
+        claim = [user_id, stamp, names]
+        if self.schema is not None and self.schema.grants is not None:
+            user = current_user._get_current_object()
+            ttl = self._grant_ttl(user, sa.inspect(user).identity[0])
+            if ttl is not None:
+                claim.append(time.time() + ttl)
+        cookie_session["_roles"] = claim
+        return mask
+
+    def matches(self, mask, names, match_all=False):
+        """Return whether the role ``mask`` holds any (or, with
+        ``match_all``, each) of ``names``. A name may be a wildcard such as
+        ``"billing.*"``, held when any role below ``billing`` is.
+        """
+        required, prefixes = self.index.compile(names)
+        return allows(mask, Requirement(required, match_all, None, prefixes))
+
+    def has_any_role(self, user, *names, scope=None):
+        """Return whether ``user`` effectively holds any of ``names`` (within
+        ``scope``), which may include wildcards like ``"billing.*"``.
+        """
+        return self.matches(self.get_role_mask(user, scope), names)
+
+    def has_all_roles(self, user, *names, scope=None):
+        """Return whether ``user`` effectively holds all of ``names`` (within
+        ``scope``). A wildcard like ``"billing.*"`` is held when any role
+        below ``billing`` is.
+        """
+        return self.matches(self.get_role_mask(user, scope), names, True)
+
+    def require_any(self, *role_names, http_exception=403):
+        """Decorate a view so that it aborts with ``http_exception`` unless
+        ``current_user`` effectively holds at least one of ``role_names``::
+
+            @app.route("/reports")
+            @roles.require_any("reports.view", "admin")
+            def reports():
+                ...
+
+        Unlike a Flask-Principal ``Permission``, no ``Identity`` or
+        ``RoleNeed`` is built: the required names are turned into a bitmask
+        once, when the view is decorated, and each request costs one AND
+        against the user's cached mask. Wildcards like ``"billing.*"`` are
+        resolved to a node of the :class:`RoleIndex` prefix trie up front
+        as well.
+        """
+        mask, prefixes = self.index.compile(role_names)
+        return self._require(
+            Requirement(mask, False, http_exception, prefixes)
+        )
+
+    def require_all(self, *role_names, http_exception=403):
+        """Like :meth:`require_any`, but ``current_user`` must effectively
+        hold every one of ``role_names``.
+        """
+        mask, prefixes = self.index.compile(role_names)
+        return self._require(
+            Requirement(mask, True, http_exception, prefixes)
+        )
+
+    def policy(self, expression):
+        """Compile a role policy such as ``"admin or (editor and not
+        suspended)"`` (or one built with :func:`~flask_roles.policy.any_of`,
+        :func:`~flask_roles.policy.all_of` and
+        :func:`~flask_roles.policy.not_`) into a
+        :class:`~flask_roles.policy.Policy` over :attr:`index`.
+        """
+        if isinstance(expression, Policy):
+            return expression
+        return Policy(expression, self.index)
+
+    def satisfies(self, user, policy, scope=None):
+        """Return whether the effective roles of ``user`` (within ``scope``)
+        satisfy ``policy``, a :class:`~flask_roles.policy.Policy` or
+        expression.
+        """
+        mask = self.get_role_mask(user, scope)
+        return self.policy(policy).allows(mask)
+
+    def require(self, policy, http_exception=403):
+        """Decorate a view so that it aborts with ``http_exception`` unless
+        ``current_user`` satisfies ``policy``. The policy is compiled when
+        the view is decorated::
+
+            @app.route("/articles/<id>/edit")
+            @roles.require("admin or (editor and not suspended)")
+            def edit_article(id):
+                ...
+        """
+        return self._require(
+            Requirement(0, False, http_exception, (), self.policy(policy))
+        )
+
+    def _require(self, requirement):
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                # Skip only the stack the endpoint index already checked,
+                # not views or helpers called from within it
+                checked = g.get("_roles_authorized", ())
+                own = requirements(wrapper)
+                if checked[-len(own):] != own:
+                    code = denied(self.current_role_mask(), (requirement,))
+                    if code is not None:
+                        abort(code)
+                return view(*args, **kwargs)
+
+            mark(wrapper, requirement)
+            return wrapper
+
+        return decorator
+
+    def compile_endpoints(self, app=None):
+        """Build :attr:`endpoints`, a dict from endpoint name to the
+        requirements of its view, by walking ``app.url_map``. Called on the
+        first request when ``ROLES_ENDPOINT_INDEX`` is set; call it again
+        after registering routes later on.
+
+        :param app: the Flask object, ``current_app`` if omitted
+        """
+        self.endpoints = compile_endpoints(app or current_app)
+        return self.endpoints
+
+    def _authorize_endpoint(self):
+        endpoints = self.endpoints
+        if endpoints is None:
+            endpoints = self.compile_endpoints()
+        found = endpoints.get(request.endpoint)
+        if found is None:
+            return
+        if cookie_session.get("_user_id") is None:
+            # Left to the view, whose login_required comes first. Read from
+            # the session: current_user would run the user_loader
+            return
+        code = denied(self.current_role_mask(), found)
+        if code is not None:
+            abort(code)
+        g._roles_authorized = found
+
+    def allowed_endpoints(self, mask, app=None):
+        """Return the sorted names of the endpoints of ``app`` that a holder
+        of the effective roles ``mask`` may reach, e.g.
+        ``roles.allowed_endpoints(roles.get_role_mask(user))``. Endpoints
+        without role requirements are included.
+
+        :param mask: effective role bitmask over :attr:`index`
+        :param app: the Flask object, ``current_app`` if omitted
         """
+        app = app or current_app
+        endpoints = self.endpoints
+        if endpoints is None:
+            endpoints = self.compile_endpoints(app)
+        return sorted(
+            endpoint
+            for endpoint in app.view_functions
+            if denied(mask, endpoints.get(endpoint, ())) is None
+        )
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_roles.aio
+    ~~~~~~~~~~~~~~~
+
+    Awaitable role resolution for async views and async sessions.
+"""
+import asyncio
+import threading
+import weakref
+
+import sqlalchemy as sa
+from flask import _request_ctx_stack
+
+from .batch import chunked, effective_role_names
+from .grants import utcnow
+
+
+class _LoopState(object):
+    # Checks in flight on one event loop: futures by cache key, users
+    # waiting for the next batch by session, and the generation being read
+    def __init__(self):
+        self.inflight = {}
+        self.pending = {}
+        self.generation = None
+
+
+class AsyncRoles(object):
+    """The role checks of a :class:`~flask_roles.Roles` extension as
+    coroutines, available as ``roles.aio``::
+
+        async def report(session):
+            if not await roles.aio.has_any_role(session, user, "reports"):
+                abort(403)
+
+    ``session`` is anything whose ``execute(statement)`` is a coroutine
+    returning iterable rows, such as SQLAlchemy's ``AsyncSession``. No ORM
+    collections are touched, so nothing lazy loads and blocks the loop:
+    effective roles come from one set based statement (recursive or
+    through the closure table).
+
+    Lookups for users who are not cached are gathered for one loop
+    iteration and resolved together, ``chunk_size`` users per statement.
+    While a user is being resolved, every other check for that user waits
+    on the same result instead of issuing its own query. Each event loop
+    batches its own checks, so threads running a loop each, like async
+    Flask views, do not share futures. The
+    :class:`~flask_roles.RoleGeneration`, if any, is read once per request,
+    or outside one, once for the checks made while it is being read. With
+    :class:`~flask_roles.ExpiringRoles`, one more statement per chunk reads
+    when each user's earliest grant expires, and their cache entries end
+    then.
+
+    :param roles: the :class:`~flask_roles.Roles` extension
+    :param chunk_size: maximum number of users resolved per statement
+    """
+
+    def __init__(self, roles, chunk_size=1000):
+        self.roles = roles
+        self.chunk_size = chunk_size
+        self._loops = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def _state(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            state = self._loops.get(loop)
+            if state is None:
+                state = self._loops[loop] = _LoopState()
+        return state
+
+    async def _cache_key(self, state, session, user_id):
+        generation = self.roles.generation
+        if generation is None:
+            return user_id
+        versions = await self._versions(state, session)
+        return (versions[0], user_id)
+
+    async def _versions(self, state, session):
+        ctx = _request_ctx_stack.top
+        if getattr(ctx, "_roles_versions", None) is not None:
+            return ctx._roles_versions
+        task = state.generation
+        if task is None:
+            task = state.generation = asyncio.get_running_loop().create_task(
+                self._read_versions(session)
+            )
+
+            def done(task):
+                state.generation = None
+
+            task.add_done_callback(done)
+        versions = await asyncio.shield(task)
+        if ctx is not None:
+            ctx._roles_versions = versions
+        return versions
+
+    async def _read_versions(self, session):
+        generation = self.roles.generation
+        row = (await session.execute(generation.select())).first()
+        return generation.parse(row)
+
+    async def resolve_role_names(self, session, user_ids):
+        """Return ``{user_id: frozenset of role names}`` for ``user_ids``,
+        bypassing the cache, with one statement per ``chunk_size`` users.
+        """
+        schema = self.roles.schema
+        resolved = {}
+        for chunk in chunked(user_ids, self.chunk_size):
+            names = {user_id: set() for user_id in chunk}
+            rows = await session.execute(effective_role_names(schema, chunk))
+            for user_id, name in rows:
+                names[user_id].add(name)
+            for user_id, found in names.items():
+                resolved[user_id] = frozenset(found)
+        return resolved
+
+    async def _grant_ttls(self, session, user_ids):
+        # {user_id: seconds until the earliest of their grants expires}
+        grants = self.roles.schema.grants
+        ttls = {}
+        if grants is None:
+            return ttls
+        now = utcnow()
+        for chunk in chunked(user_ids, self.chunk_size):
+            rows = await session.execute(grants.next_expiry(chunk, now))
+            for user_id, expires in rows:
+                ttls[user_id] = (expires - now).total_seconds()
+        return ttls
+
+    def _schedule(self, state, session, key, user_id):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        state.inflight[key] = future
+        pending = state.pending.get(session)
+        if pending is None:
+            pending = state.pending[session] = {}
+            # Runs after the checks already scheduled for this iteration,
+            # which join the batch
+            loop.create_task(self._flush(state, session))
+        pending[key] = user_id
+        return future
+
+    async def _flush(self, state, session):
+        pending = state.pending.pop(session)
+        user_ids = sorted(set(pending.values()))
+        try:
+            ttls = await self._grant_ttls(session, user_ids)
+            resolved = await self.resolve_role_names(session, user_ids)
+        except Exception as exc:
+            for key in pending:
+                state.inflight.pop(key).set_exception(exc)
+            return
+        roles = self.roles
+        for key, user_id in pending.items():
+            mask = roles.index.mask(resolved[user_id])
+            if roles.cache is not None:
+                roles._cache_set(key, mask, ttls.get(user_id))
+            state.inflight.pop(key).set_result(mask)
+
+    async def get_role_mask(self, session, user):
+        """Return the effective roles of ``user`` (a user object or primary
+        key) as a bitmask, from the cache when possible.
+        """
+        roles = self.roles
+        if hasattr(user, "get_role_names"):
+            if roles.user_model is None:
+                roles._bind(type(user))
+            identity = sa.inspect(user).identity
+            if identity is None:
+                return roles.resolve_role_mask(user)
+            user_id = identity[0]
+        elif user is None or getattr(user, "is_anonymous", False):
+            return 0
+        elif roles.schema is None:
+            raise ValueError("Set user_model to resolve user ids")
+        else:
+            user_id = user
+
+        state = self._state()
+        key = await self._cache_key(state, session, user_id)
+        if roles.cache is not None:
+            value = roles.cache.get(key)
+            if value is not None:
+                if roles.cache.process_local:
+                    return value
+                return roles.index.mask(value)
+
+        future = state.inflight.get(key)
+        if future is None:
+            future = self._schedule(state, session, key, user_id)
+        return await asyncio.shield(future)
+
+    async def get_role_names(self, session, user):
+        """Return the effective role names of ``user`` as a frozenset."""
+        mask = await self.get_role_mask(session, user)
+        return self.roles.index.names(mask)
+
+    async def has_any_role(self, session, user, *names):
+        """Return whether ``user`` effectively holds any of ``names``."""
+        mask = await self.get_role_mask(session, user)
+        return self.roles.matches(mask, names)
+
+    async def has_all_roles(self, session, user, *names):
+        """Return whether ``user`` effectively holds all of ``names``."""
+        mask = await self.get_role_mask(session, user)
+        return self.roles.matches(mask, names, True)
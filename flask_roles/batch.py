@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_roles.batch
+    ~~~~~~~~~~~~~~~~~
+
+    Effective role resolution for many users at once.
+"""
+from collections import defaultdict
+from itertools import islice
+
+import sqlalchemy as sa
+
+from .schema import direct_role_pairs, hierarchy_columns
+
+
+def chunked(iterable, size):
+    """Yield lists of up to ``size`` items from ``iterable``."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class _Hierarchy(object):
+    # The whole role tree as plain ids, loaded with one query, for databases
+    # without a closure table. Descendant sets are memoized per role.
+
+    def __init__(self, session, schema):
+        self.names = {}
+        self.children = defaultdict(list)
+        rows = session.execute(
+            sa.select(
+                [schema.role_id, schema.role_name, schema.role_parent]
+            )
+        )
+        for role_id, name, parent_id in rows:
+            self.names[role_id] = name
+            if parent_id is not None:
+                self.children[parent_id].append(role_id)
+        self._descendants = {}
+
+    def descendant_names(self, role_id):
+        names = self._descendants.get(role_id)
+        if names is None:
+            seen = set()
+            stack = [role_id]
+            while stack:
+                current = stack.pop()
+                if current in seen:
+                    continue
+                seen.add(current)
+                stack.extend(self.children.get(current, ()))
+            names = frozenset(self.names[i] for i in seen if i in self.names)
+            self._descendants[role_id] = names
+        return names
+
+
+def effective_role_names(schema, user_ids):
+    """Select ``(user_id, role name)`` for every role the users ``user_ids``
+    effectively hold, as one statement: through the
+    :class:`~flask_roles.RoleClosure` when there is one, otherwise with a
+    ``WITH RECURSIVE`` walk down the hierarchy.
+
+    :param schema: the :class:`~flask_roles.schema.Schema` of the user model
+    :param user_ids: user primary keys
+    """
+    pairs = direct_role_pairs(schema.user_model, user_ids).alias()
+    return _expand(schema, pairs)
+
+
+def scoped_role_names(schema, user_ids, scope_id):
+    """Like :func:`effective_role_names`, for the roles assigned to
+    ``user_ids`` within ``scope_id`` through the
+    :class:`~flask_roles.ScopedRoles` of the user model. Only that scope's
+    assignments are read.
+    """
+    pairs = schema.scopes.role_pairs(user_ids, scope_id).alias()
+    return _expand(schema, pairs)
+
+
+def _expand(schema, pairs):
+    # (holder_id, role name) for every role below the (holder_id, role_id)
+    # pairs
+    closure = getattr(schema.role_model, "__role_closure__", None)
+    if closure is not None:
+        c = closure.table.c
+        joined = pairs.join(
+            closure.table, c.ancestor_id == pairs.c.role_id
+        ).join(schema.role_table, schema.role_id == c.descendant_id)
+        return (
+            sa.select([pairs.c.holder_id, schema.role_name])
+            .select_from(joined)
+            .distinct()
+        )
+
+    role_id, parent = hierarchy_columns(schema.role_model)
+    tree = sa.select([pairs.c.holder_id, pairs.c.role_id]).cte(
+        "effective_roles", recursive=True
+    )
+    tree = tree.union(
+        sa.select([tree.c.holder_id, role_id]).where(
+            parent == tree.c.role_id
+        )
+    )
+    return (
+        sa.select([tree.c.holder_id, schema.role_name])
+        .select_from(
+            tree.join(schema.role_table, schema.role_id == tree.c.role_id)
+        )
+        .distinct()
+    )
+
+
+def iter_role_names(session, schema, user_ids, chunk_size=1000):
+    """Yield ``(user_id, frozenset of role names)`` for every id in
+    ``user_ids``, in input order.
+
+    Ids are consumed ``chunk_size`` at a time and each chunk costs one
+    query. Without a :class:`~flask_roles.RoleClosure` the role hierarchy is
+    loaded once up front.
+
+    :param session: the SQLAlchemy session to query with
+    :param schema: the :class:`~flask_roles.schema.Schema` of the user model
+    :param user_ids: iterable of user primary keys
+    :param chunk_size: number of users resolved per query
+    """
+    closure = getattr(schema.role_model, "__role_closure__", None)
+    hierarchy = None if closure is not None else _Hierarchy(session, schema)
+
+    for chunk in chunked(user_ids, chunk_size):
+        resolved = defaultdict(set)
+        if closure is not None:
+            rows = session.execute(effective_role_names(schema, chunk))
+            for user_id, name in rows:
+                resolved[user_id].add(name)
+        else:
+            pairs = direct_role_pairs(schema.user_model, chunk).alias()
+            rows = session.execute(
+                sa.select([pairs.c.holder_id, pairs.c.role_id])
+            )
+            for user_id, role_id in rows:
+                resolved[user_id].update(hierarchy.descendant_names(role_id))
+
+        for user_id in chunk:
+            yield user_id, frozenset(resolved.get(user_id, ()))
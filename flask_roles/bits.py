@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_roles.bits
+    ~~~~~~~~~~~~~~~~
+
+    Integer bitmask representation of role sets.
+"""
+import threading
+
+from .cache import LRUCache
+
+
+class Prefix(object):
+    """A node of the :class:`RoleIndex` prefix trie. :attr:`mask` holds
+    every interned name below the node and grows as names are interned, so
+    a requirement can keep the node and read the mask when it is checked.
+    """
+
+    __slots__ = ("children", "mask")
+
+    def __init__(self):
+        self.children = {}
+        self.mask = 0
+
+    def child(self, segment):
+        node = self.children.get(segment)
+        if node is None:
+            node = self.children[segment] = Prefix()
+        return node
+
+
+class RoleIndex(object):
+    """Interns role names to bit positions, so that a set of roles is a
+    single Python int and checking a requirement is one bitwise AND::
+
+        index = RoleIndex()
+        held = index.mask(["protected", "protected.view"])
+        held & index.mask(["protected.view"])  # truthy
+
+    Positions are handed out in first seen order and are only meaningful
+    within one process; share role names, not masks, between workers.
+
+    Dotted names are also indexed in a trie by segment, so that wildcard
+    requirements such as ``"billing.*"`` (any role below ``billing``) or
+    ``"*"`` (any role) cost a walk over their segments, not a scan of the
+    held names::
+
+        held & index.prefix("billing.invoice.*").mask
+    """
+
+    def __init__(self):
+        self._bits = {}
+        self._names = []
+        self._lock = threading.Lock()
+        self._decoded = LRUCache(maxsize=4096)
+        self._root = Prefix()
+
+    def __len__(self):
+        return len(self._names)
+
+    def bit(self, name):
+        """Return the single bit mask of ``name``, interning it if needed."""
+        bit = self._bits.get(name)
+        if bit is None:
+            with self._lock:
+                bit = self._bits.get(name)
+                if bit is None:
+                    bit = 1 << len(self._names)
+                    self._names.append(name)
+                    node = self._root
+                    node.mask |= bit
+                    for segment in name.split(".")[:-1]:
+                        node = node.child(segment)
+                        node.mask |= bit
+                    self._bits[name] = bit
+        return bit
+
+    def prefix(self, pattern):
+        """Return the trie node of the wildcard ``pattern``: ``"*"`` or a
+        dotted prefix followed by ``".*"``.
+
+        :raises ValueError: for any other use of ``*``
+        """
+        if pattern == "*":
+            return self._root
+        head, _, star = pattern.rpartition(".")
+        segments = head.split(".")
+        if star != "*" or "*" in head or "" in segments:
+            raise ValueError("Unsupported role pattern %r" % pattern)
+        with self._lock:
+            node = self._root
+            for segment in segments:
+                node = node.child(segment)
+        return node
+
+    def compile(self, names):
+        """Split ``names`` into the mask of the plain names and a tuple of
+        :class:`Prefix` nodes for the wildcard patterns among them.
+        """
+        mask = 0
+        prefixes = []
+        for name in names:
+            if "*" in name:
+                prefixes.append(self.prefix(name))
+            else:
+                mask |= self.bit(name)
+        return mask, tuple(prefixes)
+
+    def mask(self, names):
+        """Return the mask of the role ``names``."""
+        mask = 0
+        for name in names:
+            mask |= self.bit(name)
+        return mask
+
+    def names(self, mask):
+        """Return the role names in ``mask`` as a frozenset. Role sets are
+        few compared to users, so decoded sets are shared.
+        """
+        names = self._decoded.get(mask)
+        if names is None:
+            found = []
+            remaining = mask
+            while remaining:
+                low = remaining & -remaining
+                found.append(self._names[low.bit_length() - 1])
+                remaining ^= low
+            names = frozenset(found)
+            self._decoded.set(mask, names)
+        return names
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_roles.bulk
+    ~~~~~~~~~~~~~~~~
+
+    Set based role assignment for many users or groups at once.
+"""
+import sqlalchemy as sa
+
+from .batch import chunked
+from .schema import association
+
+
+def _ids(items):
+    ids = []
+    for item in items:
+        state = sa.inspect(item, raiseerr=False)
+        ids.append(item if state is None else state.identity[0])
+    return ids
+
+
+def _expire(session, model, holders):
+    # Loaded roles collections no longer match the association table
+    for holder in holders:
+        if isinstance(holder, model):
+            session.expire(holder, ["roles"])
+
+
+def assign_roles(session, model, holders, roles, chunk_size=1000):
+    """Assign every role in ``roles`` to every holder in ``holders``, with
+    one ``INSERT .. SELECT`` per ``chunk_size`` holders. Pairs which
+    already exist are skipped. Returns the number of rows inserted.
+
+    :param session: the SQLAlchemy session
+    :param model: the holder class, e.g. ``User`` or ``Group``
+    :param holders: holder objects or primary keys
+    :param roles: role objects or primary keys
+    :param chunk_size: number of holders per statement
+    """
+    session.flush()
+    holders = list(holders)
+    role_ids = _ids(roles)
+    if not holders or not role_ids:
+        return 0
+
+    table, holder_col, role_col = association(model, "roles")
+    holder_id = sa.inspect(model).primary_key[0]
+    role_id = list(role_col.foreign_keys)[0].column
+    existing = table.alias("existing")
+
+    inserted = 0
+    for chunk in chunked(_ids(holders), chunk_size):
+        pairs = sa.select([holder_id, role_id]).where(
+            sa.and_(
+                holder_id.in_(chunk),
+                role_id.in_(role_ids),
+                ~sa.exists().where(
+                    sa.and_(
+                        existing.c[holder_col.name] == holder_id,
+                        existing.c[role_col.name] == role_id,
+                    )
+                ),
+            )
+        )
+        result = session.execute(
+            table.insert().from_select([holder_col, role_col], pairs)
+        )
+        inserted += result.rowcount
+    _expire(session, model, holders)
+    return inserted
+
+
+def revoke_roles(session, model, holders, roles, chunk_size=1000):
+    """Remove every role in ``roles`` from every holder in ``holders``, with
+    one ``DELETE`` per ``chunk_size`` holders. Returns the number of rows
+    deleted.
+
+    :param session: the SQLAlchemy session
+    :param model: the holder class, e.g. ``User`` or ``Group``
+    :param holders: holder objects or primary keys
+    :param roles: role objects or primary keys
+    :param chunk_size: number of holders per statement
+    """
+    session.flush()
+    holders = list(holders)
+    role_ids = _ids(roles)
+    if not holders or not role_ids:
+        return 0
+
+    table, holder_col, role_col = association(model, "roles")
+    deleted = 0
+    for chunk in chunked(_ids(holders), chunk_size):
+        result = session.execute(
+            table.delete().where(
+                sa.and_(holder_col.in_(chunk), role_col.in_(role_ids))
+            )
+        )
+        deleted += result.rowcount
+    _expire(session, model, holders)
+    return deleted
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_roles.cache
+    ~~~~~~~~~~~~~~~~~
+
+    Caches for effective role sets.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class BaseCache(object):
+    """Interface of the backends the :class:`~flask_roles.Roles` extension
+    stores effective role sets in. Keys are user ids, or ``(generation,
+    user id)`` tuples when a :class:`~flask_roles.RoleGeneration` is used.
+
+    Process local backends are handed role bitmasks, shared ones the role
+    names, since bit positions differ between processes. ``set`` may be
+    given a ``ttl`` in seconds, shorter than the backend's own, when the
+    value goes stale sooner, e.g. when a role grant expires.
+    """
+
+    process_local = True
+
+    def get(self, key, default=None):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class LRUCache(BaseCache):
+    """A thread safe, size bounded, least recently used cache whose entries
+    optionally expire ``ttl`` seconds after they were stored.
+
+    :param maxsize: maximum number of entries kept
+    :param ttl: seconds an entry stays valid, ``None`` for no expiry
+    :param clock: monotonic time source, useful in tests
+    :param on_evict: called with the key of every entry pushed out to make
+        room, after the cache lock is released
+
+    :attr:`evictions` counts the entries pushed out so far.
+    """
+
+    def __init__(
+        self, maxsize=1024, ttl=None, clock=time.monotonic, on_evict=None
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.on_evict = on_evict
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                return default
+            if expires is not None and expires <= self.clock():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None or (self.ttl is not None and self.ttl < ttl):
+            ttl = self.ttl
+        expires = None if ttl is None else self.clock() + ttl
+        evicted = []
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                evicted.append(self._data.popitem(last=False)[0])
+            self.evictions += len(evicted)
+        if self.on_evict is not None:
+            for evicted_key in evicted:
+                self.on_evict(evicted_key)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SharedCache(BaseCache):
+    """Stores role sets in a cache shared by every worker, e.g. redis or
+    memcached. ``client`` is any object with the ``get(key)``,
+    ``set(key, value, timeout)`` and ``delete(key)`` methods of the
+    `cachelib <https://cachelib.readthedocs.io/>`_ backends, which take care
+    of serialization::
+
+        from cachelib import RedisCache
+        roles = Roles(cache=SharedCache(RedisCache(host="cache")))
+
+    A shared cache cannot enumerate its keys, so :meth:`clear` is a no-op.
+    Combine it with a :class:`~flask_roles.RoleGeneration` so that role
+    changes move every worker on to fresh keys.
+
+    :param client: the cache client
+    :param prefix: prepended to every key
+    :param ttl: seconds an entry stays valid, ``None`` for no expiry
+    """
+
+    process_local = False
+
+    def __init__(self, client, prefix="flask_roles:", ttl=None):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def _key(self, key):
+        if isinstance(key, tuple):
+            key = ":".join(str(part) for part in key)
+        return "%s%s" % (self.prefix, key)
+
+    def get(self, key, default=None):
+        value = self.client.get(self._key(key))
+        return default if value is None else value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            self.client.set(self._key(key), value, self.ttl)
+            return
+        # Whole seconds, rounded down so the entry never outlives ttl; a
+        # timeout of 0 would mean no expiry at all
+        timeout = int(ttl if self.ttl is None else min(ttl, self.ttl))
+        if timeout < 1:
+            self.client.delete(self._key(key))
+        else:
+            self.client.set(self._key(key), value, timeout)
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+    def clear(self):
+        pass
@@ -0,0 +1,486 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_roles.closure
+    ~~~~~~~~~~~~~~~~~~~
+
+    Optional materialized transitive closures of the role hierarchy and of
+    nested group membership.
+"""
+import weakref
+from collections import defaultdict
+
+import sqlalchemy as sa
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import object_session
+from sqlalchemy.sql.dml import Delete, Insert, Update
+
+from .invalidation import param_rows
+from .schema import association, direct_role_ids
+
+_group_closures = weakref.WeakSet()
+
+
+def _after_execute(conn, clauseelement, multiparams, params, **kw):
+    # One engine listener for every GroupClosure, like invalidation.watch
+    if not isinstance(clauseelement, (Insert, Update, Delete)):
+        return
+    for closure in list(_group_closures):
+        closure._nesting_written(conn, clauseelement, multiparams, params)
+
+
+class RoleClosure(object):
+    """Maintains a ``(ancestor_id, descendant_id, depth)`` table next to a
+    self-referential role model. Every role is its own ancestor at depth 0,
+    so the full effective role set of a user is a single indexed join::
+
+        class Role(db.Model, flask_roles.RoleMixin):
+            ...
+
+        role_closure = flask_roles.RoleClosure(Role)
+
+    The table is added to the role model's metadata and kept up to date by
+    mapper events whenever a role is created, re-parented or deleted.
+    Re-parenting a role under one of its own descendants raises
+    :class:`ValueError`.
+
+    :param role_model: the mapped role class
+    :param parent: name of the self-referential foreign key column
+    :param name: table name, defaults to ``<role table>_closure``
+    """
+
+    def __init__(self, role_model, parent="parent_id", name=None):
+        mapper = sa.inspect(role_model)
+        role_table = mapper.local_table
+        role_id = mapper.primary_key[0]
+
+        self.role_model = role_model
+        self.role_id = role_id
+        self.parent_id = role_table.c[parent]
+        self.parent_key = mapper.get_property_by_column(self.parent_id).key
+        self.id_key = mapper.get_property_by_column(role_id).key
+
+        name = name or "%s_closure" % role_table.name
+        self.table = sa.Table(
+            name,
+            role_table.metadata,
+            sa.Column(
+                "ancestor_id",
+                role_id.type,
+                sa.ForeignKey(role_id),
+                primary_key=True,
+            ),
+            sa.Column(
+                "descendant_id",
+                role_id.type,
+                sa.ForeignKey(role_id),
+                primary_key=True,
+            ),
+            sa.Column("depth", sa.Integer, nullable=False),
+            sa.Index("ix_%s_descendant_id" % name, "descendant_id"),
+        )
+
+        role_model.__role_closure__ = self
+        event.listen(role_model, "after_insert", self._after_insert)
+        event.listen(role_model, "after_update", self._after_update)
+        event.listen(role_model, "before_delete", self._before_delete)
+
+    def descendant_ids(self, role_ids):
+        """Select the ids of ``role_ids`` and all of their descendants."""
+        c = self.table.c
+        return (
+            sa.select([c.descendant_id])
+            .where(c.ancestor_id.in_(role_ids))
+            .distinct()
+        )
+
+    def ancestor_ids(self, role_ids):
+        """Select the ids of ``role_ids`` and all of their ancestors."""
+        c = self.table.c
+        return (
+            sa.select([c.ancestor_id])
+            .where(c.descendant_id.in_(role_ids))
+            .distinct()
+        )
+
+    def get_roles(self, holder):
+        """Query every role ``holder`` (a user or group) effectively holds,
+        including roles granted through groups and inherited from parents.
+        """
+        model = type(holder)
+        holder_id = sa.inspect(model).primary_key[0]
+        direct = direct_role_ids(model, [getattr(holder, holder_id.key)])
+        role_id = getattr(self.role_model, self.id_key)
+        return (
+            object_session(holder)
+            .query(self.role_model)
+            .filter(role_id.in_(self.descendant_ids(direct)))
+            .order_by(role_id)
+        )
+
+    def get_role_names(self, holder):
+        """Return the set of role names ``holder`` effectively holds."""
+        return {role.name for role in self.get_roles(holder)}
+
+    def rebuild(self, connection):
+        """Recompute the whole table from the parent column, e.g. after
+        enabling the closure on an existing database.
+        """
+        parents = dict(
+            (row[0], row[1])
+            for row in connection.execute(
+                sa.select([self.role_id, self.parent_id])
+            )
+        )
+
+        rows = []
+        for descendant in parents:
+            ancestor, depth, seen = descendant, 0, set()
+            while ancestor is not None and ancestor not in seen:
+                seen.add(ancestor)
+                rows.append(
+                    {
+                        "ancestor_id": ancestor,
+                        "descendant_id": descendant,
+                        "depth": depth,
+                    }
+                )
+                ancestor, depth = parents.get(ancestor), depth + 1
+
+        connection.execute(self.table.delete())
+        if rows:
+            connection.execute(self.table.insert(), rows)
+
+    def _link(self, connection, role_id, parent_id):
+        # Connect the subtree rooted at role_id below every ancestor of
+        # parent_id (including parent_id itself)
+        if parent_id is None:
+            return
+        above = self.table.alias("above")
+        below = self.table.alias("below")
+        connection.execute(
+            self.table.insert().from_select(
+                ["ancestor_id", "descendant_id", "depth"],
+                sa.select(
+                    [
+                        above.c.ancestor_id,
+                        below.c.descendant_id,
+                        above.c.depth + below.c.depth + 1,
+                    ]
+                ).where(
+                    sa.and_(
+                        above.c.descendant_id == parent_id,
+                        below.c.ancestor_id == role_id,
+                    )
+                ),
+            )
+        )
+
+    def _after_insert(self, mapper, connection, target):
+        role_id = getattr(target, self.id_key)
+        connection.execute(
+            self.table.insert(),
+            {"ancestor_id": role_id, "descendant_id": role_id, "depth": 0},
+        )
+        self._link(connection, role_id, getattr(target, self.parent_key))
+
+    def _after_update(self, mapper, connection, target):
+        history = sa.inspect(target).attrs[self.parent_key].history
+        if not history.has_changes():
+            return
+
+        role_id = getattr(target, self.id_key)
+        parent_id = getattr(target, self.parent_key)
+        c = self.table.c
+        if parent_id is not None:
+            cycle = connection.execute(
+                sa.select([c.depth]).where(
+                    sa.and_(
+                        c.ancestor_id == role_id, c.descendant_id == parent_id
+                    )
+                )
+            ).first()
+            if cycle is not None:
+                raise ValueError(
+                    "Role %r cannot be a descendant of itself" % target
+                )
+
+        # Detach the subtree from its old ancestors
+        subtree = sa.select([c.descendant_id]).where(c.ancestor_id == role_id)
+        old_ancestors = sa.select([c.ancestor_id]).where(
+            sa.and_(c.descendant_id == role_id, c.ancestor_id != role_id)
+        )
+        connection.execute(
+            self.table.delete().where(
+                sa.and_(
+                    c.descendant_id.in_(subtree),
+                    c.ancestor_id.in_(old_ancestors),
+                )
+            )
+        )
+        self._link(connection, role_id, parent_id)
+
+    def _before_delete(self, mapper, connection, target):
+        role_id = getattr(target, self.id_key)
+        c = self.table.c
+        connection.execute(
+            self.table.delete().where(
+                sa.or_(c.ancestor_id == role_id, c.descendant_id == role_id)
+            )
+        )
+
+
+class GroupClosure(object):
+    """Maintains an ``(ancestor_id, descendant_id)`` table of nested group
+    membership, for group models which can themselves belong to groups
+    through a ``groups`` relationship, just like users do::
+
+        class Group(db.Model, flask_roles.GroupMixin):
+            ...
+            groups = db.relationship(
+                "Group",
+                secondary="group_group",
+                primaryjoin="Group.id == GroupGroup.member_id",
+                secondaryjoin="Group.id == GroupGroup.group_id",
+                backref="members",
+            )
+
+        group_closure = flask_roles.GroupClosure(Group)
+
+    The ancestors of a group are the groups containing it, directly or
+    through other groups, and the group itself. Members of a group inherit
+    the roles of all its ancestors, and a user's full group set is a single
+    indexed join from the user_group table.
+
+    The table is updated whenever the group nesting table is written to:
+    removing an edge only recomputes the rows of the groups below its
+    member. Statements which do not bind the member and group of every row
+    they touch (updates, ad hoc ``WHERE`` clauses) rebuild the whole table.
+    Nesting a group inside one of its own members raises
+    :class:`ValueError`.
+
+    :param group_model: the mapped group class
+    :param name: table name, defaults to ``<group table>_closure``
+    """
+
+    def __init__(self, group_model, name=None):
+        mapper = sa.inspect(group_model)
+        group_table = mapper.local_table
+        group_id = mapper.primary_key[0]
+
+        self.group_model = group_model
+        self.group_id = group_id
+        self.id_key = mapper.get_property_by_column(group_id).key
+
+        name = name or "%s_closure" % group_table.name
+        self.table = sa.Table(
+            name,
+            group_table.metadata,
+            sa.Column(
+                "ancestor_id",
+                group_id.type,
+                sa.ForeignKey(group_id),
+                primary_key=True,
+            ),
+            sa.Column(
+                "descendant_id",
+                group_id.type,
+                sa.ForeignKey(group_id),
+                primary_key=True,
+            ),
+            sa.Index("ix_%s_descendant_id" % name, "descendant_id"),
+        )
+        self._nesting = None
+
+        group_model.__group_closure__ = self
+        event.listen(group_model, "after_insert", self._after_insert)
+        event.listen(group_model, "before_delete", self._before_delete)
+        if not event.contains(Engine, "after_execute", _after_execute):
+            event.listen(Engine, "after_execute", _after_execute, named=True)
+        _group_closures.add(self)
+
+    @property
+    def nesting(self):
+        """``(table, member_column, group_column)`` of the nesting table."""
+        if self._nesting is None:
+            self._nesting = association(self.group_model, "groups")
+        return self._nesting
+
+    def ancestor_ids(self, group_ids):
+        """Select the ids of ``group_ids`` and every group containing them."""
+        c = self.table.c
+        return (
+            sa.select([c.ancestor_id])
+            .where(c.descendant_id.in_(group_ids))
+            .distinct()
+        )
+
+    def descendant_ids(self, group_ids):
+        """Select the ids of ``group_ids`` and every group they contain."""
+        c = self.table.c
+        return (
+            sa.select([c.descendant_id])
+            .where(c.ancestor_id.in_(group_ids))
+            .distinct()
+        )
+
+    def get_groups(self, holder):
+        """Query every group ``holder`` (a user or group) belongs to,
+        directly or through nesting.
+        """
+        table, holder_col, group_col = association(type(holder), "groups")
+        holder_id = sa.inspect(holder).identity[0]
+        group_id = getattr(self.group_model, self.id_key)
+        direct = sa.select([group_col]).where(holder_col == holder_id)
+        return (
+            object_session(holder)
+            .query(self.group_model)
+            .filter(group_id.in_(self.ancestor_ids(direct)))
+            .order_by(group_id)
+        )
+
+    def rebuild(self, connection):
+        """Recompute the whole table from the nesting table."""
+        table, member_col, group_col = self.nesting
+        containers = defaultdict(list)
+        for member, group in connection.execute(
+            sa.select([member_col, group_col])
+        ):
+            containers[member].append(group)
+
+        rows = []
+        for (descendant,) in connection.execute(sa.select([self.group_id])):
+            seen = set()
+            stack = [descendant]
+            while stack:
+                ancestor = stack.pop()
+                if ancestor in seen:
+                    continue
+                seen.add(ancestor)
+                rows.append(
+                    {"ancestor_id": ancestor, "descendant_id": descendant}
+                )
+                stack.extend(containers.get(ancestor, ()))
+
+        connection.execute(self.table.delete())
+        if rows:
+            connection.execute(self.table.insert(), rows)
+
+    def _link(self, connection, member_id, group_id):
+        c = self.table.c
+        cycle = connection.execute(
+            sa.select([c.ancestor_id]).where(
+                sa.and_(
+                    c.ancestor_id == member_id, c.descendant_id == group_id
+                )
+            )
+        ).first()
+        if cycle is not None:
+            raise ValueError(
+                "Group %r cannot be nested in its own member %r"
+                % (group_id, member_id)
+            )
+
+        # Every container of group_id now contains every member of member_id
+        above = self.table.alias("above")
+        below = self.table.alias("below")
+        existing = self.table.alias("existing")
+        connection.execute(
+            self.table.insert().from_select(
+                ["ancestor_id", "descendant_id"],
+                sa.select([above.c.ancestor_id, below.c.descendant_id]).where(
+                    sa.and_(
+                        above.c.descendant_id == group_id,
+                        below.c.ancestor_id == member_id,
+                        ~sa.exists().where(
+                            sa.and_(
+                                existing.c.ancestor_id == above.c.ancestor_id,
+                                existing.c.descendant_id
+                                == below.c.descendant_id,
+                            )
+                        ),
+                    )
+                ),
+            )
+        )
+
+    def _unlink(self, connection, member_id):
+        # The nesting edge from member_id is gone. Only groups below it can
+        # lose containers, and the rows among them stay: recompute their
+        # containers outside it from the edges still leaving it.
+        c = self.table.c
+        below = [
+            row[0]
+            for row in connection.execute(
+                sa.select([c.descendant_id]).where(c.ancestor_id == member_id)
+            )
+        ]
+        if not below:
+            return
+        connection.execute(
+            self.table.delete().where(
+                sa.and_(
+                    c.descendant_id.in_(below), ~c.ancestor_id.in_(below)
+                )
+            )
+        )
+        table, member_col, group_col = self.nesting
+        inner = self.table.alias("inner")
+        above = self.table.alias("above")
+        connection.execute(
+            self.table.insert().from_select(
+                ["ancestor_id", "descendant_id"],
+                sa.select([above.c.ancestor_id, inner.c.descendant_id])
+                .select_from(
+                    inner.join(table, member_col == inner.c.ancestor_id).join(
+                        above, above.c.descendant_id == group_col
+                    )
+                )
+                .where(
+                    sa.and_(
+                        inner.c.descendant_id.in_(below),
+                        inner.c.ancestor_id.in_(below),
+                        ~group_col.in_(below),
+                    )
+                )
+                .distinct(),
+            )
+        )
+
+    def _nesting_written(self, conn, statement, multiparams, params):
+        if self.nesting is None or statement.table is not self.nesting[0]:
+            return
+        table, member_col, group_col = self.nesting
+
+        rows = param_rows(multiparams, params)
+        keys = (member_col.key, group_col.key)
+        if (
+            isinstance(statement, Update)
+            or not rows
+            or not all(key in row for row in rows for key in keys)
+        ):
+            # Which edges changed is unknown
+            self.rebuild(conn)
+        elif isinstance(statement, Insert):
+            for row in rows:
+                self._link(conn, row[member_col.key], row[group_col.key])
+        else:
+            # Removing an edge of a DAG can leave other paths in place
+            for member_id in {row[member_col.key] for row in rows}:
+                self._unlink(conn, member_id)
+
+    def _after_insert(self, mapper, connection, target):
+        group_id = getattr(target, self.id_key)
+        connection.execute(
+            self.table.insert(),
+            {"ancestor_id": group_id, "descendant_id": group_id},
+        )
+
+    def _before_delete(self, mapper, connection, target):
+        group_id = getattr(target, self.id_key)
+        c = self.table.c
+        connection.execute(
+            self.table.delete().where(
+                sa.or_(c.ancestor_id == group_id, c.descendant_id == group_id)
+            )
+        )
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_roles.endpoints
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Endpoint to required role bitmask table, compiled from the views
+    decorated with :meth:`~flask_roles.Roles.require_any` and
+    :meth:`~flask_roles.Roles.require_all`.
+"""
+from collections import namedtuple
+
+#: One decorator's requirement: the mask of plain role names, whether all
+#: of them are needed, the status code to abort with otherwise, the
+#: :class:`~flask_roles.bits.Prefix` nodes of wildcard patterns and a
+#: :class:`~flask_roles.policy.Policy` which replaces all of those
+Requirement = namedtuple(
+    "Requirement",
+    "mask match_all http_exception prefixes policy",
+    defaults=[(), None],
+)
+
+_ATTR = "__roles_required__"
+
+
+def requirements(view):
+    """Return the :class:`Requirement` tuple attached to ``view``, looking
+    through ``__wrapped__`` for decorators which do not copy attributes.
+    """
+    while view is not None:
+        found = getattr(view, _ATTR, None)
+        if found is not None:
+            return found
+        view = getattr(view, "__wrapped__", None)
+    return ()
+
+
+def mark(view, requirement):
+    """Put ``requirement`` in front of those ``view`` already carries, so
+    requirements are checked in the order the decorators would run.
+    """
+    setattr(view, _ATTR, (requirement,) + requirements(view))
+
+
+def allows(mask, requirement):
+    """Return whether the role ``mask`` satisfies ``requirement``."""
+    if requirement.policy is not None:
+        return requirement.policy.allows(mask)
+    held = mask & requirement.mask
+    if requirement.match_all:
+        return held == requirement.mask and all(
+            mask & prefix.mask for prefix in requirement.prefixes
+        )
+    return bool(held) or any(
+        mask & prefix.mask for prefix in requirement.prefixes
+    )
+
+
+def denied(mask, requirements):
+    """Return the status code of the first requirement that ``mask`` fails,
+    or ``None`` if it satisfies all of them.
+    """
+    for requirement in requirements:
+        if not allows(mask, requirement):
+            return requirement.http_exception
+    return None
+
+
+def compile_endpoints(app):
+    """Walk ``app.url_map`` and return ``{endpoint: requirements}`` for every
+    endpoint whose view requires roles.
+    """
+    endpoints = {}
+    for rule in app.url_map.iter_rules():
+        found = requirements(app.view_functions.get(rule.endpoint))
+        if found:
+            endpoints[rule.endpoint] = found
+    return endpoints
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_roles.generation
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    A database backed version counter for the role data.
+"""
+import sqlalchemy as sa
+from sqlalchemy import event
+
+
+class RoleGeneration(object):
+    """A single row table holding a counter which is incremented, inside the
+    writing transaction, whenever role assignments or the role hierarchy
+    change. Workers key their cached role sets by the current generation,
+    so a change made by any worker on any host is seen everywhere after one
+    integer read::
+
+        role_generation = flask_roles.RoleGeneration(db.metadata)
+        roles = Roles(generation=role_generation)
+
+    :param metadata: the metadata to add the table to
+    :param name: table name
+    """
+
+    def __init__(self, metadata, name="role_generation"):
+        self.table = sa.Table(
+            name,
+            metadata,
+            sa.Column("id", sa.Integer, primary_key=True, autoincrement=False),
+            sa.Column("generation", sa.BigInteger, nullable=False),
+            sa.Column("hierarchy", sa.BigInteger, nullable=False, default=0),
+        )
+        event.listen(self.table, "after_create", self._after_create)
+
+    def _after_create(self, target, connection, **kw):
+        connection.execute(
+            self.table.insert(), {"id": 1, "generation": 0, "hierarchy": 0}
+        )
+
+    def versions(self, connection):
+        """Return ``(generation, hierarchy)``. The hierarchy version only
+        moves when roles themselves are renamed, re-parented or deleted.
+        """
+        return self.parse(connection.execute(self.select()).first())
+
+    def select(self):
+        """Select the ``(generation, hierarchy)`` row, for callers which
+        execute it themselves, e.g. on an async session.
+        """
+        c = self.table.c
+        return sa.select([c.generation, c.hierarchy]).where(c.id == 1)
+
+    @staticmethod
+    def parse(row):
+        """Turn the row read with :meth:`select` into a tuple."""
+        return (row[0], row[1]) if row is not None else (0, 0)
+
+    def current(self, connection):
+        """Return the current generation."""
+        return self.versions(connection)[0]
+
+    def bump(self, connection, hierarchy=False):
+        """Increment the generation, and the hierarchy version if
+        ``hierarchy`` is set, within the transaction of ``connection``.
+        """
+        c = self.table.c
+        values = {"generation": c.generation + 1}
+        if hierarchy:
+            values["hierarchy"] = c.hierarchy + 1
+        result = connection.execute(
+            self.table.update().where(c.id == 1).values(**values)
+        )
+        if result.rowcount == 0:
+            connection.execute(
+                self.table.insert(),
+                {"id": 1, "generation": 1, "hierarchy": int(hierarchy)},
+            )
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_roles.grants
+    ~~~~~~~~~~~~~~~~~~
+
+    Role grants which lapse on their own after a while.
+"""
+from datetime import datetime, timedelta
+
+import sqlalchemy as sa
+
+from .bulk import _ids
+
+
+def utcnow():
+    """The naive UTC datetime expiry times are compared with."""
+    return datetime.utcnow()
+
+
+class ExpiringRoles(object):
+    """Maintains a ``(user_id, role_id, expires_at)`` table of temporary role
+    grants next to the user model, e.g. for elevated access which must lapse
+    without anyone revoking it::
+
+        class User(db.Model, flask_roles.UserMixin):
+            ...
+
+        expiring_roles = flask_roles.ExpiringRoles(User, Role)
+        expiring_roles.grant(db.session, user, on_call, timedelta(hours=8))
+
+    Grants are held, and inherited down the hierarchy, like ordinary
+    assignments until ``expires_at`` (a naive UTC datetime). Only unexpired
+    grants are read, through an index on ``(user_id, expires_at)``, and
+    :meth:`purge` removes lapsed ones through an index on ``expires_at``.
+
+    The :class:`~flask_roles.Roles` cache keeps a user's role set no longer
+    than until the earliest upcoming expiry among their grants, so entries
+    lapse with them and checks never compare timestamps.
+
+    :param user_model: mapped class using :class:`~flask_roles.UserMixin`
+    :param role_model: the mapped role class
+    :param name: table name, defaults to ``<user table>_role_grant``
+    """
+
+    def __init__(self, user_model, role_model, name=None):
+        user_mapper = sa.inspect(user_model)
+        user_id = user_mapper.primary_key[0]
+        role_id = sa.inspect(role_model).primary_key[0]
+
+        self.user_model = user_model
+        self.role_model = role_model
+        name = name or "%s_role_grant" % user_mapper.local_table.name
+        self.table = sa.Table(
+            name,
+            user_mapper.local_table.metadata,
+            sa.Column(
+                "user_id",
+                user_id.type,
+                sa.ForeignKey(user_id),
+                primary_key=True,
+            ),
+            sa.Column(
+                "role_id",
+                role_id.type,
+                sa.ForeignKey(role_id),
+                primary_key=True,
+            ),
+            sa.Column("expires_at", sa.DateTime, nullable=False),
+            sa.Index(
+                "ix_%s_user_id_expires_at" % name, "user_id", "expires_at"
+            ),
+            sa.Index("ix_%s_expires_at" % name, "expires_at"),
+        )
+        user_model.__role_grants__ = self
+
+    def active_pairs(self, user_ids, now=None):
+        """Select ``(holder_id, role_id)`` for the unexpired grants of the
+        users ``user_ids``.
+        """
+        c = self.table.c
+        return sa.select(
+            [c.user_id.label("holder_id"), c.role_id.label("role_id")]
+        ).where(
+            sa.and_(c.user_id.in_(user_ids), c.expires_at > (now or utcnow()))
+        )
+
+    def active_holder_ids(self, role_ids, now=None):
+        """Select the ids of users with an unexpired grant of any of
+        ``role_ids``.
+        """
+        c = self.table.c
+        return sa.select([c.user_id]).where(
+            sa.and_(c.role_id.in_(role_ids), c.expires_at > (now or utcnow()))
+        )
+
+    def next_expiry(self, user_ids, now=None):
+        """Select ``(user_id, expires_at)`` of the earliest upcoming expiry
+        among the grants of each of ``user_ids`` which has any.
+        """
+        c = self.table.c
+        return (
+            sa.select([c.user_id, sa.func.min(c.expires_at)])
+            .where(
+                sa.and_(
+                    c.user_id.in_(user_ids), c.expires_at > (now or utcnow())
+                )
+            )
+            .group_by(c.user_id)
+        )
+
+    def grant(self, session, user, role, expires):
+        """Grant ``role`` to ``user`` until ``expires``, replacing any grant
+        of the same role. Returns the expiry time.
+
+        :param session: the SQLAlchemy session
+        :param user: user object or primary key
+        :param role: role object or primary key
+        :param expires: naive UTC datetime, or a timedelta from now
+        """
+        if isinstance(expires, timedelta):
+            expires = utcnow() + expires
+        session.flush()
+        (user_id,), (role_id,) = _ids([user]), _ids([role])
+        self.revoke(session, user_id, role_id)
+        session.execute(
+            self.table.insert(),
+            {"user_id": user_id, "role_id": role_id, "expires_at": expires},
+        )
+        return expires
+
+    def revoke(self, session, user, role):
+        """Remove the grant of ``role`` to ``user`` before it expires.
+        Returns whether there was one.
+        """
+        session.flush()
+        (user_id,), (role_id,) = _ids([user]), _ids([role])
+        return bool(self._delete(session, [(user_id, role_id)]))
+
+    def purge(self, session, now=None):
+        """Delete the grants which have expired. Returns how many there
+        were. Expired grants are already ignored, so this only keeps the
+        table small.
+        """
+        c = self.table.c
+        expired = session.execute(
+            sa.select([c.user_id, c.role_id]).where(
+                c.expires_at <= (now or utcnow())
+            )
+        ).fetchall()
+        return self._delete(session, expired)
+
+    def _delete(self, session, pairs):
+        # Bound per row, so that only these users' cache entries are dropped
+        if not pairs:
+            return 0
+        c = self.table.c
+        result = session.execute(
+            self.table.delete().where(
+                sa.and_(
+                    c.user_id == sa.bindparam("user_id"),
+                    c.role_id == sa.bindparam("role_id"),
+                )
+            ),
+            [
+                {"user_id": user_id, "role_id": role_id}
+                for user_id, role_id in pairs
+            ],
+        )
+        return result.rowcount
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_roles.graph
+    ~~~~~~~~~~~~~~~~~
+
+    Immutable in-memory snapshot of the role hierarchy.
+"""
+import io
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+
+import sqlalchemy as sa
+
+
+#: magic, byte order mark, has version, version, roles, child targets,
+#: descendant targets, name bytes
+_HEADER = struct.Struct("=8sqqqqqqq")
+_MAGIC = b"FRGRAPH1"
+_ORDER = 0x0102030405060708
+
+
+class RoleGraph(object):
+    """A frozen, compact copy of the role hierarchy.
+
+    Roles are numbered densely by id. Adjacency and the precomputed
+    descendant closure are stored CSR style in flat integer arrays (one
+    offsets array and one targets array each), not as ORM objects. Role
+    names are interned with a :class:`~flask_roles.RoleIndex`, so the
+    effective roles of a set of directly held roles come out as a bitmask in
+    the same bit space as the rest of the extension.
+
+    Snapshots are never modified. When the hierarchy changes a new one is
+    built and swapped in, so readers never need a lock.
+
+    A snapshot can be written to a file with :meth:`dump` and mapped back
+    with :meth:`open`. The arrays of a mapped snapshot are views of the
+    file, so every process mapping it shares the same pages.
+
+    :param rows: iterable of ``(role_id, name, parent_id)`` tuples
+    :param index: the :class:`~flask_roles.RoleIndex` to intern names with
+    :param version: the hierarchy version this snapshot was built from
+    """
+
+    __slots__ = (
+        "version",
+        "index",
+        "ids",
+        "names",
+        "bits",
+        "parents",
+        "child_offsets",
+        "child_targets",
+        "descendant_offsets",
+        "descendant_targets",
+        "_positions",
+        "_masks",
+        "_buffer",
+    )
+
+    def __init__(self, rows, index, version=None):
+        rows = sorted(rows, key=lambda row: row[0])
+        self.ids = array("q", (row[0] for row in rows))
+        self.names = tuple(row[1] for row in rows)
+        self._attach(index, version)
+        self.parents = array(
+            "l", (self._positions.get(row[2], -1) for row in rows)
+        )
+
+        children = [[] for _ in rows]
+        for pos, parent in enumerate(self.parents):
+            if parent >= 0:
+                children[parent].append(pos)
+        self.child_offsets, self.child_targets = _csr(children)
+
+        descendants = []
+        for pos in range(len(rows)):
+            seen = set()
+            stack = [pos]
+            while stack:
+                current = stack.pop()
+                if current in seen:
+                    continue
+                seen.add(current)
+                stack.extend(children[current])
+            descendants.append(sorted(seen))
+        self.descendant_offsets, self.descendant_targets = _csr(descendants)
+        self._buffer = None
+
+    def _attach(self, index, version):
+        # Everything that depends on this process: bit positions are only
+        # meaningful within one RoleIndex
+        self.version = version
+        self.index = index
+        self._positions = {
+            role_id: pos for pos, role_id in enumerate(self.ids)
+        }
+        self.bits = array(
+            "l", (index.bit(name).bit_length() - 1 for name in self.names)
+        )
+        # A plain dict: the snapshot is immutable and has one entry per
+        # role at most, so a racing reader at worst computes a mask twice
+        self._masks = {}
+
+    @classmethod
+    def load(cls, connection, schema, index, version=None):
+        """Build a snapshot from the role table with one query.
+
+        :param connection: a connection or session
+        :param schema: the :class:`~flask_roles.schema.Schema` of the models
+        :param index: the :class:`~flask_roles.RoleIndex` to intern with
+        :param version: the hierarchy version being loaded
+        """
+        rows = connection.execute(
+            sa.select([schema.role_id, schema.role_name, schema.role_parent])
+        )
+        return cls([tuple(row) for row in rows], index, version)
+
+    def dump(self, path):
+        """Write the snapshot to ``path`` in the native byte order, for
+        :meth:`open`. The file is written beside ``path`` and renamed over
+        it, so a process opening ``path`` sees either the old snapshot or
+        the new one, never part of one.
+        """
+        names = [name.encode("utf-8") for name in self.names]
+        name_offsets = array("q", [0])
+        for name in names:
+            name_offsets.append(name_offsets[-1] + len(name))
+        header = _HEADER.pack(
+            _MAGIC,
+            _ORDER,
+            self.version is not None,
+            self.version or 0,
+            len(self.ids),
+            len(self.child_targets),
+            len(self.descendant_targets),
+            name_offsets[-1],
+        )
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temp = tempfile.mkstemp(prefix=".roles-graph-", dir=directory)
+        try:
+            with io.open(fd, "wb") as f:
+                f.write(header)
+                for values in (
+                    self.ids,
+                    self.parents,
+                    self.child_offsets,
+                    self.child_targets,
+                    self.descendant_offsets,
+                    self.descendant_targets,
+                ):
+                    f.write(array("q", values).tobytes())
+                f.write(name_offsets.tobytes())
+                f.write(b"".join(names))
+            os.chmod(temp, 0o644)
+            os.replace(temp, path)
+        except BaseException:
+            os.unlink(temp)
+            raise
+
+    @classmethod
+    def open(cls, path, index):
+        """Map a snapshot written by :meth:`dump`. Only the role names are
+        copied, to intern them with ``index``; ids, adjacency and the
+        descendant closure are read from the mapped file.
+
+        :param path: the snapshot file
+        :param index: the :class:`~flask_roles.RoleIndex` to intern with
+        :raises ValueError: if ``path`` is not a snapshot of this format
+        """
+        with io.open(path, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(buffer) < _HEADER.size:
+            raise ValueError("%s is not a role graph snapshot" % path)
+        (
+            magic,
+            order,
+            has_version,
+            version,
+            size,
+            child_count,
+            descendant_count,
+            name_bytes,
+        ) = _HEADER.unpack_from(buffer)
+        if magic != _MAGIC or order != _ORDER:
+            raise ValueError(
+                "%s is not a %s endian role graph snapshot"
+                % (path, sys.byteorder)
+            )
+        counts = (
+            size,
+            size,
+            size + 1,
+            child_count,
+            size + 1,
+            descendant_count,
+            size + 1,
+        )
+        if len(buffer) != _HEADER.size + 8 * sum(counts) + name_bytes:
+            raise ValueError("%s is truncated" % path)
+
+        view = memoryview(buffer)
+        arrays = []
+        start = _HEADER.size
+        for count in counts:
+            end = start + 8 * count
+            arrays.append(view[start:end].cast("q"))
+            start = end
+        name_offsets = arrays.pop()
+        blob = view[start:]
+        graph = cls.__new__(cls)
+        (
+            graph.ids,
+            graph.parents,
+            graph.child_offsets,
+            graph.child_targets,
+            graph.descendant_offsets,
+            graph.descendant_targets,
+        ) = arrays
+        names = []
+        for i in range(size):
+            first, last = name_offsets[i], name_offsets[i + 1]
+            names.append(str(blob[first:last], "utf-8"))
+        graph.names = tuple(names)
+        graph._buffer = buffer
+        graph._attach(index, version if has_version else None)
+        return graph
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, role_id):
+        return role_id in self._positions
+
+    def _slice(self, offsets, targets, role_id):
+        pos = self._positions[role_id]
+        start, end = offsets[pos], offsets[pos + 1]
+        return [self.ids[i] for i in targets[start:end]]
+
+    def children(self, role_id):
+        """Return the ids of the direct children of ``role_id``."""
+        return self._slice(self.child_offsets, self.child_targets, role_id)
+
+    def descendants(self, role_id):
+        """Return the ids of ``role_id`` and all of its descendants."""
+        return self._slice(
+            self.descendant_offsets, self.descendant_targets, role_id
+        )
+
+    def ancestors(self, role_id):
+        """Return the ids of ``role_id`` and its ancestors, from the role
+        itself up to the root.
+        """
+        ancestors = []
+        seen = set()
+        pos = self._positions.get(role_id, -1)
+        while pos >= 0 and pos not in seen:
+            seen.add(pos)
+            ancestors.append(self.ids[pos])
+            pos = self.parents[pos]
+        return ancestors
+
+    def descendant_mask(self, role_id):
+        """Return the bitmask of ``role_id`` and all of its descendants."""
+        mask = self._masks.get(role_id)
+        if mask is None:
+            pos = self._positions.get(role_id)
+            if pos is None:
+                return 0
+            mask = 0
+            start = self.descendant_offsets[pos]
+            end = self.descendant_offsets[pos + 1]
+            for i in self.descendant_targets[start:end]:
+                mask |= 1 << self.bits[i]
+            self._masks[role_id] = mask
+        return mask
+
+    def effective_mask(self, role_ids):
+        """Return the bitmask of everything reachable from ``role_ids``."""
+        mask = 0
+        for role_id in role_ids:
+            mask |= self.descendant_mask(role_id)
+        return mask
+
+
+def _csr(lists):
+    offsets = array("l", [0])
+    targets = array("l")
+    for items in lists:
+        targets.extend(items)
+        offsets.append(len(targets))
+    return offsets, targets
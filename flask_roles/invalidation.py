@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_roles.invalidation
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Watches writes to the role tables and tells the :class:`~flask_roles.Roles`
+    extensions which users' cached role sets went stale.
+
+    Both ORM flushes of the ``roles``/``groups`` relationships and direct
+    Core statements end up as ``INSERT``/``UPDATE``/``DELETE`` statements on
+    the association tables, so the listener works at the engine level.
+    Affected users are invalidated as soon as the statement runs and once
+    more when the transaction commits, so that a concurrent request cannot
+    re-cache the pre-commit state. When a
+    :class:`~flask_roles.RoleGeneration` is configured it is bumped once per
+    transaction, as part of that transaction, for other workers to notice;
+    writes to a :class:`~flask_roles.ScopedRoles` table naming their scopes
+    leave it alone.
+"""
+import weakref
+
+import sqlalchemy as sa
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql.dml import Delete, Insert, Update
+
+#: Returned by :meth:`Watcher.affected` when every entry must go
+ALL = object()
+
+#: Like :data:`ALL`, when the role hierarchy itself changed
+HIERARCHY = object()
+
+
+class Scoped(dict):
+    """Returned by :meth:`Watcher.affected` for writes to a
+    :class:`~flask_roles.ScopedRoles` table: maps each scope written to the
+    set of affected user ids, or to :data:`ALL`. A write that does not name
+    its scopes maps :data:`ALL` to :data:`ALL`.
+    """
+
+
+_PENDING = "flask_roles.pending"
+_BUMPED = "flask_roles.bumped"
+
+_watchers = weakref.WeakSet()
+
+
+def watch(watcher):
+    """Start feeding ``watcher`` the statements executed on any engine."""
+    if not event.contains(Engine, "after_execute", _after_execute):
+        event.listen(Engine, "after_execute", _after_execute, named=True)
+        event.listen(Engine, "commit", _commit)
+        event.listen(Engine, "rollback", _rollback)
+    _watchers.add(watcher)
+
+
+def param_rows(multiparams, params):
+    """Flatten the parameters of an execute call into a list of dicts."""
+    rows = []
+    for entry in multiparams:
+        if isinstance(entry, dict):
+            rows.append(entry)
+        elif isinstance(entry, (list, tuple)):
+            rows.extend(row for row in entry if isinstance(row, dict))
+    if params:
+        rows.append(params)
+    return rows
+
+
+def _after_execute(conn, clauseelement, multiparams, params, **kw):
+    if not isinstance(clauseelement, (Insert, Update, Delete)):
+        return
+    rows = None
+    for watcher in list(_watchers):
+        if rows is None:
+            rows = param_rows(multiparams, params)
+        affected = watcher.affected(conn, clauseelement, rows)
+        if not affected:
+            continue
+        watcher.invalidate(affected)
+        conn.info.setdefault(_PENDING, []).append((watcher, affected))
+
+        generation = watcher.generation
+        if generation is None or isinstance(affected, Scoped):
+            # Scoped entries are dropped per scope, without the generation
+            # moving every other entry on
+            continue
+        bump(conn, generation, hierarchy=affected is HIERARCHY)
+
+
+def bump(connection, generation, hierarchy=False):
+    """Bump ``generation`` in the transaction of ``connection``, once per
+    transaction: the keys move on at commit however often they are bumped.
+    """
+    bumped = connection.info.setdefault(_BUMPED, set())
+    if (generation, hierarchy) not in bumped:
+        bumped.add((generation, hierarchy))
+        generation.bump(connection, hierarchy=hierarchy)
+
+
+def uncommitted(connection):
+    """Return whether the transaction of ``connection`` bumped a generation.
+
+    Until it commits, the generation it reads back is its own: a rollback
+    hands the same value to the next transaction that bumps, with other
+    data behind it, so nothing read meanwhile may be kept under it.
+    """
+    return bool(connection.info.get(_BUMPED))
+
+
+def _commit(conn):
+    conn.info.pop(_BUMPED, None)
+    for watcher, affected in conn.info.pop(_PENDING, ()):
+        watcher.invalidate(affected)
+
+
+def _rollback(conn):
+    # Whatever the transaction read back of its own writes may have been
+    # cached in between, so the evictions are replayed just as on commit
+    conn.info.pop(_BUMPED, None)
+    for watcher, affected in conn.info.pop(_PENDING, ()):
+        watcher.invalidate(affected)
+
+
+class Watcher(object):
+    """Maps statements on the tables of a :class:`~flask_roles.schema.Schema`
+    to the ids of the users whose effective roles they change.
+
+    :param schema: the discovered role tables
+    :param invalidate: callable receiving a set of user ids or :data:`ALL`
+    :param generation: optional :class:`~flask_roles.RoleGeneration` to bump
+    """
+
+    def __init__(self, schema, invalidate, generation=None):
+        self.schema = schema
+        self.invalidate = invalidate
+        self.generation = generation
+
+    def affected(self, conn, statement, rows):
+        """Return the set of affected user ids, :data:`ALL`,
+        :data:`HIERARCHY` or ``None``.
+        """
+        table = statement.table
+        schema = self.schema
+
+        if table is schema.role_table:
+            return self._hierarchy(statement, rows)
+
+        for association in (schema.user_role, schema.user_group):
+            if association is not None and table is association[0]:
+                return self._values(statement, rows, association[1])
+
+        if schema.group_group is not None and table is schema.group_group[0]:
+            return ALL
+
+        if schema.scopes is not None and table is schema.scopes.table:
+            return self._scoped(statement, rows)
+
+        if schema.grants is not None and table is schema.grants.table:
+            return self._values(statement, rows, table.c.user_id)
+
+        if schema.group_role is not None and table is schema.group_role[0]:
+            group_ids = self._values(statement, rows, schema.group_role[1])
+            if group_ids is ALL:
+                return ALL
+            closure = getattr(schema.group_model, "__group_closure__", None)
+            if closure is not None:
+                group_ids = closure.descendant_ids(group_ids)
+            user_group, user_id, group_id = schema.user_group
+            members = conn.execute(
+                sa.select([user_id]).where(group_id.in_(group_ids))
+            )
+            return {row[0] for row in members}
+        return None
+
+    def _hierarchy(self, statement, rows):
+        # A new child of a held role, a rename, re-parenting or a delete can
+        # change the effective roles of anyone. A new root role, or an
+        # update of other columns, changes nobody's.
+        if isinstance(statement, Delete):
+            return HIERARCHY
+        if getattr(statement, "select", None) is not None:
+            return HIERARCHY
+        inline = statement.parameters
+        if isinstance(inline, dict):
+            rows = rows + [inline]
+        elif inline is not None:
+            rows = rows + list(inline)
+        if not rows:
+            return HIERARCHY
+        parent = self.schema.role_parent
+        if isinstance(statement, Insert):
+            columns = [] if parent is None else [parent]
+        else:
+            columns = [self.schema.role_name, parent]
+        for row in rows:
+            for key, value in row.items():
+                key = getattr(key, "key", key)
+                for column in columns:
+                    if column is None or key != column.key:
+                        continue
+                    if isinstance(statement, Update) or value is not None:
+                        return HIERARCHY
+        return None
+
+    @staticmethod
+    def _scoped(statement, rows):
+        # Like _values, but grouped by scope. Without a scope_id in every
+        # row any scope may have changed.
+        if isinstance(statement, Update) or not rows:
+            return Scoped({ALL: ALL})
+        changed = Scoped()
+        for row in rows:
+            if "scope_id" not in row:
+                return Scoped({ALL: ALL})
+            users = changed.setdefault(row["scope_id"], set())
+            if "user_id" not in row:
+                changed[row["scope_id"]] = ALL
+            elif users is not ALL:
+                users.add(row["user_id"])
+        return changed
+
+    @staticmethod
+    def _values(statement, rows, column):
+        # Flushes and executemany calls bind one value per row under the
+        # column key; anything else (INSERT .. SELECT, ad hoc WHERE clauses,
+        # UPDATEs) is treated as touching everybody.
+        if isinstance(statement, Update) or not rows:
+            return ALL
+        values = set()
+        for row in rows:
+            if column.key not in row:
+                return ALL
+            values.add(row[column.key])
+        return values
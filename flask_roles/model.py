@@ -1,10 +1,228 @@
+import sqlalchemy as sa
+from flask import current_app, has_app_context
+from sqlalchemy.orm import noload, object_session
+from sqlalchemy.orm.attributes import set_committed_value
+
+from . import bulk, transfer
+from .schema import hierarchy_columns
+
+
+def current_graph(obj):
+    """Return the :class:`~flask_roles.RoleGraph` of the current app's
+    ``Roles`` extension if ``ROLES_GRAPH`` is enabled, else ``None``.
+    """
+    if not has_app_context():
+        return None
+    roles = current_app.extensions.get("roles")
+    if roles is None or not roles.use_graph or roles.schema is None:
+        return None
+    session = object_session(obj)
+    if session is None:
+        return None
+    return roles.get_graph(session)
+
+
+def _graph_role_ids(graph, roles):
+    # None unless every role is persisted and present in the snapshot
+    ids = []
+    for role in roles:
+        identity = sa.inspect(role).identity
+        if identity is None or identity[0] not in graph:
+            return None
+        ids.append(identity[0])
+    return ids
+
+
+def walk_roles(roles):
+    """Yield every role in ``roles`` and all of their descendants once.
+
+    The hierarchy is walked depth first with an explicit stack, so a cycle
+    in ``parent_id`` or a very deep tree cannot exhaust the interpreter
+    stack. Roles already seen are skipped.
+
+    :param roles: iterable of root roles
+    """
+    seen = set()
+    stack = list(roles)
+    stack.reverse()
+    while stack:
+        role = stack.pop()
+        if role in seen:
+            continue
+        seen.add(role)
+        yield role
+        # Push in reverse so children come out in relationship order
+        stack.extend(reversed(role.children))
+
+
+def descendant_ids(role_model, seed):
+    """Return a ``WITH RECURSIVE`` select of the ids of the roles ``seed``
+    and all of their descendants, following the ``children`` relationship
+    of ``role_model``. ``UNION`` drops rows already found, so a cycle in
+    the hierarchy ends the recursion instead of looping.
+
+    :param role_model: the mapped role class
+    :param seed: role ids, or a select of them
+    """
+    role_id, parent = hierarchy_columns(role_model)
+    tree = (
+        sa.select([role_id.label("id")])
+        .where(role_id.in_(seed))
+        .cte("role_descendants", recursive=True)
+    )
+    tree = tree.union(sa.select([role_id]).where(parent == tree.c.id))
+    return sa.select([tree.c.id])
+
+
+def ancestor_ids(role_model, seed):
+    """Return a ``WITH RECURSIVE`` select of the ids of the roles ``seed``
+    and all of their ancestors, following the ``children`` relationship of
+    ``role_model`` upwards. Like :func:`descendant_ids`, a cycle ends the
+    recursion.
+
+    :param role_model: the mapped role class
+    :param seed: role ids, or a select of them
+    """
+    role_id, parent = hierarchy_columns(role_model)
+    tree = (
+        sa.select([role_id.label("id"), parent.label("parent_id")])
+        .where(role_id.in_(seed))
+        .cte("role_ancestors", recursive=True)
+    )
+    tree = tree.union(
+        sa.select([role_id, parent]).where(role_id == tree.c.parent_id)
+    )
+    return sa.select([tree.c.id])
+
+
+def load_descendants(roles):
+    """Load ``roles`` and all of their descendants with one ``WITH
+    RECURSIVE`` query (SQLite, PostgreSQL, MySQL 8) and fill in every
+    loaded role's ``children`` collection, ordered by primary key, so that
+    walking the hierarchy afterwards needs no lazy loads.
+
+    Returns ``False``, loading nothing, unless every role is persistent and
+    its model has a ``children`` list relationship.
+
+    :param roles: role objects from one session
+    """
+    roles = list(roles)
+    if not roles:
+        return True
+    role_model = type(roles[0])
+    columns = hierarchy_columns(role_model)
+    session = object_session(roles[0])
+    if columns is None or session is None:
+        return False
+    ids = []
+    for role in roles:
+        identity = sa.inspect(role).identity
+        if identity is None or object_session(role) is not session:
+            return False
+        ids.append(identity[0])
+
+    role_id, parent = columns
+    mapper = sa.inspect(role_model)
+    id_key = mapper.get_property_by_column(role_id).key
+    parent_key = mapper.get_property_by_column(parent).key
+    loaded = (
+        session.query(role_model)
+        # The collections are filled in below
+        .options(noload("children"))
+        .filter(role_id.in_(descendant_ids(role_model, ids)))
+        .order_by(role_id)
+        .all()
+    )
+    by_id = {getattr(role, id_key): role for role in loaded}
+    children = {role: [] for role in loaded}
+    for role in loaded:
+        parent_role = by_id.get(getattr(role, parent_key))
+        if parent_role is not None:
+            children[parent_role].append(role)
+    for role, kids in children.items():
+        set_committed_value(role, "children", kids)
+    return True
+
+
+def _load_roles(session, role_model, role_ids):
+    role_id = sa.inspect(role_model).primary_key[0]
+    return iter(
+        session.query(role_model)
+        .filter(role_id.in_(list(role_ids)))
+        .order_by(role_id)
+    )
+
+
 class RoleMixin(object):
+    @classmethod
+    def import_roles(cls, session, lines, batch_size=1000):
+        """Create roles from JSON Lines, resolving parents by name, with
+        batched ``INSERT`` statements. Returns the number of roles created.
+        See :func:`flask_roles.transfer.import_roles`.
+        """
+        return transfer.import_roles(session, cls, lines, batch_size)
+
+    @classmethod
+    def export_roles(cls, session, fp, columns=()):
+        """Write every role to ``fp`` as JSON Lines, parents first. Returns
+        the number of roles written. See
+        :func:`flask_roles.transfer.export_roles`.
+        """
+        return transfer.export_roles(session, cls, fp, columns)
+
     def get_children(self):
-        yield self
-        for child in self.children:
-            yield child
-            for grandchild in child.get_children():
-                yield grandchild
+        graph = current_graph(self)
+        role_ids = None if graph is None else _graph_role_ids(graph, [self])
+        if role_ids is not None:
+            # One query for the whole subtree instead of a walk
+            return _load_roles(
+                object_session(self),
+                type(self),
+                graph.descendants(role_ids[0]),
+            )
+        load_descendants([self])
+        return walk_roles([self])
+
+    def get_ancestors(self):
+        """Return this role and every role it inherits from, nearest first:
+        the roles whose holders effectively hold this one.
+        """
+        graph = current_graph(self)
+        role_ids = None if graph is None else _graph_role_ids(graph, [self])
+        session = object_session(self)
+        role_model = type(self)
+        closure = getattr(role_model, "__role_closure__", None)
+        columns = hierarchy_columns(role_model)
+        identity = sa.inspect(self).identity
+        if role_ids is not None:
+            ids = graph.ancestors(role_ids[0])
+        elif session is None or identity is None or columns is None:
+            ids = None
+        elif closure is not None:
+            ids = closure.ancestor_ids([identity[0]])
+        else:
+            ids = ancestor_ids(role_model, [identity[0]])
+        if ids is None:
+            # Not persisted: follow the parent attribute instead
+            ancestors = []
+            role = self
+            while role is not None and role not in ancestors:
+                ancestors.append(role)
+                role = getattr(role, "parent", None)
+            return ancestors
+
+        # One query, then order by following parent ids from this role
+        mapper = sa.inspect(role_model)
+        id_key = mapper.get_property_by_column(columns[0]).key
+        parent_key = mapper.get_property_by_column(columns[1]).key
+        loaded = session.query(role_model).filter(columns[0].in_(ids))
+        by_id = {getattr(role, id_key): role for role in loaded}
+        ancestors = []
+        role = self
+        while role is not None and role not in ancestors:
+            ancestors.append(role)
+            role = by_id.get(getattr(role, parent_key))
+        return ancestors
 
 
 class UserMixin(object):
@@ -15,17 +233,47 @@ class UserMixin(object):
         for role in roles:
             self.add_role(role)
 
+    @classmethod
+    def bulk_add_roles(cls, session, holders, roles, chunk_size=1000):
+        """Assign ``roles`` to many users (or groups) with set based
+        ``INSERT .. SELECT`` statements, skipping roles already held.
+        Returns the number of assignments added.
+        """
+        return bulk.assign_roles(session, cls, holders, roles, chunk_size)
+
+    @classmethod
+    def bulk_remove_roles(cls, session, holders, roles, chunk_size=1000):
+        """Revoke ``roles`` from many users (or groups) with set based
+        ``DELETE`` statements. Returns the number of assignments removed.
+        """
+        return bulk.revoke_roles(session, cls, holders, roles, chunk_size)
+
+    def _graph_role_ids(self):
+        graph = current_graph(self)
+        if graph is None:
+            return None, None
+        return graph, _graph_role_ids(graph, self.roles)
+
     def get_roles(self):
         # Traverse any role which has this role
         # as an ancestor
-        for role in self.roles:
-            yield role
-            for child_role in role.get_children():
-                yield child_role
+        graph, role_ids = self._graph_role_ids()
+        if role_ids is not None:
+            ids = set()
+            for role_id in role_ids:
+                ids.update(graph.descendants(role_id))
+            role_model = sa.inspect(type(self)).relationships["roles"]
+            return _load_roles(
+                object_session(self), role_model.mapper.class_, ids
+            )
+        load_descendants(self.roles)
+        return walk_roles(self.roles)
 
     def get_role_names(self):
-        for role in self.get_roles():
-            yield role.name
+        graph, role_ids = self._graph_role_ids()
+        if role_ids is not None:
+            return iter(graph.index.names(graph.effective_mask(role_ids)))
+        return (role.name for role in self.get_roles())
 
 
 class GroupMixin(UserMixin):
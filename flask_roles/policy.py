@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_roles.policy
+    ~~~~~~~~~~~~~~~~~~
+
+    Boolean role policies, such as ``admin or (editor and not suspended)``,
+    compiled to a short list of bitmask tests.
+"""
+import re
+
+_TOKENS = re.compile(r"\s*(?:(\()|(\))|([^\s()]+))")
+_KEYWORDS = ("and", "or", "not")
+_ANY = object()
+
+
+def any_of(*terms):
+    """Policy held when any of ``terms`` (role names or policies) is."""
+    return ("or", tuple(_term(term) for term in terms))
+
+
+def all_of(*terms):
+    """Policy held when all of ``terms`` (role names or policies) are."""
+    return ("and", tuple(_term(term) for term in terms))
+
+
+def not_(term):
+    """Policy held when ``term`` (a role name or policy) is not."""
+    return ("not", _term(term))
+
+
+def _term(term):
+    if isinstance(term, tuple):
+        return term
+    if term in _KEYWORDS:
+        raise ValueError("%r is not a role name" % term)
+    return ("role", term)
+
+
+def parse(text):
+    """Parse a policy expression into the tuples built by :func:`any_of`,
+    :func:`all_of` and :func:`not_`. ``not`` binds tighter than ``and``,
+    which binds tighter than ``or``; role names may use wildcards like
+    ``billing.*``.
+
+    :raises ValueError: on a syntax error
+    """
+    tokens = []
+    pos = 0
+    text = text.strip()
+    while pos < len(text):
+        match = _TOKENS.match(text, pos)
+        if match is None:  # pragma: no cover - every character matches
+            raise ValueError("Cannot parse policy %r" % text)
+        tokens.append(match.group(match.lastindex))
+        pos = match.end()
+    tokens.append(None)
+
+    def peek():
+        return tokens[0]
+
+    def take(expected=_ANY):
+        token = tokens.pop(0)
+        if expected is not _ANY and token != expected:
+            raise ValueError(
+                "Expected %r, found %r in policy %r" % (expected, token, text)
+            )
+        return token
+
+    def disjunction():
+        terms = [conjunction()]
+        while peek() == "or":
+            take()
+            terms.append(conjunction())
+        return terms[0] if len(terms) == 1 else ("or", tuple(terms))
+
+    def conjunction():
+        terms = [negation()]
+        while peek() == "and":
+            take()
+            terms.append(negation())
+        return terms[0] if len(terms) == 1 else ("and", tuple(terms))
+
+    def negation():
+        if peek() == "not":
+            take()
+            return ("not", negation())
+        if peek() == "(":
+            take()
+            term = disjunction()
+            take(")")
+            return term
+        token = take()
+        if token is None or token == ")" or token in _KEYWORDS:
+            raise ValueError("Expected a role name in policy %r" % text)
+        return ("role", token)
+
+    term = disjunction()
+    take(None)
+    return term
+
+
+def _dnf(term, negated=False):
+    # Disjunctive normal form: a list of clauses, each a list of
+    # (role name, negated) literals
+    kind = term[0]
+    if kind == "role":
+        return [[(term[1], negated)]]
+    if kind == "not":
+        return _dnf(term[1], not negated)
+    # De Morgan: a negated "and" is an "or" of negations and vice versa
+    if (kind == "or") != negated:
+        return [clause for part in term[1] for clause in _dnf(part, negated)]
+    clauses = [[]]
+    for part in term[1]:
+        clauses = [
+            clause + other
+            for clause in clauses
+            for other in _dnf(part, negated)
+        ]
+    return clauses
+
+
+class Policy(object):
+    """A policy compiled against a :class:`~flask_roles.RoleIndex`. Each
+    clause of its disjunctive normal form becomes a mask of roles that must
+    all be held, a mask of roles that must not be, and the wildcard
+    :class:`~flask_roles.bits.Prefix` nodes for both. Checking a role mask
+    is then a few integer operations per clause.
+
+    :param term: a policy expression string or tuple
+    :param index: the :class:`~flask_roles.RoleIndex` to compile with
+    """
+
+    __slots__ = ("source", "clauses")
+
+    def __init__(self, term, index):
+        self.source = term
+        if not isinstance(term, tuple):
+            term = parse(term)
+        clauses = []
+        for literals in _dnf(term):
+            required = forbidden = 0
+            need, avoid = [], []
+            for name, negated in literals:
+                if "*" in name:
+                    (avoid if negated else need).append(index.prefix(name))
+                elif negated:
+                    forbidden |= index.bit(name)
+                else:
+                    required |= index.bit(name)
+            if required & forbidden:
+                continue  # never satisfiable
+            clauses.append((required, forbidden, tuple(need), tuple(avoid)))
+        self.clauses = tuple(clauses)
+
+    def allows(self, mask):
+        """Return whether the role ``mask`` satisfies the policy."""
+        for required, forbidden, need, avoid in self.clauses:
+            if (
+                mask & required == required
+                and not mask & forbidden
+                and all(mask & prefix.mask for prefix in need)
+                and not any(mask & prefix.mask for prefix in avoid)
+            ):
+                return True
+        return False
+
+    def __repr__(self):
+        return "<Policy %r>" % (self.source,)
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_roles.provides
+    ~~~~~~~~~~~~~~~~~~~~
+
+    A Flask-Principal ``identity.provides`` set which only resolves the
+    user's roles once a permission check reads it.
+"""
+from collections.abc import MutableSet
+
+
+class LazyProvides(MutableSet):
+    """Set of needs whose role needs are computed on first read.
+
+    Needs added by other ``identity_loaded`` handlers are kept as they are
+    and do not trigger resolution. Membership tests, iteration and ``len``
+    do, exactly once.
+
+    :param load: callable returning the needs to add on first read
+    :param needs: needs the identity already provides
+    """
+
+    def __init__(self, load, needs=()):
+        self._load = load
+        self._needs = set(needs)
+
+    def _resolved(self):
+        if self._load is not None:
+            load, self._load = self._load, None
+            self._needs.update(load())
+        return self._needs
+
+    @property
+    def loaded(self):
+        """Whether the role needs have been resolved."""
+        return self._load is None
+
+    def __contains__(self, need):
+        return need in self._needs or need in self._resolved()
+
+    def __iter__(self):
+        return iter(self._resolved())
+
+    def __len__(self):
+        return len(self._resolved())
+
+    def add(self, need):
+        self._needs.add(need)
+
+    def discard(self, need):
+        self._resolved().discard(need)
+
+    def update(self, needs):
+        self._needs.update(needs)
+
+    def __repr__(self):
+        if self._load is not None:
+            return "<LazyProvides %r + roles>" % self._needs
+        return "<LazyProvides %r>" % self._needs
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_roles.schema
+    ~~~~~~~~~~~~~~~~~~
+
+    Discovers the association tables behind the ``roles`` and ``groups``
+    relationships of models using the mixins, so that role lookups can be
+    expressed as set based SQL instead of walking ORM collections.
+"""
+import sqlalchemy as sa
+
+
+def association(model, key):
+    """Return ``(table, local_column, remote_column)`` for the many to many
+    relationship ``key`` of ``model``, or ``None`` if it has no such
+    relationship.
+
+    :param model: mapped class, e.g. ``User``
+    :param key: relationship name, e.g. ``"roles"``
+    """
+    relationship = sa.inspect(model).relationships.get(key)
+    if relationship is None or relationship.secondary is None:
+        return None
+    return (
+        relationship.secondary,
+        relationship.synchronize_pairs[0][1],
+        relationship.secondary_synchronize_pairs[0][1],
+    )
+
+
+def related_model(model, key):
+    """Return the class on the other side of relationship ``key``."""
+    return sa.inspect(model).relationships[key].mapper.class_
+
+
+def hierarchy_columns(role_model):
+    """Return ``(id column, parent column)`` behind the ``children`` list
+    relationship of ``role_model``, or ``None`` if it has none.
+    """
+    children = sa.inspect(role_model).relationships.get("children")
+    if children is None or not children.uselist or children.lazy == "dynamic":
+        return None
+    return children.local_remote_pairs[0]
+
+
+def direct_role_pairs(model, ids):
+    """Select ``(holder_id, role_id)`` for every role assigned to the
+    ``model`` rows ``ids``, either directly, through unexpired
+    :class:`~flask_roles.ExpiringRoles` grants or through the groups they
+    belong to.
+
+    :param model: mapped class using :class:`~flask_roles.UserMixin`
+    :param ids: primary keys of ``model`` rows
+    """
+    table, holder_id, role_id = association(model, "roles")
+    selects = [
+        sa.select(
+            [holder_id.label("holder_id"), role_id.label("role_id")]
+        ).where(holder_id.in_(ids))
+    ]
+    grants = getattr(model, "__role_grants__", None)
+    if grants is not None:
+        selects.append(grants.active_pairs(ids))
+
+    groups = association(model, "groups")
+    if groups is not None:
+        user_group, user_id, group_id = groups
+        group_model = related_model(model, "groups")
+        group_role, role_group_id, group_role_id = association(
+            group_model, "roles"
+        )
+        closure = getattr(group_model, "__group_closure__", None)
+        if closure is None:
+            joined = group_role.join(user_group, group_id == role_group_id)
+        else:
+            # Roles of every group containing the holder's groups
+            c = closure.table.c
+            joined = user_group.join(
+                closure.table, c.descendant_id == group_id
+            ).join(group_role, role_group_id == c.ancestor_id)
+        selects.append(
+            sa.select(
+                [user_id.label("holder_id"), group_role_id.label("role_id")]
+            )
+            .select_from(joined)
+            .where(user_id.in_(ids))
+        )
+    return sa.union(*selects)
+
+
+def role_holder_ids(model, role_ids):
+    """Select the ids of the ``model`` rows holding any of ``role_ids``,
+    either directly or through the groups they belong to. This is
+    :func:`direct_role_pairs` read the other way round.
+
+    :param model: mapped class using :class:`~flask_roles.UserMixin`
+    :param role_ids: role ids, or a select of them
+    """
+    table, holder_id, role_id = association(model, "roles")
+    selects = [sa.select([holder_id]).where(role_id.in_(role_ids))]
+    grants = getattr(model, "__role_grants__", None)
+    if grants is not None:
+        selects.append(grants.active_holder_ids(role_ids))
+
+    groups = association(model, "groups")
+    if groups is not None:
+        user_group, user_id, group_id = groups
+        group_model = related_model(model, "groups")
+        group_role, role_group_id, group_role_id = association(
+            group_model, "roles"
+        )
+        closure = getattr(group_model, "__group_closure__", None)
+        if closure is None:
+            joined = group_role.join(user_group, group_id == role_group_id)
+        else:
+            # Members of every group nested in a group holding the role
+            c = closure.table.c
+            joined = group_role.join(
+                closure.table, c.ancestor_id == role_group_id
+            ).join(user_group, group_id == c.descendant_id)
+        selects.append(
+            sa.select([user_id])
+            .select_from(joined)
+            .where(group_role_id.in_(role_ids))
+        )
+    return sa.union(*selects)
+
+
+def direct_role_ids(model, ids):
+    """Select the ids of roles assigned to the ``model`` rows ``ids``, either
+    directly or through the groups they belong to.
+
+    :param model: mapped class using :class:`~flask_roles.UserMixin`
+    :param ids: primary keys of ``model`` rows
+    """
+    pairs = direct_role_pairs(model, ids).alias()
+    return sa.select([pairs.c.role_id])
+
+
+class Schema(object):
+    """The tables behind a user model using :class:`~flask_roles.UserMixin`,
+    discovered from its ``roles`` and (optional) ``groups`` relationships.
+
+    Each association is a ``(table, local_column, remote_column)`` tuple, or
+    ``None`` when the model has no such relationship.
+
+    :param user_model: the mapped user class
+    """
+
+    def __init__(self, user_model):
+        self.user_model = user_model
+        self.user_role = association(user_model, "roles")
+        self.user_group = association(user_model, "groups")
+        self.group_model = None
+        self.group_role = None
+        self.group_group = None
+        if self.user_group is not None:
+            self.group_model = related_model(user_model, "groups")
+            self.group_role = association(self.group_model, "roles")
+            self.group_group = association(self.group_model, "groups")
+
+        #: the :class:`~flask_roles.ScopedRoles` of the user model, if any
+        self.scopes = getattr(user_model, "__role_scopes__", None)
+        #: the :class:`~flask_roles.ExpiringRoles` of the user model, if any
+        self.grants = getattr(user_model, "__role_grants__", None)
+
+        self.role_model = related_model(user_model, "roles")
+        role_mapper = sa.inspect(self.role_model)
+        self.role_table = role_mapper.local_table
+        self.role_id = role_mapper.primary_key[0]
+        self.role_name = role_mapper.attrs["name"].columns[0]
+        self.role_parent = None
+        for column in self.role_table.c:
+            if any(fk.column is self.role_id for fk in column.foreign_keys):
+                self.role_parent = column
+                break
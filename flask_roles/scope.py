@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_roles.scope
+    ~~~~~~~~~~~~~~~~~
+
+    Role assignments which only apply within one scope, such as a tenant.
+"""
+import sqlalchemy as sa
+
+from .bulk import _ids
+
+
+class ScopedRoles(object):
+    """Maintains a ``(scope_id, user_id, role_id)`` table of role
+    assignments which only hold within one scope, e.g. the organisation a
+    request is made for::
+
+        class User(db.Model, flask_roles.UserMixin):
+            ...
+
+        scoped_roles = flask_roles.ScopedRoles(User, Role)
+        scoped_roles.grant(db.session, user, project_admin, org.id)
+
+        roles.has_any_role(user, "project.admin", scope=org.id)
+
+    Scoped roles add to the user's unscoped roles and are inherited down
+    the role hierarchy like them. The primary key leads with ``scope_id``,
+    so resolving a user's roles in one scope reads a single index range of
+    that scope's rows; a second index on ``(role_id, scope_id)`` serves
+    lookups by role.
+
+    Write through :meth:`grant`, :meth:`revoke` and :meth:`delete_scope` (or
+    statements binding the same columns) so that the extension can evict
+    just the affected users of the affected scope.
+
+    :param user_model: mapped class using :class:`~flask_roles.UserMixin`
+    :param role_model: the mapped role class
+    :param scope_type: column type of scope ids
+    :param name: table name, defaults to ``<user table>_role_scope``
+    """
+
+    def __init__(
+        self, user_model, role_model, scope_type=sa.Integer, name=None
+    ):
+        user_mapper = sa.inspect(user_model)
+        user_id = user_mapper.primary_key[0]
+        role_id = sa.inspect(role_model).primary_key[0]
+
+        self.user_model = user_model
+        self.role_model = role_model
+        name = name or "%s_role_scope" % user_mapper.local_table.name
+        self.table = sa.Table(
+            name,
+            user_mapper.local_table.metadata,
+            sa.Column("scope_id", scope_type, primary_key=True),
+            sa.Column(
+                "user_id",
+                user_id.type,
+                sa.ForeignKey(user_id),
+                primary_key=True,
+            ),
+            sa.Column(
+                "role_id",
+                role_id.type,
+                sa.ForeignKey(role_id),
+                primary_key=True,
+            ),
+            sa.Index("ix_%s_role_id" % name, "role_id", "scope_id"),
+        )
+        user_model.__role_scopes__ = self
+
+    def role_pairs(self, user_ids, scope_id):
+        """Select ``(holder_id, role_id)`` for the roles assigned to the
+        users ``user_ids`` in ``scope_id``.
+        """
+        c = self.table.c
+        return sa.select(
+            [c.user_id.label("holder_id"), c.role_id.label("role_id")]
+        ).where(sa.and_(c.scope_id == scope_id, c.user_id.in_(user_ids)))
+
+    def grant(self, session, user, role, scope_id):
+        """Assign ``role`` to ``user`` within ``scope_id``. Returns whether
+        the assignment was added, ``False`` if it already existed.
+
+        :param session: the SQLAlchemy session
+        :param user: user object or primary key
+        :param role: role object or primary key
+        :param scope_id: the scope the role holds in
+        """
+        session.flush()
+        (user_id,), (role_id,) = _ids([user]), _ids([role])
+        row = {"scope_id": scope_id, "user_id": user_id, "role_id": role_id}
+        c = self.table.c
+        exists = session.execute(
+            sa.select([c.role_id]).where(
+                sa.and_(
+                    c.scope_id == scope_id,
+                    c.user_id == user_id,
+                    c.role_id == role_id,
+                )
+            )
+        ).first()
+        if exists is not None:
+            return False
+        session.execute(self.table.insert(), row)
+        return True
+
+    def revoke(self, session, user, role, scope_id):
+        """Remove ``role`` from ``user`` within ``scope_id``. Returns
+        whether there was such an assignment.
+        """
+        session.flush()
+        (user_id,), (role_id,) = _ids([user]), _ids([role])
+        c = self.table.c
+        result = session.execute(
+            self.table.delete().where(
+                sa.and_(
+                    c.scope_id == sa.bindparam("scope_id"),
+                    c.user_id == sa.bindparam("user_id"),
+                    c.role_id == sa.bindparam("role_id"),
+                )
+            ),
+            {"scope_id": scope_id, "user_id": user_id, "role_id": role_id},
+        )
+        return result.rowcount > 0
+
+    def delete_scope(self, session, scope_id):
+        """Remove every assignment within ``scope_id``, e.g. when a tenant
+        is deleted. Returns the number of assignments removed.
+        """
+        session.flush()
+        c = self.table.c
+        result = session.execute(
+            self.table.delete().where(c.scope_id == sa.bindparam("scope_id")),
+            {"scope_id": scope_id},
+        )
+        return result.rowcount
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_roles.signals
+    ~~~~~~~~~~~~~~~~~~~
+
+    Blinker signals sent by the :class:`~flask_roles.Roles` extension when
+    ``ROLES_STATS`` is set. The sender is the extension.
+"""
+from flask.signals import Namespace
+
+_signals = Namespace()
+
+#: A user's effective roles were resolved. Receivers get ``user_id``,
+#: ``seconds``, ``roles`` (the number of effective roles) and ``statements``
+#: (SQL statements issued while resolving).
+roles_resolved = _signals.signal("roles-resolved")
+
+#: A user's roles were found in the cache. Receivers get ``user_id``.
+role_cache_hit = _signals.signal("role-cache-hit")
+
+#: A user's roles were not in the cache. Receivers get ``user_id``.
+role_cache_miss = _signals.signal("role-cache-miss")
+
+#: The cache pushed an entry out to make room. Receivers get ``key``.
+role_cache_evicted = _signals.signal("role-cache-evicted")
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_roles.stats
+    ~~~~~~~~~~~~~~~~~
+
+    Counters of the work spent on role resolution, in aggregate and per
+    request.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_local = threading.local()
+_listening = False
+
+
+def _count_statement(conn, cursor, statement, parameters, context, many):
+    # Only statements issued while a resolution is being timed count
+    if getattr(_local, "statements", None) is not None:
+        _local.statements += 1
+
+
+class RoleStats(object):
+    """Aggregate counters of role resolution, kept by
+    :class:`~flask_roles.Roles` when ``ROLES_STATS`` is set. The same
+    counters for the current request are in :meth:`request`.
+
+    ``resolutions``
+        users whose roles were computed instead of read from the cache
+    ``resolve_seconds``
+        wall time spent computing them
+    ``roles_traversed``
+        effective roles found by those resolutions
+    ``statements``
+        SQL statements issued while resolving
+    ``cache_hits``, ``cache_misses``
+        role cache lookups
+    ``cache_evictions``
+        entries the cache pushed out to make room
+    """
+
+    FIELDS = (
+        "resolutions",
+        "resolve_seconds",
+        "roles_traversed",
+        "statements",
+        "cache_hits",
+        "cache_misses",
+        "cache_evictions",
+    )
+
+    def __init__(self):
+        global _listening
+        self._lock = threading.Lock()
+        self._totals = dict.fromkeys(self.FIELDS, 0)
+        if not _listening:
+            _listening = True
+            event.listen(Engine, "before_cursor_execute", _count_statement)
+
+    def add(self, **counts):
+        """Add ``counts`` to the totals and to those of the request."""
+        with self._lock:
+            for field, count in counts.items():
+                self._totals[field] += count
+        if has_app_context():
+            current = g.get("_roles_stats")
+            if current is None:
+                current = g._roles_stats = dict.fromkeys(self.FIELDS, 0)
+            for field, count in counts.items():
+                current[field] += count
+
+    @contextmanager
+    def timing(self):
+        """Time the block, count the SQL statements it issues and yield a
+        dict receiving ``seconds`` and ``statements`` when it exits.
+        """
+        outer = getattr(_local, "statements", None)
+        _local.statements = 0
+        result = {}
+        start = time.perf_counter()
+        try:
+            yield result
+        finally:
+            result["seconds"] = time.perf_counter() - start
+            result["statements"] = _local.statements
+            _local.statements = (
+                None if outer is None else outer + result["statements"]
+            )
+
+    def snapshot(self):
+        """Return a copy of the totals, with the cache ``hit_rate``."""
+        with self._lock:
+            totals = dict(self._totals)
+        lookups = totals["cache_hits"] + totals["cache_misses"]
+        totals["hit_rate"] = totals["cache_hits"] / lookups if lookups else 0.0
+        return totals
+
+    def request(self):
+        """Return the counters of the current request (or app context)."""
+        current = g.get("_roles_stats") if has_app_context() else None
+        return dict(current or dict.fromkeys(self.FIELDS, 0))
+
+    def reset(self):
+        """Zero the totals."""
+        with self._lock:
+            self._totals = dict.fromkeys(self.FIELDS, 0)
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_roles.transfer
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Streaming export and import of the role hierarchy as JSON Lines.
+"""
+import json
+from collections import defaultdict
+from itertools import groupby
+
+import sqlalchemy as sa
+
+from .schema import hierarchy_columns
+
+
+def _role_columns(role_model):
+    # (table, id column, name column, parent column)
+    mapper = sa.inspect(role_model)
+    role_id = mapper.primary_key[0]
+    columns = hierarchy_columns(role_model)
+    if columns is not None:
+        parent = columns[1]
+    else:
+        parent = next(
+            column
+            for column in mapper.local_table.c
+            if any(fk.column is role_id for fk in column.foreign_keys)
+        )
+    return mapper.local_table, role_id, mapper.attrs["name"].columns[0], parent
+
+
+def export_roles(session, role_model, fp, columns=()):
+    """Write every role to ``fp`` as one JSON object per line, such as
+    ``{"name": "protected.view", "parent": "protected"}``, parents before
+    their children. Returns the number of roles written.
+
+    :param session: the SQLAlchemy session
+    :param role_model: the mapped role class
+    :param fp: text file to write to
+    :param columns: names of further role table columns to include
+    :raises ValueError: if the hierarchy has a cycle, before writing
+    """
+    table, role_id, name, parent = _role_columns(role_model)
+    extra = [table.c[column] for column in columns]
+    rows = session.execute(
+        sa.select([role_id, name, parent] + extra).order_by(role_id)
+    ).fetchall()
+
+    names = {row[0]: row[1] for row in rows}
+    children = defaultdict(list)
+    stack = []
+    for row in rows:
+        if row[2] in names:
+            children[row[2]].append(row)
+        else:
+            stack.append(row)
+    # Depth first from the roots, children in id order
+    stack.reverse()
+    ordered = []
+    while stack:
+        row = stack.pop()
+        ordered.append(row)
+        stack.extend(reversed(children.pop(row[0], ())))
+    if children:
+        cycle = sorted(row[1] for rows in children.values() for row in rows)
+        raise ValueError("The role hierarchy has a cycle through %s" % cycle)
+
+    for row in ordered:
+        record = {"name": row[1], "parent": names.get(row[2])}
+        record.update(zip(columns, row[3:]))
+        fp.write(json.dumps(record))
+        fp.write("\n")
+    return len(ordered)
+
+
+def import_roles(session, role_model, lines, batch_size=1000):
+    """Create roles from JSON Lines written by :func:`export_roles`,
+    reading ``lines`` incrementally. Parents are resolved by name, against
+    existing roles and the roles imported before them. Lines may come in
+    any order: a role whose parent is not there yet waits until the batch
+    creating its parent has been inserted. Roles which already exist are
+    skipped. Returns the number of roles created.
+
+    Roles are inserted ``batch_size`` at a time with plain ``INSERT``
+    statements, and a :class:`~flask_roles.RoleClosure` is rebuilt once at
+    the end. The :class:`~flask_roles.RoleGraph` snapshot is rebuilt when
+    it is next used.
+
+    :param session: the SQLAlchemy session
+    :param role_model: the mapped role class
+    :param lines: a text file, or any iterable of lines
+    :param batch_size: number of roles per ``INSERT``
+    :raises ValueError: if some parents never appear, or form a cycle; roll
+        back the session to discard the roles inserted so far
+    """
+    session.flush()
+    table, role_id, name, parent = _role_columns(role_model)
+    ids = dict(session.execute(sa.select([name, role_id])).fetchall())
+    queued = set()
+    ready = []
+    waiting = defaultdict(list)
+    created = 0
+
+    def insert(batch):
+        values = []
+        for record in batch:
+            row = {
+                table.c[key].key: value
+                for key, value in record.items()
+                if key not in ("name", "parent")
+            }
+            row[name.key] = record["name"]
+            row[parent.key] = ids.get(record.get("parent"))
+            values.append(row)
+        # One executemany per set of columns
+        values.sort(key=lambda row: sorted(row))
+        for _, rows in groupby(values, key=lambda row: sorted(row)):
+            session.execute(table.insert(), list(rows))
+        names = [record["name"] for record in batch]
+        ids.update(
+            session.execute(
+                sa.select([name, role_id]).where(name.in_(names))
+            ).fetchall()
+        )
+        for record in batch:
+            ready.extend(waiting.pop(record["name"], ()))
+
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        record = json.loads(line)
+        role_name = record["name"]
+        for key in record:
+            if key not in ("name", "parent") and key not in table.c:
+                raise ValueError("%s has no column %r" % (table.name, key))
+        if role_name in ids or role_name in queued:
+            continue
+        queued.add(role_name)
+        parent_name = record.get("parent")
+        if parent_name is None or parent_name in ids:
+            ready.append(record)
+        else:
+            waiting[parent_name].append(record)
+        if len(ready) >= batch_size:
+            batch, ready[:] = ready[:batch_size], ready[batch_size:]
+            insert(batch)
+            created += len(batch)
+
+    while ready:
+        batch, ready[:] = ready[:batch_size], ready[batch_size:]
+        insert(batch)
+        created += len(batch)
+    if waiting:
+        raise ValueError(
+            "Unknown or cyclic parent roles: %s" % sorted(waiting)
+        )
+
+    closure = getattr(role_model, "__role_closure__", None)
+    if closure is not None and created:
+        closure.rebuild(session.connection())
+    return created
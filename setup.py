@@ -22,6 +22,7 @@ setup(
     packages=["flask_roles"],
     zip_safe=False,
     include_package_data=True,
+    install_requires=["Flask<2.3", "SQLAlchemy<1.4"],
     extras_require={
         "testing": [
             "pip-tools == 4.5.1",
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from unittest import TestCase
+
+from flask_roles.bits import RoleIndex
+
+
+class RoleIndexTest(TestCase):
+    def test_names_are_interned_in_first_seen_order(self):
+        index = RoleIndex()
+        self.assertEqual(index.bit("admin"), 1)
+        self.assertEqual(index.bit("protected"), 2)
+        self.assertEqual(index.bit("admin"), 1)
+        self.assertEqual(len(index), 2)
+
+    def test_mask_round_trip(self):
+        index = RoleIndex()
+        names = frozenset(["admin", "protected", "protected.view"])
+        mask = index.mask(names)
+        self.assertEqual(mask, 0b111)
+        self.assertEqual(index.names(mask), names)
+        self.assertEqual(index.names(0), frozenset())
+
+    def test_decoded_sets_are_shared(self):
+        index = RoleIndex()
+        mask = index.mask(["admin", "protected"])
+        self.assertIs(index.names(mask), index.names(mask))
+
+    def test_requirement_check_is_a_bitwise_and(self):
+        index = RoleIndex()
+        held = index.mask(["protected", "protected.view"])
+        self.assertTrue(held & index.mask(["protected.view"]))
+        self.assertFalse(held & index.mask(["protected.create"]))
+
+    def test_wildcards_match_by_prefix(self):
+        index = RoleIndex()
+        billing = index.prefix("billing.*")
+        invoice = index.prefix("billing.invoice.*")
+        held = index.mask(["billing.invoice.read", "reports"])
+
+        self.assertTrue(held & billing.mask)
+        self.assertTrue(held & invoice.mask)
+        self.assertFalse(held & index.prefix("billing.refund.*").mask)
+        self.assertTrue(held & index.prefix("*").mask)
+        # "billing" itself is not below billing
+        self.assertFalse(index.mask(["billing"]) & billing.mask)
+
+        # Nodes pick up names interned after they were looked up
+        refunds = index.prefix("billing.refund.*")
+        self.assertTrue(index.mask(["billing.refund.create"]) & refunds.mask)
+
+    def test_compile_splits_names_and_patterns(self):
+        index = RoleIndex()
+        mask, prefixes = index.compile(["admin", "billing.*"])
+        self.assertEqual(mask, index.bit("admin"))
+        self.assertEqual(prefixes, (index.prefix("billing.*"),))
+        for pattern in ("billing*", "*.read", "billing.*.read", ".*"):
+            with self.assertRaises(ValueError):
+                index.prefix(pattern)
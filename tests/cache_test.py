@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+from unittest import TestCase
+
+from flask_roles.cache import LRUCache, SharedCache
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key, (None,))[0]
+
+    def set(self, key, value, timeout):
+        self.data[key] = (value, timeout)
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+class LRUCacheTest(TestCase):
+    def test_get_and_set(self):
+        cache = LRUCache()
+        self.assertIsNone(cache.get("missing"))
+        cache.set(1, frozenset(["admin"]))
+        self.assertEqual(cache.get(1), frozenset(["admin"]))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = LRUCache(maxsize=2)
+        cache.set(1, "a")
+        cache.set(2, "b")
+        cache.get(1)
+        cache.set(3, "c")
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get(1), "a")
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(3), "c")
+
+    def test_evictions_are_counted_and_reported(self):
+        evicted = []
+        cache = LRUCache(maxsize=1, on_evict=evicted.append)
+        cache.set(1, "a")
+        cache.set(2, "b")
+        cache.set(2, "c")
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(evicted, [1])
+
+    def test_entries_expire_after_ttl(self):
+        clock = FakeClock()
+        cache = LRUCache(ttl=10, clock=clock)
+        cache.set(1, "a")
+        clock.now = 9.9
+        self.assertEqual(cache.get(1), "a")
+        clock.now = 10
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(len(cache), 0)
+
+    def test_delete_and_clear(self):
+        cache = LRUCache()
+        cache.set(1, "a")
+        cache.set(2, "b")
+        cache.delete(1)
+        cache.delete(1)
+        self.assertIsNone(cache.get(1))
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_entries_expire_after_a_shorter_ttl(self):
+        clock = FakeClock()
+        cache = LRUCache(ttl=10, clock=clock)
+        cache.set(1, "a", 2.5)
+        cache.set(2, "b", 60)
+        clock.now = 2.5
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.get(2), "b")
+        clock.now = 10
+        self.assertIsNone(cache.get(2))
+
+
+class SharedCacheTest(TestCase):
+    def test_ttl_is_rounded_down_to_whole_seconds(self):
+        client = FakeClient()
+        cache = SharedCache(client, ttl=300)
+        cache.set(1, frozenset(["admin"]))
+        cache.set(2, frozenset(["admin"]), 59.9)
+        cache.set(3, frozenset(["admin"]), 0.5)
+        self.assertEqual(
+            client.data,
+            {
+                "flask_roles:1": (frozenset(["admin"]), 300),
+                "flask_roles:2": (frozenset(["admin"]), 59),
+            },
+        )
@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+from unittest import TestCase
+
+import flask_roles
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+
+db = SQLAlchemy()
+
+
+class Role(db.Model, flask_roles.RoleMixin):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(80), unique=True, nullable=False)
+    parent_id = db.Column(db.Integer, db.ForeignKey("role.id"))
+    children = db.relationship(
+        "Role", order_by=id, backref=db.backref("parent", remote_side=[id]),
+    )
+
+    def __repr__(self):
+        return "<Role %r>" % self.name
+
+
+role_closure = flask_roles.RoleClosure(Role)
+
+
+class User(db.Model, flask_roles.UserMixin):
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(80), unique=True)
+    roles = db.relationship("Role", secondary="user_role")
+    groups = db.relationship(
+        "Group", secondary="user_group", backref=db.backref("users"),
+    )
+
+
+class UserRole(db.Model):
+    user_id = db.Column(
+        db.Integer, db.ForeignKey("user.id"), primary_key=True,
+    )
+    role_id = db.Column(
+        db.Integer, db.ForeignKey("role.id"), primary_key=True,
+    )
+
+
+class Group(db.Model, flask_roles.GroupMixin):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(80), unique=True, nullable=False)
+    roles = db.relationship("Role", secondary="group_role")
+    groups = db.relationship(
+        "Group",
+        secondary="group_group",
+        primaryjoin="Group.id == GroupGroup.member_id",
+        secondaryjoin="Group.id == GroupGroup.group_id",
+        backref="members",
+    )
+
+    def __repr__(self):
+        return "<Group %r>" % self.name
+
+
+group_closure = flask_roles.GroupClosure(Group)
+
+
+class GroupGroup(db.Model):
+    group_id = db.Column(
+        db.Integer, db.ForeignKey("group.id"), primary_key=True,
+    )
+    member_id = db.Column(
+        db.Integer, db.ForeignKey("group.id"), primary_key=True,
+    )
+
+
+class GroupRole(db.Model):
+    group_id = db.Column(
+        db.Integer, db.ForeignKey("group.id"), primary_key=True,
+    )
+    role_id = db.Column(
+        db.Integer, db.ForeignKey("role.id"), primary_key=True,
+    )
+
+
+class UserGroup(db.Model):
+    group_id = db.Column(
+        db.Integer, db.ForeignKey("group.id"), primary_key=True,
+    )
+    user_id = db.Column(
+        db.Integer, db.ForeignKey("user.id"), primary_key=True,
+    )
+
+
+class ClosureTestCase(TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///:memory:"
+        self.app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+        db.init_app(self.app)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def mk_role(self, name, parent=None):
+        role = Role(name=name, parent=parent)
+        db.session.add(role)
+        db.session.commit()
+        return role
+
+
+class RoleClosureTest(ClosureTestCase):
+    def closure(self):
+        c = role_closure.table.c
+        rows = db.session.execute(
+            db.select([c.ancestor_id, c.descendant_id, c.depth])
+        )
+        names = {role.id: role.name for role in Role.query}
+        return {(names[a], names[d], depth) for a, d, depth in rows}
+
+    def test_insert_links_all_ancestors(self):
+        admin = self.mk_role("admin")
+        protected = self.mk_role("protected", parent=admin)
+        self.mk_role("protected.view", parent=protected)
+
+        self.assertEqual(
+            self.closure(),
+            {
+                ("admin", "admin", 0),
+                ("protected", "protected", 0),
+                ("protected.view", "protected.view", 0),
+                ("admin", "protected", 1),
+                ("protected", "protected.view", 1),
+                ("admin", "protected.view", 2),
+            },
+        )
+
+    def test_insert_parent_and_child_in_one_flush(self):
+        admin = Role(name="admin")
+        db.session.add(Role(name="protected", parent=admin))
+        db.session.commit()
+
+        self.assertIn(("admin", "protected", 1), self.closure())
+
+    def test_reparent_moves_subtree(self):
+        admin = self.mk_role("admin")
+        reports = self.mk_role("reports")
+        protected = self.mk_role("protected", parent=admin)
+        self.mk_role("protected.view", parent=protected)
+
+        protected.parent = reports
+        db.session.commit()
+
+        closure = self.closure()
+        self.assertNotIn(("admin", "protected", 1), closure)
+        self.assertNotIn(("admin", "protected.view", 2), closure)
+        self.assertIn(("reports", "protected", 1), closure)
+        self.assertIn(("reports", "protected.view", 2), closure)
+
+    def test_reparent_under_descendant_is_rejected(self):
+        admin = self.mk_role("admin")
+        protected = self.mk_role("protected", parent=admin)
+
+        admin.parent = protected
+        with self.assertRaises(ValueError):
+            db.session.commit()
+
+    def test_delete_detaches_role(self):
+        admin = self.mk_role("admin")
+        protected = self.mk_role("protected", parent=admin)
+        self.mk_role("protected.view", parent=protected)
+
+        db.session.delete(protected)
+        db.session.commit()
+
+        self.assertEqual(
+            self.closure(),
+            {("admin", "admin", 0), ("protected.view", "protected.view", 0)},
+        )
+
+    def test_rebuild(self):
+        admin = self.mk_role("admin")
+        self.mk_role("protected", parent=admin)
+        expected = self.closure()
+
+        db.session.execute(role_closure.table.delete())
+        role_closure.rebuild(db.session.connection())
+
+        self.assertEqual(self.closure(), expected)
+
+    def test_get_role_names_via_user_and_groups(self):
+        admin = self.mk_role("admin")
+        protected = self.mk_role("protected", parent=admin)
+        self.mk_role("protected.view", parent=protected)
+        reports = self.mk_role("reports")
+        self.mk_role("unused")
+
+        user = User(username="test_user")
+        group = Group(name="reporters")
+        user.add_role(protected)
+        group.add_role(reports)
+        user.groups.append(group)
+        db.session.add(user)
+        db.session.commit()
+
+        self.assertEqual(
+            role_closure.get_role_names(user),
+            {"protected", "protected.view", "reports"},
+        )
+        self.assertEqual(role_closure.get_role_names(group), {"reports"})
+
+    def test_batch_resolution_uses_closure(self):
+        roles = flask_roles.Roles(user_model=User)
+        admin = self.mk_role("admin")
+        self.mk_role("protected", parent=admin)
+        reports = self.mk_role("reports")
+
+        user = User(username="test_user")
+        other_user = User(username="other_user")
+        group = Group(name="reporters")
+        user.add_role(admin)
+        group.add_role(reports)
+        other_user.groups.append(group)
+        db.session.add_all([user, other_user])
+        db.session.commit()
+
+        self.assertEqual(
+            dict(roles.iter_role_names([user, other_user])),
+            {
+                user.id: frozenset(["admin", "protected"]),
+                other_user.id: frozenset(["reports"]),
+            },
+        )
+
+    def test_holders_use_closure(self):
+        roles = flask_roles.Roles(user_model=User)
+        admin = self.mk_role("admin")
+        protected = self.mk_role("protected", parent=admin)
+        view = self.mk_role("protected.view", parent=protected)
+
+        user = User(username="test_user")
+        other_user = User(username="other_user")
+        user.add_role(admin)
+        other_user.add_role(view)
+        db.session.add_all([user, other_user])
+        db.session.commit()
+
+        self.assertEqual(view.get_ancestors(), [view, protected, admin])
+        self.assertEqual(list(roles.holders(db.session, "protected")), [user])
+        self.assertEqual(
+            list(roles.holders(db.session, "protected.view")),
+            [user, other_user],
+        )
+
+
+class GroupClosureTest(ClosureTestCase):
+    def mk_group(self, name, *containers):
+        group = Group(name=name, groups=list(containers))
+        db.session.add(group)
+        db.session.commit()
+        return group
+
+    def group_closure(self):
+        c = group_closure.table.c
+        rows = db.session.execute(db.select([c.ancestor_id, c.descendant_id]))
+        names = {group.id: group.name for group in Group.query}
+        return {(names[a], names[d]) for a, d in rows}
+
+    def test_group_nesting_links_all_containers(self):
+        staff = self.mk_group("staff")
+        engineering = self.mk_group("engineering", staff)
+        self.mk_group("backend", engineering)
+
+        self.assertEqual(
+            self.group_closure(),
+            {
+                ("staff", "staff"),
+                ("engineering", "engineering"),
+                ("backend", "backend"),
+                ("staff", "engineering"),
+                ("engineering", "backend"),
+                ("staff", "backend"),
+            },
+        )
+
+    def test_group_nesting_cycle_is_rejected(self):
+        staff = self.mk_group("staff")
+        engineering = self.mk_group("engineering", staff)
+
+        staff.groups.append(engineering)
+        with self.assertRaises(ValueError):
+            db.session.commit()
+
+    def test_group_unnesting_keeps_other_paths(self):
+        staff = self.mk_group("staff")
+        engineering = self.mk_group("engineering", staff)
+        backend = self.mk_group("backend", engineering, staff)
+
+        backend.groups.remove(staff)
+        db.session.commit()
+        self.assertIn(("staff", "backend"), self.group_closure())
+
+        engineering.groups.remove(staff)
+        db.session.commit()
+        self.assertNotIn(("staff", "backend"), self.group_closure())
+
+        db.session.delete(engineering)
+        db.session.commit()
+        self.assertEqual(
+            self.group_closure(), {("staff", "staff"), ("backend", "backend")}
+        )
+
+    def test_group_unnesting_only_touches_groups_below(self):
+        staff = self.mk_group("staff")
+        engineering = self.mk_group("engineering", staff)
+        platform = self.mk_group("platform", staff)
+        backend = self.mk_group("backend", engineering, platform)
+        self.mk_group("oncall", backend)
+        sales = self.mk_group("sales", staff)
+        self.mk_group("emea", sales)
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        db.event.listen(db.engine, "before_cursor_execute", record)
+        backend.groups.remove(engineering)
+        db.session.commit()
+        db.event.remove(db.engine, "before_cursor_execute", record)
+        # Neither the whole nesting table nor every group was read
+        self.assertFalse(
+            [s for s in statements if "WHERE" not in s], statements
+        )
+
+        closure = self.group_closure()
+        self.assertNotIn(("engineering", "oncall"), closure)
+        self.assertIn(("staff", "oncall"), closure)
+        self.assertIn(("staff", "emea"), closure)
+        group_closure.rebuild(db.session.connection())
+        self.assertEqual(self.group_closure(), closure)
+
+    def test_group_closures_share_one_listener(self):
+        self.assertTrue(
+            db.event.contains(
+                db.engine.__class__,
+                "after_execute",
+                flask_roles.closure._after_execute,
+            )
+        )
+        self.assertIn(group_closure, flask_roles.closure._group_closures)
+
+    def test_group_roles_are_inherited_by_nested_members(self):
+        roles = flask_roles.Roles(user_model=User)
+        staff = self.mk_group("staff")
+        engineering = self.mk_group("engineering", staff)
+        backend = self.mk_group("backend", engineering)
+        staff.add_role(self.mk_role("intranet"))
+        engineering.add_role(self.mk_role("deploy"))
+
+        user = User(username="test_user", groups=[backend])
+        db.session.add(user)
+        db.session.commit()
+
+        self.assertEqual(
+            [group.name for group in group_closure.get_groups(user)],
+            ["staff", "engineering", "backend"],
+        )
+        self.assertEqual(
+            roles.get_role_names(user), frozenset(["intranet", "deploy"])
+        )
+        self.assertEqual(
+            role_closure.get_role_names(backend),
+            {"intranet", "deploy"},
+        )
+
+        # Roles granted to a container reach cached members
+        staff.add_role(self.mk_role("payroll"))
+        db.session.commit()
+        self.assertEqual(
+            roles.get_role_names(user),
+            frozenset(["intranet", "deploy", "payroll"]),
+        )
+
+    def test_holders_through_nested_groups(self):
+        roles = flask_roles.Roles(user_model=User)
+        staff = self.mk_group("staff")
+        engineering = self.mk_group("engineering", staff)
+        backend = self.mk_group("backend", engineering)
+        self.mk_group("sales")
+        staff.add_role(self.mk_role("intranet"))
+
+        user = User(username="test_user", groups=[backend])
+        db.session.add_all([user, User(username="other_user")])
+        db.session.commit()
+
+        self.assertEqual(list(roles.holders(db.session, "intranet")), [user])
+        self.assertEqual(
+            list(roles.holders(db.session, "intranet", Group)),
+            [staff, engineering, backend],
+        )
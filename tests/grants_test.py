@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+import flask_roles
+from flask import Flask
+from flask_roles.cache import LRUCache
+from flask_sqlalchemy import SQLAlchemy
+
+db = SQLAlchemy()
+
+
+class Role(db.Model, flask_roles.RoleMixin):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(80), unique=True, nullable=False)
+    parent_id = db.Column(db.Integer, db.ForeignKey("role.id"))
+    children = db.relationship(
+        "Role", order_by=id, backref=db.backref("parent", remote_side=[id])
+    )
+
+
+class User(db.Model, flask_roles.UserMixin):
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(80), unique=True)
+    roles = db.relationship("Role", secondary="user_role")
+
+
+class UserRole(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    role_id = db.Column(db.Integer, db.ForeignKey("role.id"), primary_key=True)
+
+
+expiring_roles = flask_roles.ExpiringRoles(User, Role)
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class ExpiringRolesTest(TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///:memory:"
+        self.app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+        db.init_app(self.app)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+
+        self.clock = FakeClock()
+        self.cache = LRUCache(ttl=300, clock=self.clock)
+        self.roles = flask_roles.Roles(user_model=User, cache=self.cache)
+        self.on_call = Role(name="on_call")
+        self.pager = Role(name="on_call.pager", parent=self.on_call)
+        self.user = User(username="test_user")
+        self.other_user = User(username="other_user")
+        db.session.add_all([self.on_call, self.pager, self.user])
+        db.session.add(self.other_user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def expire_grants(self):
+        # Let the grants lapse behind the extension's back, like time would
+        cursor = db.session.connection().connection.cursor()
+        cursor.execute(
+            "UPDATE user_role_grant SET expires_at = ?",
+            (str(datetime(2000, 1, 1)),),
+        )
+
+    def test_cache_entries_end_with_the_earliest_grant(self):
+        expiring_roles.grant(
+            db.session, self.user, self.on_call, timedelta(seconds=60)
+        )
+        db.session.commit()
+
+        self.assertEqual(
+            self.roles.get_role_names(self.user),
+            frozenset(["on_call", "on_call.pager"]),
+        )
+        self.assertEqual(
+            self.roles.get_role_names(self.other_user), frozenset()
+        )
+        expires = self.cache._data[self.user.id][1]
+        self.assertTrue(59 < expires - self.clock.now <= 60)
+        self.assertEqual(self.cache._data[self.other_user.id][1], 300)
+
+        self.expire_grants()
+        self.assertTrue(self.roles.has_any_role(self.user, "on_call"))
+        self.clock.now = expires
+        self.assertFalse(self.roles.has_any_role(self.user, "on_call"))
+
+    def test_grant_and_revoke_drop_cache_entries(self):
+        self.assertEqual(self.roles.get_role_names(self.user), frozenset())
+        expiring_roles.grant(
+            db.session, self.user, self.pager, timedelta(hours=1)
+        )
+        db.session.commit()
+        self.assertEqual(
+            self.roles.get_role_names(self.user), frozenset(["on_call.pager"])
+        )
+        self.assertEqual(
+            list(self.roles.holders(db.session, "on_call.pager")), [self.user]
+        )
+
+        self.assertTrue(
+            expiring_roles.revoke(db.session, self.user, self.pager)
+        )
+        self.assertFalse(
+            expiring_roles.revoke(db.session, self.user, self.pager)
+        )
+        db.session.commit()
+        self.assertEqual(self.roles.get_role_names(self.user), frozenset())
+
+    def test_expired_grants_are_ignored_and_purged(self):
+        expiring_roles.grant(
+            db.session, self.user, self.on_call, timedelta(hours=1)
+        )
+        expiring_roles.grant(
+            db.session, self.other_user, self.pager, timedelta(hours=1)
+        )
+        db.session.commit()
+        self.expire_grants()
+        expiring_roles.grant(
+            db.session, self.other_user, self.on_call, timedelta(hours=1)
+        )
+
+        self.assertEqual(
+            dict(self.roles.iter_role_names([self.user, self.other_user])),
+            {
+                self.user.id: frozenset(),
+                self.other_user.id: frozenset(["on_call", "on_call.pager"]),
+            },
+        )
+        self.assertEqual(
+            list(self.roles.holders(db.session, "on_call")), [self.other_user]
+        )
+        self.assertEqual(expiring_roles.purge(db.session), 2)
+        self.assertEqual(db.session.query(expiring_roles.table).count(), 1)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+from unittest import TestCase
+
+from flask_roles import RoleGraph, RoleIndex
+
+ROWS = [
+    (1, "admin", None),
+    (2, "protected", 1),
+    (3, "protected.view", 2),
+    (4, "protected.create", 2),
+    (5, "reports", None),
+]
+
+
+class RoleGraphTest(TestCase):
+    def test_children_and_descendants(self):
+        graph = RoleGraph(ROWS, RoleIndex())
+        self.assertEqual(len(graph), 5)
+        self.assertEqual(graph.children(1), [2])
+        self.assertEqual(graph.children(2), [3, 4])
+        self.assertEqual(graph.children(3), [])
+        self.assertEqual(graph.descendants(1), [1, 2, 3, 4])
+        self.assertEqual(graph.descendants(5), [5])
+        self.assertIn(5, graph)
+        self.assertNotIn(6, graph)
+
+    def test_masks_share_the_index_bit_space(self):
+        index = RoleIndex()
+        graph = RoleGraph(ROWS, index)
+        self.assertEqual(
+            index.names(graph.descendant_mask(2)),
+            frozenset(["protected", "protected.view", "protected.create"]),
+        )
+        self.assertEqual(
+            index.names(graph.effective_mask([3, 5])),
+            frozenset(["protected.view", "reports"]),
+        )
+        self.assertEqual(graph.effective_mask([42]), 0)
+
+    def test_cycle_terminates(self):
+        graph = RoleGraph([(1, "a", 2), (2, "b", 1)], RoleIndex())
+        self.assertEqual(graph.descendants(1), [1, 2])
+        self.assertEqual(graph.descendants(2), [1, 2])
+        self.assertEqual(graph.ancestors(1), [1, 2])
+
+    def test_ancestors(self):
+        graph = RoleGraph(ROWS, RoleIndex())
+        self.assertEqual(graph.ancestors(3), [3, 2, 1])
+        self.assertEqual(graph.ancestors(5), [5])
+        self.assertEqual(graph.ancestors(42), [])
+
+    def test_dump_and_open(self):
+        graph = RoleGraph(ROWS + [(6, "résumé", 5)], RoleIndex(), 7)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "roles.graph")
+            graph.dump(path)
+            index = RoleIndex()
+            index.bit("reports")  # bit positions differ between processes
+            mapped = RoleGraph.open(path, index)
+            self.assertEqual(mapped.version, 7)
+            self.assertEqual(mapped.names, graph.names)
+            self.assertEqual(mapped.children(2), [3, 4])
+            self.assertEqual(mapped.descendants(1), [1, 2, 3, 4])
+            self.assertEqual(
+                index.names(mapped.effective_mask([5])),
+                frozenset(["reports", "résumé"]),
+            )
+
+            with open(path, "r+b") as f:
+                f.truncate(os.path.getsize(path) - 1)
+            with self.assertRaises(ValueError):
+                RoleGraph.open(path, RoleIndex())
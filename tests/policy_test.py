@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from unittest import TestCase
+
+from flask_roles.bits import RoleIndex
+from flask_roles.policy import Policy, all_of, any_of, not_, parse
+
+
+class PolicyTest(TestCase):
+    def test_parse_precedence(self):
+        self.assertEqual(
+            parse("a or b and not c"),
+            (
+                "or",
+                (
+                    ("role", "a"),
+                    ("and", (("role", "b"), ("not", ("role", "c")))),
+                ),
+            ),
+        )
+        self.assertEqual(
+            parse("(a or b) and c"), all_of(any_of("a", "b"), "c")
+        )
+
+    def test_parse_errors(self):
+        for text in ("", "a and", "(a or b", "a b", "not", "a or )"):
+            with self.assertRaises(ValueError):
+                parse(text)
+
+    def test_negations_are_pushed_down(self):
+        index = RoleIndex()
+        policy = Policy("not (a or b)", index)
+        self.assertEqual(
+            policy.clauses, ((0, index.mask(["a", "b"]), (), ()),)
+        )
+        self.assertTrue(policy.allows(0))
+        self.assertFalse(policy.allows(index.mask(["b"])))
+
+    def test_contradictions_are_dropped(self):
+        index = RoleIndex()
+        policy = Policy(all_of("a", not_("a")), index)
+        self.assertEqual(policy.clauses, ())
+        self.assertFalse(policy.allows(index.mask(["a"])))
+
+    def test_allows(self):
+        index = RoleIndex()
+        policy = Policy("admin or (editor and not suspended)", index)
+        self.assertTrue(policy.allows(index.mask(["admin", "suspended"])))
+        self.assertTrue(policy.allows(index.mask(["editor"])))
+        self.assertFalse(policy.allows(index.mask(["editor", "suspended"])))
+        self.assertFalse(policy.allows(0))
+
+    def test_wildcards(self):
+        index = RoleIndex()
+        policy = Policy("billing.* and not billing.frozen.*", index)
+        self.assertTrue(policy.allows(index.mask(["billing.read"])))
+        self.assertFalse(
+            policy.allows(index.mask(["billing.read", "billing.frozen.all"]))
+        )
+        # Roles interned after compiling still match the wildcard
+        self.assertTrue(policy.allows(index.mask(["billing.write"])))
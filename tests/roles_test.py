@@ -1,12 +1,18 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import os
+import tempfile
+import threading
 from unittest import TestCase
 
 import flask_login
+import sqlalchemy as sa
 import flask_roles
 import werkzeug
 from flask import Flask, Response, current_app, request
 from flask_login import LoginManager, current_user, login_required, login_user
 from flask_principal import (
+    AnonymousIdentity,
     Identity,
     Permission,
     Principal,
@@ -18,6 +24,7 @@ from flask_sqlalchemy import SQLAlchemy
 
 db = SQLAlchemy()
 principal = Principal()
+role_generation = flask_roles.RoleGeneration(db.metadata)
 
 
 @identity_loaded.connect
@@ -35,6 +42,35 @@ def on_identity_loaded(sender, identity):
             identity.provides.add(RoleNeed(role_name))
 
 
+class FakeAsyncSession(object):
+    """Awaitable execute() over a synchronous session, like AsyncSession"""
+
+    def __init__(self, session):
+        self.session = session
+        self.statements = 0
+
+    async def execute(self, statement):
+        self.statements += 1
+        await asyncio.sleep(0)
+        return self.session.execute(statement).fetchall()
+
+
+class DictCacheClient(object):
+    """Stands in for a cachelib client shared between workers"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, timeout=None):
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
 class Role(db.Model, flask_roles.RoleMixin):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(80), unique=True, nullable=False)
@@ -108,6 +144,9 @@ class UserGroup(db.Model):
     )
 
 
+scoped_roles = flask_roles.ScopedRoles(User, Role)
+
+
 class RolesTest(TestCase):
     TESTING = True
 
@@ -172,18 +211,18 @@ class RolesTest(TestCase):
             user = db.session.query(User).get(int(id))
             return user
 
-    def init_roles(self, via_factory=True):
+    def init_roles(self, via_factory=True, **kwargs):
         if via_factory:
-            self.roles = flask_roles.Roles()
+            self.roles = flask_roles.Roles(**kwargs)
             self.roles.init_app(self.app)
         else:
-            self.roles = flask_roles.Roles(self.app)
+            self.roles = flask_roles.Roles(self.app, **kwargs)
 
     def init_db(self):
         db.init_app(self.app)
 
-    def init_app_routes(self, via_factory=True):
-        self.init_roles(via_factory)
+    def init_app_routes(self, via_factory=True, **kwargs):
+        self.init_roles(via_factory, **kwargs)
         # Public resource
         @self.app.route("/login", methods=["post"])
         def login():
@@ -548,3 +587,1381 @@ class RolesTest(TestCase):
             self.assertEqual(
                 self.client.open("/protected/create").data, b"create protected"
             )
+
+    def test_get_children_yields_each_role_once(self):
+        with self.app.test_request_context():
+            admin_role = self.mk_role("admin")
+            protected_role = self.mk_role("protected", parent=admin_role)
+            self.mk_role("protected.view", parent=protected_role)
+            self.mk_role("protected.create", parent=protected_role)
+            self.mk_role("reports", parent=admin_role)
+
+            self.assertEqual(
+                [role.name for role in admin_role.get_children()],
+                [
+                    "admin",
+                    "protected",
+                    "protected.view",
+                    "protected.create",
+                    "reports",
+                ],
+            )
+
+    def test_get_children_with_a_cycle(self):
+        with self.app.test_request_context():
+            admin_role = self.mk_role("admin")
+            protected_role = self.mk_role("protected", parent=admin_role)
+            admin_role.parent = protected_role
+            db.session.commit()
+
+            self.assertEqual(
+                [role.name for role in admin_role.get_children()],
+                ["admin", "protected"],
+            )
+
+    def test_get_roles_yields_each_role_once(self):
+        with self.app.test_request_context():
+            user = self.mk_user()
+            admin_role = self.mk_role("admin")
+            protected_role = self.mk_role("protected", parent=admin_role)
+            self.mk_role("protected.view", parent=protected_role)
+            # protected is held directly and through admin
+            user.add_roles([admin_role, protected_role])
+            db.session.commit()
+
+            self.assertEqual(
+                list(user.get_role_names()),
+                ["admin", "protected", "protected.view"],
+            )
+
+    def test_roles_caches_role_names(self):
+        self.init_app_routes()
+        with self.app.test_request_context():
+            user = self.mk_user()
+            group = self.mk_group("creators")
+            user.groups.append(group)
+            user.add_role(self.mk_role("protected.view"))
+            group.add_role(self.mk_role("protected.create"))
+            db.session.commit()
+
+            names = self.roles.get_role_names(user)
+            self.assertEqual(
+                names, frozenset(["protected.view", "protected.create"])
+            )
+            self.assertIs(self.roles.get_role_names(user), names)
+            self.assertEqual(
+                self.roles.get_role_names(current_user), frozenset()
+            )
+
+    def test_roles_cache_invalidated_by_user_role_changes(self):
+        self.init_app_routes()
+        with self.app.test_request_context():
+            user = self.mk_user()
+            other_user = self.mk_user("other_user")
+            view_role = self.mk_role("protected.view")
+            self.assertEqual(self.roles.get_role_names(user), frozenset())
+            self.assertEqual(
+                self.roles.get_role_names(other_user), frozenset()
+            )
+
+            user.add_role(view_role)
+            db.session.commit()
+            self.assertEqual(
+                self.roles.get_role_names(user),
+                frozenset(["protected.view"]),
+            )
+            # Only the user whose assignments changed was evicted
+            self.assertEqual(len(self.roles.cache), 2)
+
+            user.roles.remove(view_role)
+            db.session.commit()
+            self.assertEqual(self.roles.get_role_names(user), frozenset())
+
+    def test_roles_cache_invalidated_by_rollback(self):
+        self.init_app_routes()
+        with self.app.test_request_context():
+            user = self.mk_user()
+            user_id = user.id
+            view_role = self.mk_role("protected.view")
+            db.session.commit()
+            self.assertEqual(self.roles.get_role_names(user), frozenset())
+
+            user.add_role(view_role)
+            db.session.flush()
+            # Read back inside the transaction, and cached
+            self.assertEqual(
+                self.roles.get_role_names(user),
+                frozenset(["protected.view"]),
+            )
+            db.session.rollback()
+            self.assertEqual(
+                self.roles.get_role_names(User.query.get(user_id)),
+                frozenset(),
+            )
+
+    def test_roles_cache_invalidated_by_group_changes(self):
+        self.init_app_routes()
+        with self.app.test_request_context():
+            user = self.mk_user()
+            group = self.mk_group("creators")
+            create_role = self.mk_role("protected.create")
+            self.assertEqual(self.roles.get_role_names(user), frozenset())
+
+            user.groups.append(group)
+            db.session.commit()
+            self.assertEqual(self.roles.get_role_names(user), frozenset())
+
+            group.add_role(create_role)
+            db.session.commit()
+            self.assertEqual(
+                self.roles.get_role_names(user),
+                frozenset(["protected.create"]),
+            )
+
+    def test_roles_cache_invalidated_by_reparenting(self):
+        self.init_app_routes()
+        with self.app.test_request_context():
+            user = self.mk_user()
+            admin_role = self.mk_role("admin")
+            view_role = self.mk_role("protected.view")
+            user.add_role(admin_role)
+            db.session.commit()
+            self.assertEqual(
+                self.roles.get_role_names(user), frozenset(["admin"])
+            )
+
+            view_role.parent = admin_role
+            db.session.commit()
+            self.assertEqual(
+                self.roles.get_role_names(user),
+                frozenset(["admin", "protected.view"]),
+            )
+
+    def test_roles_generation_bumped_once_per_transaction(self):
+        self.init_roles(user_model=User, generation=role_generation)
+        with self.app.test_request_context():
+            user = self.mk_user()
+            roles = [
+                self.mk_role("protected.view"),
+                self.mk_role("protected.create"),
+            ]
+            # New root roles change nobody's effective roles
+            self.assertEqual(role_generation.versions(db.session), (0, 0))
+
+            user.add_roles(roles)
+            db.session.commit()
+            self.assertEqual(role_generation.versions(db.session), (1, 0))
+
+            # A new child, a rename and a delete each moved both counters
+            child = self.mk_role("protected.view.own", parent=roles[0])
+            self.assertEqual(role_generation.versions(db.session), (2, 1))
+            child.name = "protected.view.mine"
+            db.session.commit()
+            self.assertEqual(role_generation.versions(db.session), (3, 2))
+            db.session.delete(child)
+            db.session.commit()
+            self.assertEqual(role_generation.versions(db.session), (4, 3))
+
+    def test_roles_new_root_role_keeps_the_cache(self):
+        self.app.config["ROLES_GRAPH"] = True
+        self.init_roles(user_model=User)
+        with self.app.test_request_context():
+            user = self.mk_user()
+            user.add_role(self.mk_role("admin"))
+            db.session.commit()
+            self.assertEqual(
+                self.roles.get_role_names(user), frozenset(["admin"])
+            )
+            graph = self.roles.graph
+
+            reports = self.mk_role("reports")
+            self.assertIs(self.roles.graph, graph)
+            self.assertIn(user.id, self.roles.cache._data)
+
+            # The snapshot is rebuilt once a user holds the new role
+            user.add_role(reports)
+            db.session.commit()
+            self.assertEqual(
+                self.roles.get_role_names(user),
+                frozenset(["admin", "reports"]),
+            )
+            self.assertIsNot(self.roles.graph, graph)
+
+    def test_roles_shared_cache_sees_other_workers_changes(self):
+        client = DictCacheClient()
+        self.init_roles(
+            user_model=User,
+            cache=flask_roles.SharedCache(client),
+            generation=role_generation,
+        )
+        with self.app.test_request_context():
+            user_id = self.mk_user().id
+            role_id = self.mk_role("protected.view").id
+
+        with self.app.test_request_context():
+            user = db.session.query(User).get(user_id)
+            self.assertEqual(self.roles.get_role_names(user), frozenset())
+            generation = role_generation.current(db.session)
+            self.assertEqual(
+                list(client.data),
+                ["flask_roles:%d:%d" % (generation, user_id)],
+            )
+
+        with self.app.test_request_context():
+            # Another worker grants the role. Its statements never reach
+            # this process, only the generation it bumped does.
+            cursor = db.session.connection().connection.cursor()
+            cursor.execute(
+                "INSERT INTO user_role (user_id, role_id) VALUES (?, ?)",
+                (user_id, role_id),
+            )
+            cursor.execute(
+                "UPDATE role_generation SET generation = generation + 1"
+            )
+            db.session.commit()
+
+        with self.app.test_request_context():
+            user = db.session.query(User).get(user_id)
+            self.assertEqual(
+                self.roles.get_role_names(user),
+                frozenset(["protected.view"]),
+            )
+
+    def test_roles_rolled_back_generation_never_cached(self):
+        self.app.config["ROLES_GRAPH"] = True
+        client = DictCacheClient()
+        self.init_roles(
+            user_model=User,
+            cache=flask_roles.SharedCache(client),
+            generation=role_generation,
+        )
+        with self.app.test_request_context():
+            user_id = self.mk_user().id
+            other_id = self.mk_user("other_user").id
+            admin_id = self.mk_role("admin").id
+            self.mk_role("reports", parent=Role.query.get(admin_id))
+            db.session.commit()
+
+        with self.app.test_request_context():
+            user = User.query.get(user_id)
+            user.add_role(Role.query.get(admin_id))
+            db.session.flush()
+            # Read back under the generation this transaction bumped to
+            self.assertEqual(
+                self.roles.get_role_names(user),
+                frozenset(["admin", "reports"]),
+            )
+            self.assertEqual(client.data, {})
+            self.assertIsNone(self.roles.graph)
+            db.session.rollback()
+
+        with self.app.test_request_context():
+            # The next commit hands out the same generation
+            User.query.get(other_id).add_role(Role.query.get(admin_id))
+            db.session.commit()
+            self.assertEqual(
+                self.roles.get_role_names(User.query.get(user_id)),
+                frozenset(),
+            )
+
+    def test_roles_generation_read_for_detached_users(self):
+        self.init_roles(user_model=User, generation=role_generation)
+        with self.app.test_request_context():
+            user = self.mk_user()
+            user.add_role(self.mk_role("protected.view"))
+            db.session.commit()
+            # Loaded before detaching, to resolve from
+            user.roles, user.groups
+            db.session.expunge(user)
+            with self.assertRaises(ValueError):
+                self.roles.get_role_names(user)
+
+            self.roles.session = db.session
+            self.assertEqual(
+                self.roles.get_role_names(user),
+                frozenset(["protected.view"]),
+            )
+
+    def test_roles_generation_read_per_request(self):
+        client = DictCacheClient()
+        self.init_roles(
+            user_model=User,
+            cache=flask_roles.SharedCache(client),
+            generation=role_generation,
+            session=db.session,
+        )
+        with self.app.test_request_context():
+            user_id = self.mk_user().id
+            role_id = self.mk_role("protected.view").id
+
+        def behind_the_back(statement, bump=True):
+            # Like another worker, or a change outside SQLAlchemy
+            cursor = db.session.connection().connection.cursor()
+            cursor.execute(statement, (user_id, role_id))
+            if bump:
+                cursor.execute(
+                    "UPDATE role_generation SET generation = generation + 1"
+                )
+            db.session.commit()
+
+        grant = "INSERT INTO user_role (user_id, role_id) VALUES (?, ?)"
+        revoke = "DELETE FROM user_role WHERE user_id = ? AND role_id = ?"
+        view = frozenset(["protected.view"])
+
+        # A long lived app context, like a CLI command or task worker
+        with self.app.app_context():
+            user = db.session.query(User).get(user_id)
+            self.assertEqual(self.roles.get_role_names(user), frozenset())
+            behind_the_back(grant)
+            self.assertEqual(self.roles.get_role_names(user), view)
+
+            # Requests inside it read the generation once each
+            with self.app.test_request_context():
+                self.assertEqual(self.roles.get_role_names(user), view)
+                behind_the_back(revoke)
+                self.assertEqual(self.roles.get_role_names(user), view)
+            with self.app.test_request_context():
+                self.assertEqual(
+                    self.roles.get_role_names(user), frozenset()
+                )
+
+            # invalidate() bumps the generation, since entries can only be
+            # reached through it
+            behind_the_back(grant, bump=False)
+            self.assertEqual(self.roles.get_role_names(user), frozenset())
+            before = role_generation.current(db.session)
+            self.roles.invalidate()
+            db.session.commit()
+            self.assertEqual(role_generation.current(db.session), before + 1)
+            self.assertEqual(self.roles.get_role_names(user), view)
+
+    def test_roles_role_checks_use_bitmasks(self):
+        self.init_roles()
+        with self.app.test_request_context():
+            user = self.mk_user()
+            protected_role = self.mk_role("protected")
+            self.mk_role("protected.view", parent=protected_role)
+            self.mk_role("protected.create")
+            user.add_role(protected_role)
+            db.session.commit()
+
+            mask = self.roles.get_role_mask(user)
+            self.assertIsInstance(mask, int)
+            self.assertEqual(
+                self.roles.index.names(mask),
+                frozenset(["protected", "protected.view"]),
+            )
+            self.assertEqual(list(self.roles.cache._data.values())[0][0], mask)
+
+            self.assertTrue(
+                self.roles.has_any_role(
+                    user, "protected.view", "protected.create"
+                )
+            )
+            self.assertFalse(self.roles.has_any_role(user, "protected.create"))
+            self.assertTrue(
+                self.roles.has_all_roles(user, "protected", "protected.view")
+            )
+            self.assertFalse(
+                self.roles.has_all_roles(
+                    user, "protected.view", "protected.create"
+                )
+            )
+            self.assertFalse(
+                self.roles.has_any_role(current_user, "protected.view")
+            )
+
+    def test_roles_identity_loaded_handler(self):
+        self.app.config["ROLES_IDENTITY_LOADED"] = True
+        self.init_roles(user_model=User)
+        with self.app.test_request_context():
+            user = self.mk_user()
+            group = self.mk_group("creators")
+            user.groups.append(group)
+            protected_role = self.mk_role("protected")
+            self.mk_role("protected.view", parent=protected_role)
+            user.add_role(protected_role)
+            group.add_role(self.mk_role("protected.create"))
+            db.session.commit()
+            user_id = user.id
+
+        identity_loaded.disconnect(on_identity_loaded)
+        try:
+            with self.app.test_request_context():
+                user = db.session.query(User).get(user_id)
+                login_user(user)
+                identity = Identity(user_id)
+                statements = []
+                sa.event.listen(
+                    db.engine,
+                    "before_cursor_execute",
+                    lambda *args: statements.append(args[2]),
+                )
+                identity_loaded.send(self.app, identity=identity)
+                # Nothing is resolved until a permission reads provides
+                self.assertEqual(statements, [])
+                self.assertTrue(
+                    Permission(RoleNeed("protected.view")).allows(identity)
+                )
+                self.assertEqual(len(statements), 1)
+
+                self.assertIs(identity.user, user)
+                self.assertEqual(
+                    identity.provides,
+                    {
+                        RoleNeed("protected"),
+                        RoleNeed("protected.view"),
+                        RoleNeed("protected.create"),
+                    },
+                )
+                self.assertEqual(len(statements), 1)
+        finally:
+            identity_loaded.connect(on_identity_loaded)
+
+    def test_roles_iter_role_names_in_chunks(self):
+        self.init_roles(user_model=User)
+        with self.app.test_request_context():
+            group = self.mk_group("creators")
+            protected_role = self.mk_role("protected")
+            self.mk_role("protected.view", parent=protected_role)
+            group.add_role(self.mk_role("protected.create"))
+            users = [self.mk_user("user%d" % i) for i in range(5)]
+            users[0].add_role(protected_role)
+            users[1].groups.append(group)
+            users[2].add_role(protected_role)
+            users[2].groups.append(group)
+            db.session.commit()
+            user_ids = [user.id for user in users]
+
+            statements = []
+            sa.event.listen(
+                db.engine,
+                "before_cursor_execute",
+                lambda *args: statements.append(args[2]),
+            )
+            resolved = list(
+                self.roles.iter_role_names(
+                    iter(user_ids), db.session, chunk_size=2
+                )
+            )
+            # One query for the hierarchy, then one per chunk
+            self.assertEqual(len(statements), 4)
+            self.assertEqual(
+                resolved,
+                [
+                    (user_ids[0], frozenset(["protected", "protected.view"])),
+                    (user_ids[1], frozenset(["protected.create"])),
+                    (
+                        user_ids[2],
+                        frozenset(
+                            ["protected", "protected.view", "protected.create"]
+                        ),
+                    ),
+                    (user_ids[3], frozenset()),
+                    (user_ids[4], frozenset()),
+                ],
+            )
+            self.assertEqual(
+                dict(self.roles.iter_role_names(users)), dict(resolved)
+            )
+
+    def test_bulk_add_roles_skips_roles_already_held(self):
+        self.init_roles(user_model=User)
+        with self.app.test_request_context():
+            users = [self.mk_user("user%d" % i) for i in range(3)]
+            view_role = self.mk_role("protected.view")
+            create_role = self.mk_role("protected.create")
+            users[0].add_role(view_role)
+            db.session.commit()
+            self.assertEqual(self.roles.get_role_names(users[1]), frozenset())
+
+            holders = [users[0], users[1].id, users[2]]
+            roles = [view_role, create_role.id]
+            statements = []
+            sa.event.listen(
+                db.engine,
+                "before_cursor_execute",
+                lambda *args: statements.append(args[2]),
+            )
+            added = User.bulk_add_roles(
+                db.session, holders, roles, chunk_size=2
+            )
+            self.assertEqual(added, 5)
+            self.assertEqual(
+                [s.split()[0] for s in statements], ["INSERT", "INSERT"]
+            )
+            db.session.commit()
+
+            for user in users:
+                self.assertEqual(
+                    sorted(role.name for role in user.roles),
+                    ["protected.create", "protected.view"],
+                )
+            self.assertEqual(
+                self.roles.get_role_names(users[1]),
+                frozenset(["protected.view", "protected.create"]),
+            )
+
+    def test_bulk_remove_roles_from_groups(self):
+        with self.app.test_request_context():
+            groups = [self.mk_group("group%d" % i) for i in range(2)]
+            view_role = self.mk_role("protected.view")
+            create_role = self.mk_role("protected.create")
+            for group in groups:
+                group.add_roles([view_role, create_role])
+            db.session.commit()
+
+            removed = Group.bulk_remove_roles(db.session, groups, [view_role])
+            db.session.commit()
+
+            self.assertEqual(removed, 2)
+            for group in groups:
+                self.assertEqual(group.roles, [create_role])
+
+    def test_roles_graph_resolution(self):
+        self.app.config["ROLES_GRAPH"] = True
+        self.init_roles(user_model=User, generation=role_generation)
+        with self.app.test_request_context():
+            user = self.mk_user()
+            admin_role = self.mk_role("admin")
+            view_role = self.mk_role("protected.view", parent=admin_role)
+            reports_role = self.mk_role("reports")
+            user.add_role(admin_role)
+            db.session.commit()
+
+            self.assertEqual(
+                self.roles.get_role_names(user),
+                frozenset(["admin", "protected.view"]),
+            )
+            graph = self.roles.graph
+            self.assertIsNotNone(graph)
+            self.assertEqual(
+                sorted(user.get_role_names()), ["admin", "protected.view"]
+            )
+            self.assertEqual(
+                [role.name for role in admin_role.get_children()],
+                ["admin", "protected.view"],
+            )
+
+            # Re-parenting swaps in a fresh snapshot
+            view_role.parent = reports_role
+            db.session.commit()
+            self.assertEqual(
+                self.roles.get_role_names(user), frozenset(["admin"])
+            )
+            self.assertIsNot(self.roles.graph, graph)
+            # The old snapshot is left untouched for readers still holding it
+            self.assertEqual(
+                graph.descendants(admin_role.id),
+                [admin_role.id, view_role.id],
+            )
+
+    def test_roles_require_decorators(self):
+        self.init_app_routes()
+        roles = self.roles
+
+        @self.app.route("/fast/any")
+        @roles.require_any("protected.view", "protected.create")
+        def fast_any():
+            return Response("any")
+
+        @self.app.route("/fast/all")
+        @roles.require_all("protected.view", "protected.create")
+        def fast_all():
+            return Response("all")
+
+        with self.app.test_request_context():
+            user = self.mk_user()
+            admin_role = self.mk_role("admin")
+            self.mk_role("protected.view", parent=admin_role)
+            user.add_role(admin_role)
+            db.session.commit()
+
+        with self.client:
+            # Anonymous users hold no roles
+            self.assertEqual(self.client.get("/fast/any").status_code, 403)
+
+            self.client.post("/login", data=dict(username="test_user"))
+            self.assertEqual(self.client.get("/fast/any").data, b"any")
+            self.assertEqual(self.client.get("/fast/all").status_code, 403)
+
+            with self.app.app_context():
+                user = db.session.query(User).one()
+                user.add_role(self.mk_role("protected.create"))
+                db.session.commit()
+            self.assertEqual(self.client.get("/fast/all").data, b"all")
+
+    def test_roles_endpoint_index(self):
+        self.app.config["ROLES_ENDPOINT_INDEX"] = True
+        self.init_app_routes()
+        roles = self.roles
+
+        @self.app.route("/reports")
+        @login_required
+        @roles.require_any("reports", "admin")
+        @roles.require_all("protected.view", http_exception=404)
+        def reports():
+            return Response("reports")
+
+        @roles.require_all("billing")
+        def billing_total():
+            return "billing"
+
+        @self.app.route("/summary")
+        @roles.require_any("admin")
+        def summary():
+            # A helper's own requirement is still checked
+            return Response(billing_total())
+
+        with self.app.test_request_context():
+            user = self.mk_user()
+            admin_role = self.mk_role("admin")
+            self.mk_role("protected.view", parent=admin_role)
+            user.add_role(admin_role)
+            db.session.commit()
+
+        with self.client:
+            # login_required still answers anonymous users first
+            self.assertEqual(self.client.get("/reports").status_code, 401)
+            self.assertEqual(self.client.get("/summary").status_code, 403)
+            self.assertEqual(
+                {
+                    endpoint: [r.http_exception for r in requirements]
+                    for endpoint, requirements in roles.endpoints.items()
+                },
+                {"reports": [403, 404], "summary": [403]},
+            )
+
+            self.client.post("/login", data=dict(username="test_user"))
+            calls = []
+            get_role_mask = roles.get_role_mask
+            roles.get_role_mask = lambda user: (
+                calls.append(user) or get_role_mask(user)
+            )
+            self.assertEqual(self.client.get("/reports").data, b"reports")
+            # One check for the whole stack of decorators
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(self.client.get("/summary").status_code, 403)
+
+        with self.app.app_context():
+            everything = sorted(self.app.view_functions)
+            self.assertEqual(
+                roles.allowed_endpoints(roles.index.mask(["admin"])),
+                [e for e in everything if e != "reports"],
+            )
+            self.assertEqual(
+                roles.allowed_endpoints(
+                    roles.index.mask(["admin", "protected.view"])
+                ),
+                everything,
+            )
+
+    def test_roles_generation_needs_the_user_model(self):
+        with self.assertRaises(ValueError):
+            self.init_roles(generation=role_generation)
+        with self.assertRaises(ValueError):
+            self.init_roles(via_factory=False, generation=role_generation)
+        self.init_roles(
+            via_factory=False, user_model=User, generation=role_generation
+        )
+        self.assertIsNotNone(self.roles.schema)
+
+    def test_roles_session_claims_need_a_generation(self):
+        self.app.config["ROLES_SESSION_CLAIMS"] = True
+        with self.assertRaises(ValueError):
+            self.init_roles()
+        with self.assertRaises(ValueError):
+            self.init_roles(user_model=User, generation=role_generation)
+
+    def test_roles_session_claims_skip_the_database(self):
+        self.app.config["ROLES_SESSION_CLAIMS"] = True
+        # Nor does the endpoint index load the user to rule out anonymous
+        self.app.config["ROLES_ENDPOINT_INDEX"] = True
+        self.init_app_routes(
+            user_model=User, generation=role_generation, session=db.session
+        )
+
+        @self.app.route("/fast/view")
+        @self.roles.require_any("protected.view")
+        def fast_view():
+            return Response("view")
+
+        with self.app.test_request_context():
+            user = self.mk_user()
+            admin_role = self.mk_role("admin")
+            view_role = self.mk_role("protected.view")
+            user.add_role(admin_role)
+            db.session.commit()
+
+        # The handler at the top of this module loads the user
+        identity_loaded.disconnect(on_identity_loaded)
+        try:
+            with self.client:
+                self.client.post("/login", data=dict(username="test_user"))
+                self.assertEqual(
+                    self.client.get("/fast/view").status_code, 403
+                )
+
+                statements = []
+                sa.event.listen(
+                    db.engine,
+                    "before_cursor_execute",
+                    lambda *args: statements.append(args[2]),
+                )
+                self.assertEqual(
+                    self.client.get("/fast/view").status_code, 403
+                )
+                # Only the generation is read
+                self.assertEqual(len(statements), 1)
+                self.assertIn("role_generation", statements[0])
+
+                # Any change to role data outdates the claim
+                with self.app.app_context():
+                    db.session.add(view_role)
+                    view_role.parent = admin_role
+                    db.session.commit()
+                self.assertEqual(self.client.get("/fast/view").data, b"view")
+                del statements[:]
+                self.assertEqual(self.client.get("/fast/view").data, b"view")
+                self.assertEqual(len(statements), 1)
+        finally:
+            identity_loaded.connect(on_identity_loaded)
+
+    def test_roles_session_claims_stamped_with_generation(self):
+        self.app.config["ROLES_SESSION_CLAIMS"] = True
+        self.init_roles(
+            user_model=User, generation=role_generation, session=db.session
+        )
+
+        @self.app.route("/login", methods=["post"])
+        def login():
+            login_user(db.session.query(User).one())
+            return Response("Yay!")
+
+        @self.app.route("/fast/view")
+        @self.roles.require_any("protected.view")
+        def fast_view():
+            return Response("view")
+
+        with self.app.test_request_context():
+            user_id = self.mk_user().id
+            role_id = self.mk_role("protected.view").id
+
+        with self.client:
+            self.client.post("/login")
+            self.assertEqual(self.client.get("/fast/view").status_code, 403)
+
+            with self.app.app_context():
+                # Another worker grants the role. Only the generation it
+                # bumped tells this one.
+                cursor = db.session.connection().connection.cursor()
+                cursor.execute(
+                    "INSERT INTO user_role (user_id, role_id) VALUES (?, ?)",
+                    (user_id, role_id),
+                )
+                cursor.execute(
+                    "UPDATE role_generation SET generation = generation + 1"
+                )
+                db.session.commit()
+            self.assertEqual(self.client.get("/fast/view").data, b"view")
+
+    def test_roles_session_claims_fit_the_cookie(self):
+        self.app.config["ROLES_SESSION_CLAIMS"] = True
+        self.init_app_routes(
+            user_model=User, generation=role_generation, session=db.session
+        )
+
+        @self.app.route("/fast/view")
+        @self.roles.require_any("protected.view")
+        def fast_view():
+            return Response("view")
+
+        with self.app.test_request_context():
+            user = self.mk_user()
+            user.add_roles(
+                [self.mk_role("protected.view")]
+                + [
+                    self.mk_role("department.team%02d.role%03d" % (i % 30, i))
+                    for i in range(300)
+                ]
+            )
+            db.session.commit()
+
+        with self.client:
+            self.client.post("/login", data=dict(username="test_user"))
+            self.assertEqual(self.client.get("/fast/view").data, b"view")
+            with self.client.session_transaction() as session:
+                claim = session["_roles"]
+            self.assertLess(len(claim[2]), 2048)
+            self.assertEqual(self.client.get("/fast/view").data, b"view")
+
+            # Too many roles to keep: resolved per request instead
+            self.roles.claim_size = len(claim[2]) - 1
+            with self.client.session_transaction() as session:
+                # Outdated, as by a role change
+                session["_roles"] = [claim[0], -1] + claim[2:]
+            self.assertEqual(self.client.get("/fast/view").data, b"view")
+            with self.client.session_transaction() as session:
+                self.assertNotIn("_roles", session)
+
+    def test_roles_identity_loaded_is_lazy(self):
+        self.app.config["ROLES_IDENTITY_LOADED"] = True
+        self.init_app_routes()
+        with self.app.test_request_context():
+            user = self.mk_user()
+            user.add_role(self.mk_role("protected.view"))
+            db.session.commit()
+
+        identity_loaded.disconnect(on_identity_loaded)
+        try:
+            with self.client:
+                self.client.post("/login", data=dict(username="test_user"))
+                self.roles.cache.clear()
+                statements = []
+                sa.event.listen(
+                    db.engine,
+                    "before_cursor_execute",
+                    lambda *args: statements.append(args[2]),
+                )
+                self.assertEqual(self.client.get("/profile").data, b"profile")
+                self.assertFalse(
+                    [s for s in statements if "role" in s],
+                    "login-only views must not resolve roles",
+                )
+                self.assertEqual(
+                    self.client.get("/protected/view").data, b"view protected"
+                )
+                self.assertEqual(
+                    self.client.get("/protected/create").data,
+                    b"Forbidden. Go away",
+                )
+
+                # Anonymous identities keep the plain empty set
+                with self.app.test_request_context():
+                    identity = AnonymousIdentity()
+                    identity_loaded.send(self.app, identity=identity)
+                    self.assertEqual(identity.provides, set())
+                    self.assertIs(type(identity.provides), set)
+        finally:
+            identity_loaded.connect(on_identity_loaded)
+
+    def test_roles_stats_and_signals(self):
+        self.app.config["ROLES_STATS"] = True
+        self.app.config["ROLES_CACHE_SIZE"] = 1
+        self.init_roles(user_model=User)
+        received = []
+
+        def record(sender, **kwargs):
+            received.append(kwargs)
+
+        signals = [
+            flask_roles.signals.roles_resolved,
+            flask_roles.signals.role_cache_hit,
+            flask_roles.signals.role_cache_miss,
+            flask_roles.signals.role_cache_evicted,
+        ]
+        for signal in signals:
+            signal.connect(record, sender=self.roles)
+        try:
+            with self.app.test_request_context():
+                user = self.mk_user()
+                other_user = self.mk_user("other_user")
+                admin_role = self.mk_role("admin")
+                self.mk_role("protected.view", parent=admin_role)
+                user.add_role(admin_role)
+                db.session.commit()
+
+                self.roles.get_role_names(user)
+                self.roles.get_role_names(user)
+                self.roles.get_role_names(other_user)
+                current = self.roles.stats.request()
+
+            self.assertEqual(current["resolutions"], 2)
+            self.assertEqual(current["roles_traversed"], 2)
+            self.assertGreater(current["statements"], 0)
+            self.assertGreater(current["resolve_seconds"], 0)
+            self.assertEqual(current["cache_hits"], 1)
+            self.assertEqual(current["cache_misses"], 2)
+            self.assertEqual(current["cache_evictions"], 1)
+
+            totals = self.roles.stats.snapshot()
+            self.assertEqual(totals["resolutions"], 2)
+            self.assertAlmostEqual(totals["hit_rate"], 1 / 3.0)
+            self.assertEqual(
+                [sorted(kwargs) for kwargs in received],
+                [
+                    ["user_id"],
+                    ["roles", "seconds", "statements", "user_id"],
+                    ["user_id"],
+                    ["user_id"],
+                    ["roles", "seconds", "statements", "user_id"],
+                    ["key"],
+                ],
+            )
+            self.roles.stats.reset()
+            self.assertEqual(self.roles.stats.snapshot()["resolutions"], 0)
+        finally:
+            for signal in signals:
+                signal.disconnect(record, sender=self.roles)
+
+    def test_get_children_loads_deep_trees_with_one_query(self):
+        with self.app.test_request_context():
+            user = self.mk_user()
+            parent = root = self.mk_role("level0")
+            for depth in range(1, 6):
+                parent = self.mk_role("level%d" % depth, parent=parent)
+                self.mk_role("leaf%d" % depth, parent=parent)
+            user.add_role(root)
+            db.session.commit()
+            db.session.expire_all()
+
+            statements = []
+            sa.event.listen(
+                db.engine,
+                "before_cursor_execute",
+                lambda *args: statements.append(args[2]),
+            )
+            names = [role.name for role in root.get_children()]
+            self.assertEqual(len(names), 11)
+            self.assertEqual(
+                names[:4], ["level0", "level1", "leaf1", "level2"]
+            )
+            self.assertEqual(len(statements), 1)
+            self.assertIn("WITH RECURSIVE", statements[0])
+
+            del statements[:]
+            db.session.expire_all()
+            self.assertEqual(sorted(user.get_role_names()), sorted(names))
+            # The expired user, user.roles, then the whole tree
+            self.assertEqual(len(statements), 3)
+
+            # level4, leaf4, level5 and leaf5
+            ids = db.session.execute(
+                flask_roles.model.descendant_ids(Role, [parent.parent_id])
+            )
+            self.assertEqual(len(list(ids)), 4)
+
+    def test_roles_async_checks_share_one_query(self):
+        self.init_roles(user_model=User)
+        with self.app.test_request_context():
+            user = self.mk_user()
+            other_user = self.mk_user("other_user")
+            group = self.mk_group("viewers")
+            admin_role = self.mk_role("admin")
+            view_role = self.mk_role("protected.view", parent=admin_role)
+            user.add_role(admin_role)
+            group.add_role(view_role)
+            other_user.groups.append(group)
+            db.session.commit()
+
+            session = FakeAsyncSession(db.session)
+            aio = self.roles.aio
+
+            async def checks():
+                return await asyncio.gather(
+                    aio.has_any_role(session, user, "admin"),
+                    aio.has_all_roles(
+                        session, user, "admin", "protected.view"
+                    ),
+                    aio.has_any_role(session, other_user.id, "admin"),
+                    aio.get_role_names(session, other_user),
+                    aio.get_role_mask(session, None),
+                )
+
+            self.assertEqual(
+                asyncio.run(checks()),
+                [True, True, False, frozenset(["protected.view"]), 0],
+            )
+            # Two users resolved by one statement
+            self.assertEqual(session.statements, 1)
+
+            asyncio.run(checks())
+            self.assertEqual(session.statements, 1)
+            self.assertEqual(
+                self.roles.get_role_names(user),
+                frozenset(["admin", "protected.view"]),
+            )
+
+    def test_roles_async_checks_per_event_loop(self):
+        self.init_roles(user_model=User, generation=role_generation)
+        with self.app.test_request_context():
+            user_id = self.mk_user().id
+            role_id = self.mk_role("admin").id
+            db.session.execute(
+                UserRole.__table__.insert(),
+                {"user_id": user_id, "role_id": role_id},
+            )
+            db.session.commit()
+            rows = {}
+            for statement in (
+                role_generation.select(),
+                flask_roles.batch.effective_role_names(
+                    self.roles.schema, [user_id]
+                ),
+            ):
+                rows[str(statement)] = db.session.execute(statement).fetchall()
+
+        class CannedSession(object):
+            # Answers from rows read up front, as another thread may not
+            # reach the in-memory database
+            def __init__(self, release=None):
+                self.release = release
+                self.resolving = threading.Event()
+                self.statements = 0
+
+            async def execute(self, statement):
+                self.statements += 1
+                if self.release is not None and self.statements > 1:
+                    self.resolving.set()
+                    await asyncio.get_running_loop().run_in_executor(
+                        None, self.release.wait
+                    )
+                return FakeResult(rows[str(statement)])
+
+        class FakeResult(list):
+            def first(self):
+                return self[0] if self else None
+
+        aio = self.roles.aio
+        release = threading.Event()
+        results = []
+
+        def check(session):
+            results.append(
+                asyncio.run(aio.has_any_role(session, user_id, "admin"))
+            )
+
+        # One loop is still resolving the user when another checks it
+        blocked_session = CannedSession(release)
+        blocked = threading.Thread(target=check, args=(blocked_session,))
+        blocked.start()
+        blocked_session.resolving.wait()
+        session = CannedSession()
+        try:
+            check(session)
+        finally:
+            release.set()
+            blocked.join()
+        self.assertEqual(results, [True, True])
+
+        self.roles.cache.clear()
+
+        async def checks():
+            return await asyncio.gather(
+                *[aio.has_any_role(session, user_id, "admin") for _ in "abc"]
+            )
+
+        # One generation read and one resolution for the batch
+        session.statements = 0
+        self.assertEqual(asyncio.run(checks()), [True] * 3)
+        self.assertEqual(session.statements, 2)
+        session.statements = 0
+        self.assertEqual(asyncio.run(checks()), [True] * 3)
+        self.assertEqual(session.statements, 1)
+
+    def test_roles_wildcard_requirements(self):
+        self.init_app_routes()
+
+        @self.app.route("/billing")
+        @self.roles.require_any("billing.*")
+        def billing():
+            return Response("billing")
+
+        @self.app.route("/invoices")
+        @self.roles.require_all("billing.invoice.*", "reports")
+        def invoices():
+            return Response("invoices")
+
+        with self.app.test_request_context():
+            user = self.mk_user()
+            billing_role = self.mk_role("billing")
+            self.mk_role("billing.invoice.read", parent=billing_role)
+            user.add_role(billing_role)
+            db.session.commit()
+
+            self.assertTrue(self.roles.has_any_role(user, "billing.*"))
+            self.assertTrue(
+                self.roles.has_all_roles(user, "billing", "billing.invoice.*")
+            )
+            self.assertFalse(
+                self.roles.has_all_roles(user, "billing.*", "reports.*")
+            )
+
+        with self.client:
+            self.client.post("/login", data=dict(username="test_user"))
+            self.assertEqual(self.client.get("/billing").data, b"billing")
+            self.assertEqual(self.client.get("/invoices").status_code, 403)
+
+    def test_roles_policy_requirements(self):
+        self.init_app_routes()
+
+        @self.app.route("/edit")
+        @self.roles.require("admin or (editor and not suspended)")
+        def edit():
+            return Response("edit")
+
+        with self.app.test_request_context():
+            user = self.mk_user()
+            editor = self.mk_role("editor")
+            suspended = self.mk_role("suspended")
+            user.add_role(editor)
+            db.session.commit()
+
+            self.assertTrue(self.roles.satisfies(user, "editor and not admin"))
+            self.assertFalse(self.roles.satisfies(user, "editor and admin"))
+
+        with self.client:
+            self.client.post("/login", data=dict(username="test_user"))
+            self.assertEqual(self.client.get("/edit").data, b"edit")
+
+        with self.app.test_request_context():
+            user = User.query.filter_by(username="test_user").one()
+            user.add_role(suspended)
+            db.session.commit()
+
+        with self.client:
+            self.client.post("/login", data=dict(username="test_user"))
+            self.assertEqual(self.client.get("/edit").status_code, 403)
+
+    def test_roles_graph_file_shared_between_workers(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, directory)
+        path = os.path.join(directory, "roles.graph")
+        self.addCleanup(os.remove, path)
+        self.app.config["ROLES_GRAPH"] = True
+        self.app.config["ROLES_GRAPH_FILE"] = path
+        self.init_roles(user_model=User, generation=role_generation)
+        with self.app.test_request_context():
+            user = self.mk_user()
+            admin_role = self.mk_role("admin")
+            self.mk_role("protected.view", parent=admin_role)
+            user.add_role(admin_role)
+            db.session.commit()
+
+            self.assertEqual(
+                self.roles.get_role_names(user),
+                frozenset(["admin", "protected.view"]),
+            )
+            self.assertTrue(os.path.exists(path))
+
+            # Another worker maps the file instead of reading the role table
+            worker = flask_roles.Roles(
+                user_model=User, generation=role_generation
+            )
+            worker.use_graph = True
+            worker.graph_file = path
+            stats = flask_roles.RoleStats()
+            with stats.timing() as timing:
+                graph = worker.get_graph(db.session)
+            # The version was already read during this request
+            self.assertEqual(timing["statements"], 0)
+            self.assertIsNotNone(graph._buffer)
+            self.assertEqual(
+                worker.index.names(graph.descendant_mask(admin_role.id)),
+                frozenset(["admin", "protected.view"]),
+            )
+
+            # A hierarchy change rewrites the file with the new version
+            self.mk_role("reports", parent=admin_role)
+            db.session.commit()
+            self.assertIn("reports", self.roles.get_role_names(user))
+            mapped = flask_roles.RoleGraph.open(path, flask_roles.RoleIndex())
+            self.assertEqual(mapped.version, self.roles.graph.version)
+            self.assertIn("reports", mapped.names)
+
+    def test_roles_graph_file_not_writable(self):
+        self.app.config["ROLES_GRAPH"] = True
+        self.app.config["ROLES_GRAPH_FILE"] = "/nonexistent/dir/roles.graph"
+        self.init_roles(user_model=User, generation=role_generation)
+        with self.app.test_request_context():
+            user = self.mk_user()
+            user.add_role(self.mk_role("admin"))
+            db.session.commit()
+
+            with self.assertLogs("flask_roles", "WARNING"):
+                names = self.roles.get_role_names(user)
+            self.assertEqual(names, frozenset(["admin"]))
+            self.assertIsNone(self.roles.graph._buffer)
+
+    def test_roles_holders_and_ancestors(self):
+        self.init_roles(user_model=User)
+        with self.app.test_request_context():
+            admin_role = self.mk_role("admin")
+            protected_role = self.mk_role("protected", parent=admin_role)
+            view_role = self.mk_role("protected.view", parent=protected_role)
+            reports_role = self.mk_role("reports")
+            admin = self.mk_user("admin_user")
+            viewer = self.mk_user("viewer")
+            reporter = self.mk_user("reporter")
+            group = Group(name="protected_group")
+            group.add_role(protected_role)
+            admin.add_role(admin_role)
+            viewer.groups.append(group)
+            reporter.add_role(reports_role)
+            db.session.add(group)
+            db.session.commit()
+
+            self.assertEqual(
+                [role.name for role in view_role.get_ancestors()],
+                ["protected.view", "protected", "admin"],
+            )
+            self.assertEqual(admin_role.get_ancestors(), [admin_role])
+
+            self.assertEqual(
+                list(self.roles.holders(db.session, "protected.view")),
+                [admin, viewer],
+            )
+            self.assertEqual(
+                list(self.roles.holders(db.session, "admin")), [admin]
+            )
+            self.assertEqual(
+                list(self.roles.holders(db.session, "protected", Group)),
+                [group],
+            )
+            self.assertEqual(
+                self.roles.holders(db.session, "missing").count(), 0
+            )
+
+    def test_roles_scoped_assignments(self):
+        self.init_app_routes()
+
+        @self.roles.scope_loader
+        def current_organisation():
+            return request.args.get("org", type=int)
+
+        @self.app.route("/projects")
+        @self.roles.require_any("project.admin")
+        def projects():
+            return Response("projects")
+
+        with self.app.test_request_context():
+            user = self.mk_user()
+            project_admin = self.mk_role("project.admin")
+            self.mk_role("project.view", parent=project_admin)
+            scoped_roles.grant(db.session, user, project_admin, 1)
+            self.assertFalse(
+                scoped_roles.grant(db.session, user, project_admin, 1)
+            )
+            db.session.commit()
+
+            self.assertEqual(self.roles.get_role_names(user), frozenset())
+            self.assertEqual(
+                self.roles.get_role_names(user, scope=1),
+                frozenset(["project.admin", "project.view"]),
+            )
+            self.assertFalse(
+                self.roles.has_any_role(user, "project.view", scope=2)
+            )
+            self.assertIn(("scope", 0, 1, 0, user.id), self.roles.cache._data)
+            self.assertIn(("scope", 0, 2, 0, user.id), self.roles.cache._data)
+
+            # Writes to one scope leave the others cached
+            scoped_roles.grant(db.session, user, project_admin, 2)
+            db.session.commit()
+            self.assertNotIn(
+                ("scope", 0, 2, 0, user.id), self.roles.cache._data
+            )
+            self.assertIn(("scope", 0, 1, 0, user.id), self.roles.cache._data)
+            self.assertTrue(
+                self.roles.has_any_role(user, "project.view", scope=2)
+            )
+
+            self.assertTrue(
+                scoped_roles.revoke(db.session, user, project_admin, 2)
+            )
+            db.session.commit()
+            self.assertFalse(
+                self.roles.has_any_role(user, "project.view", scope=2)
+            )
+
+        with self.client:
+            self.client.post("/login", data=dict(username="test_user"))
+            response = self.client.get("/projects?org=1")
+            self.assertEqual(response.data, b"projects")
+            response = self.client.get("/projects?org=2")
+            self.assertEqual(response.status_code, 403)
+            self.assertEqual(self.client.get("/projects").status_code, 403)
+
+        with self.app.test_request_context():
+            self.assertEqual(scoped_roles.delete_scope(db.session, 1), 1)
+            db.session.commit()
+            user = User.query.filter_by(username="test_user").one()
+            # The whole scope moved on to fresh cache keys
+            self.assertEqual(self.roles.get_role_names(user, 1), frozenset())
+
+    def test_roles_scoped_invalidation_with_a_generation(self):
+        client = DictCacheClient()
+        self.init_roles(
+            user_model=User,
+            cache=flask_roles.SharedCache(client),
+            generation=role_generation,
+        )
+        with self.app.test_request_context():
+            user = self.mk_user()
+            role_id = self.mk_role("project.admin").id
+            user_id = user.id
+
+        def grant_behind_the_back(scope):
+            # Only the cache tells other workers about scoped writes
+            cursor = db.session.connection().connection.cursor()
+            cursor.execute(
+                "INSERT INTO user_role_scope (scope_id, user_id, role_id) "
+                "VALUES (?, ?, ?)",
+                (scope, user_id, role_id),
+            )
+
+        with self.app.test_request_context():
+            user = db.session.query(User).get(user_id)
+            self.assertEqual(self.roles.get_role_names(user), frozenset())
+            self.assertEqual(self.roles.get_role_names(user, 7), frozenset())
+            versions = role_generation.versions(db.session)
+
+            # Scoped writes leave the generation, and other entries, alone
+            scoped_roles.grant(db.session, user, role_id, 8)
+            db.session.commit()
+            self.assertEqual(role_generation.versions(db.session), versions)
+            self.assertIn(
+                "flask_roles:%d:%d" % (versions[0], user_id), client.data
+            )
+            self.assertIn("flask_roles:scope:0:7:0:%d" % user_id, client.data)
+
+        for user_ids in ([user_id], None):
+            with self.app.test_request_context():
+                user = db.session.query(User).get(user_id)
+                scoped_roles.revoke(db.session, user, role_id, 7)
+                db.session.commit()
+                self.assertEqual(
+                    self.roles.get_role_names(user, 7), frozenset()
+                )
+                grant_behind_the_back(7)
+                db.session.commit()
+                self.assertEqual(
+                    self.roles.get_role_names(user, 7), frozenset()
+                )
+                self.roles.invalidate_scope(7, user_ids)
+                self.assertEqual(
+                    self.roles.get_role_names(user, 7),
+                    frozenset(["project.admin"]),
+                )
+
+        with self.app.test_request_context():
+            user = db.session.query(User).get(user_id)
+            self.assertEqual(
+                self.roles.get_role_names(user, 8),
+                frozenset(["project.admin"]),
+            )
+            # A new child role reaches the scoped entries of every worker
+            self.mk_role("project.view", parent=Role.query.get(role_id))
+            self.assertEqual(
+                self.roles.get_role_names(user, 8),
+                frozenset(["project.admin", "project.view"]),
+            )
+
+            # Without its scopes named, a write moves every scope on
+            table = scoped_roles.table
+            db.session.execute(
+                table.delete().where(table.c.user_id == user_id)
+            )
+            db.session.commit()
+            self.assertIn("flask_roles:scope:epoch", client.data)
+            self.assertEqual(self.roles.get_role_names(user, 8), frozenset())
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+
+import flask_roles
+from tests.closure_test import ClosureTestCase, Role, db, role_closure
+
+
+class TransferTest(ClosureTestCase):
+    def closure(self):
+        c = role_closure.table.c
+        rows = db.session.execute(
+            db.select([c.ancestor_id, c.descendant_id, c.depth])
+        )
+        names = {role.id: role.name for role in Role.query}
+        return {(names[a], names[d], depth) for a, d, depth in rows}
+
+    def test_import_in_any_order_with_small_batches(self):
+        self.mk_role("admin")
+        lines = [
+            '{"name": "protected.view", "parent": "protected"}',
+            "",
+            '{"name": "protected", "parent": "admin"}',
+            '{"name": "protected.view.archive", "parent": "protected.view"}',
+            '{"name": "reports", "parent": null}',
+            '{"name": "admin", "parent": null}',
+        ]
+        stats = flask_roles.RoleStats()
+        with stats.timing() as timing:
+            created = Role.import_roles(db.session, iter(lines), batch_size=2)
+        self.assertEqual(created, 4)
+        # Existing names, three batches of inserts with an id lookup each,
+        # and the closure rebuild (read, clear, insert)
+        self.assertEqual(timing["statements"], 1 + 3 * 2 + 3)
+
+        view = Role.query.filter_by(name="protected.view").one()
+        self.assertEqual(view.parent.name, "protected")
+        self.assertEqual(view.parent.parent.name, "admin")
+        self.assertIn(("admin", "protected.view.archive", 3), self.closure())
+        self.assertEqual(len(self.closure()), 5 + 3 + 2 + 1)
+
+    def test_import_unknown_parent(self):
+        lines = ['{"name": "a", "parent": "b"}', '{"name": "c"}']
+        with self.assertRaises(ValueError):
+            Role.import_roles(db.session, lines)
+        db.session.rollback()
+        self.assertEqual(Role.query.count(), 0)
+
+        with self.assertRaises(ValueError):
+            Role.import_roles(db.session, ['{"name": "a", "colour": "red"}'])
+
+    def test_export_round_trip(self):
+        admin = self.mk_role("admin")
+        reports = self.mk_role("reports")
+        protected = self.mk_role("protected", parent=admin)
+        self.mk_role("protected.view", parent=protected)
+        # Re-parent so that a child has a smaller id than its parent
+        admin.parent = reports
+        db.session.commit()
+
+        out = io.StringIO()
+        self.assertEqual(Role.export_roles(db.session, out), 4)
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(
+            records,
+            [
+                {"name": "reports", "parent": None},
+                {"name": "admin", "parent": "reports"},
+                {"name": "protected", "parent": "admin"},
+                {"name": "protected.view", "parent": "protected"},
+            ],
+        )
+
+        before = self.closure()
+        db.session.execute(role_closure.table.delete())
+        db.session.execute(Role.__table__.delete())
+        out.seek(0)
+        self.assertEqual(Role.import_roles(db.session, out), 4)
+        # Ids are reused, the loaded roles are stale
+        db.session.expire_all()
+        self.assertEqual(self.closure(), before)